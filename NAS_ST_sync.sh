@@ -4,9 +4,12 @@
 # assumed to contain trailing slash
 # param 2 = NAS st vid root
 # param 3 = SSH port
+# param 4 (optional) = file listing paths (relative to source) changed since
+#   last sync. Only those get transferred, and any missing from source get
+#   deleted on destination.
 
-if [ $# -ne 3 ]; then
-  echo "Expected three arguments - source path, destination path, and SSH port." >&2
+if [ $# -ne 3 ] && [ $# -ne 4 ]; then
+  echo "Expected three or four arguments - source path, destination path, SSH port, and optional changed-file list." >&2
   exit 2
   # https://stackoverflow.com/questions/18568706/check-number-of-arguments-passed-to-a-bash-script
 fi
@@ -16,6 +19,10 @@ ST_LOCAL_ROOT="$(dirname "$1")"
 
 NAS_ST_DIR=$2
 SSH_PORT=$3
+FILES_FROM_OPTS=""
+if [ $# -eq 4 ]; then
+  FILES_FROM_OPTS="--files-from=$4 --delete-missing-args --force"
+fi
 
 TIMESTAMP="$(date "+%Y-%m-%dT%H%M%S")";
 LOG_FILENAME=${ST_LOCAL_ROOT}/rsync_logs/${TIMESTAMP}_${JOB_NAME};
@@ -36,6 +43,7 @@ set -x
 rsync -rltgoD -zivh --log-file=${LOG_FILENAME} \
   --partial-dir=${ST_LOCAL_ROOT}/rsync_partials \
   --omit-dir-times \
+  ${FILES_FROM_OPTS} \
   -e "ssh -p ${SSH_PORT}" \
   ${SRC_PATH} ${DEST_PATH}
   # first group of options is equivalent to -a without the -p (permissions)
@@ -0,0 +1,256 @@
+import os
+import re
+import json
+import fnmatch
+
+from idevice_media_offload.dir_names import CAT_DIRS
+from idevice_media_offload import meta_cache
+from idevice_media_offload import copy_engine
+from idevice_media_offload import media_unit
+
+
+class RuleFileError(Exception):
+    pass
+
+
+RULES_FILE_NAME = "cat_rules.json"  # Default location is next to Cat_Buffer
+NAME_DATE_RE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})_")
+
+# Used when there's no rule file, and added to a rule file that has no rule
+# for st_buffer, so st_buffer works as it always has.
+ST_RULE = {"name": "st", "buffer": "st_buffer", "dest": "st",
+                                                        "date_folder": True}
+
+
+# Rules that route Cat_Buffer items to destinations in bulk, before the
+# one-at-a-time photo_transfer prompt.
+# Rule file is a JSON list of rules, tried in order (first match wins):
+#   [{"name": "receipts", "buffer": "receipts_buffer", "dest": "r"},
+#    {"name": "trip", "dest": "/media/.../2019_Vacation",
+#     "date_from": "2019-07-01", "date_to": "2019-07-14",
+#     "gps_box": [35.0, -84.0, 36.0, -83.0]},
+#    {"name": "screenshots", "name_pattern": "*.PNG", "make": "",
+#     "dest": "ss", "date_folder": true}]
+# Keys:
+#   buffer        Subfolder of Cat_Buffer the rule applies to (an auto-buffer,
+#                 created if missing). Left out, rule applies to items in
+#                 Cat_Buffer itself, and anything not matched goes on to
+#                 photo_transfer as usual.
+#   dest          CAT_DIRS key or dir path.
+#   date_folder   Put each item in YYYY-MM-DD folder under dest (made as
+#                 needed), like st has always worked.
+# Conditions (all given ones must hold, none means match everything):
+#   name_pattern  Shell-style pattern for file name (case-insensitive).
+#   name_regex    Regex searched for in file name.
+#   date_from, date_to  Capture date range (YYYY-MM-DD, inclusive).
+#   caption_regex Regex searched for in caption/comment tags (ignores case).
+#   make, model   Text found in camera make/model (ignores case). "" matches
+#                 only items with no make/model (e.g. screenshots, downloads).
+#   has_gps       true/false.
+#   gps_box       [south lat, west lon, north lat, east lon].
+# Metadata comes from MetaCache, fetched in bulk only if some rule needs it.
+
+RULE_KEYS = ["name", "buffer", "dest", "date_folder"]
+NAME_CONDITIONS = ["name_pattern", "name_regex"]
+META_CONDITIONS = ["date_from", "date_to", "caption_regex", "make", "model",
+                                                        "has_gps", "gps_box"]
+
+
+class Rule(object):
+    """Represents one routing rule from rule file."""
+    def __init__(self, rule_data, rule_num):
+        if not isinstance(rule_data, dict):
+            raise RuleFileError("Rule %d is not a JSON object." % rule_num)
+        unknown_keys = set(rule_data) - set(RULE_KEYS + NAME_CONDITIONS
+                                                            + META_CONDITIONS)
+        if unknown_keys:
+            raise RuleFileError("Rule %d has unknown key(s): %s"
+                                % (rule_num, ", ".join(sorted(unknown_keys))))
+        if not rule_data.get("dest"):
+            raise RuleFileError("Rule %d has no dest." % rule_num)
+
+        self.rule_data = rule_data
+        self.name = rule_data.get("name", "rule %d" % rule_num)
+        self.buffer = rule_data.get("buffer", "")
+        self.date_folder = rule_data.get("date_folder", False)
+        try:
+            self.name_regex = (re.compile(rule_data["name_regex"])
+                                        if "name_regex" in rule_data else None)
+            self.caption_regex = (re.compile(rule_data["caption_regex"],
+                                                                re.IGNORECASE)
+                                    if "caption_regex" in rule_data else None)
+        except re.error as error:
+            raise RuleFileError("Rule '%s' has invalid regex: %s"
+                                                        % (self.name, error))
+        for date_key in ["date_from", "date_to"]:
+            if date_key in rule_data and not re.match(r"^\d{4}-\d{2}-\d{2}$",
+                                                        rule_data[date_key]):
+                raise RuleFileError("Rule '%s' %s not in YYYY-MM-DD format."
+                                                    % (self.name, date_key))
+        if "gps_box" in rule_data and len(rule_data["gps_box"]) != 4:
+            raise RuleFileError("Rule '%s' gps_box needs 4 values." % self.name)
+
+    def get_name(self):
+        return self.name
+
+    def get_buffer(self):
+        return self.buffer
+
+    def get_dest_root(self):
+        """Returns dir path rule sends items to (before any date folder)."""
+        dest = self.rule_data["dest"]
+        return CAT_DIRS.get(dest, dest)
+
+    def needs_meta(self):
+        return any(key in self.rule_data for key in META_CONDITIONS)
+
+    def matches(self, img_path, img_meta):
+        img_name = os.path.basename(img_path)
+        if ("name_pattern" in self.rule_data and not fnmatch.fnmatch(
+                        img_name.lower(), self.rule_data["name_pattern"].lower())):
+            return False
+        if self.name_regex and not self.name_regex.search(img_name):
+            return False
+
+        if "date_from" in self.rule_data or "date_to" in self.rule_data:
+            img_date = get_img_date(img_path, img_meta)
+            if not img_date:
+                return False
+            if img_date < self.rule_data.get("date_from", img_date):
+                return False
+            if img_date > self.rule_data.get("date_to", img_date):
+                return False
+
+        if self.caption_regex and not self.caption_regex.search(
+                                            meta_cache.get_caption(img_meta)):
+            return False
+
+        for tag_key, tags in [("make", ["EXIF:Make", "QuickTime:Make"]),
+                              ("model", ["EXIF:Model", "QuickTime:Model"])]:
+            if tag_key not in self.rule_data:
+                continue
+            tag_value = " ".join(str(img_meta[tag]) for tag in tags
+                                                        if img_meta.get(tag))
+            if self.rule_data[tag_key] == "":
+                if tag_value:
+                    return False
+            elif self.rule_data[tag_key].lower() not in tag_value.lower():
+                return False
+
+        lat = img_meta.get("Composite:GPSLatitude")
+        lon = img_meta.get("Composite:GPSLongitude")
+        has_gps = lat is not None and lon is not None
+        if "has_gps" in self.rule_data and self.rule_data["has_gps"] != has_gps:
+            return False
+        if "gps_box" in self.rule_data:
+            if not has_gps:
+                return False
+            (south, west, north, east) = self.rule_data["gps_box"]
+            try:
+                if not (south <= float(lat) <= north
+                                            and west <= float(lon) <= east):
+                    return False
+            except ValueError:
+                return False
+        return True
+
+    def get_dest_dir(self, img_path, img_meta):
+        """Returns dir item goes to, or None if it needs a date folder and
+        has no date."""
+        dest_root = self.get_dest_root()
+        if not self.date_folder:
+            return dest_root
+        img_date = get_img_date(img_path, img_meta)
+        if not img_date:
+            return None
+        return os.path.join(dest_root, img_date)
+
+    def __repr__(self):
+        return "Rule '%s' (buffer '%s') -> %s" % (self.name, self.buffer,
+                                                        self.rule_data["dest"])
+
+
+class RuleSet(object):
+    """Represents rule file (or default st rule if there isn't one)."""
+    def __init__(self, rules_path):
+        self.rules_path = rules_path
+        if os.path.isfile(self.rules_path):
+            with open(self.rules_path, "r") as rules_file:
+                try:
+                    rules_data = json.load(rules_file)
+                except ValueError as error:
+                    raise RuleFileError("Rule file %s not valid JSON: %s"
+                                                    % (self.rules_path, error))
+            if not isinstance(rules_data, list):
+                raise RuleFileError("Rule file %s should hold a JSON list."
+                                                            % self.rules_path)
+        else:
+            rules_data = []
+        self.rules = [Rule(rule_data, n+1) for n, rule_data
+                                                    in enumerate(rules_data)]
+        if not any(AutoRule.get_buffer() == ST_RULE["buffer"]
+                                                for AutoRule in self.rules):
+            self.rules.append(Rule(ST_RULE, len(self.rules) + 1))
+
+    def get_rules_path(self):
+        return self.rules_path
+
+    def get_buffers(self):
+        """Returns names of auto-buffers (Cat_Buffer subfolders) in use."""
+        return sorted(set(AutoRule.get_buffer() for AutoRule in self.rules
+                                                    if AutoRule.get_buffer()))
+
+    def get_rules(self, buffer_name):
+        return [AutoRule for AutoRule in self.rules
+                                    if AutoRule.get_buffer() == buffer_name]
+
+    def route(self, buffer_path, buffer_name, Cache):
+        """Matches every file in buffer_path against rules for that buffer.
+        Returns (routes, unmatched): routes is list of (Rule, img_path,
+        dest_dir) and unmatched is list of img names no rule took.
+        Files of one media unit (HEIC and its JPG, Live Photo video, IMG_E
+        edit) are routed together by the primary one."""
+        buffer_rules = self.get_rules(buffer_name)
+        img_names = sorted(img for img
+                            in copy_engine.clean_temp_files(buffer_path)
+                            if os.path.isfile(os.path.join(buffer_path, img)))
+        if not buffer_rules:
+            return ([], img_names)
+
+        units = media_unit.build_units(img_names, buffer_path)
+
+        if any(AutoRule.needs_meta() for AutoRule in buffer_rules):
+            all_meta = Cache.get_many([Unit.get_primary() for Unit in units])
+        else:
+            all_meta = {}
+
+        routes = []
+        unmatched = []
+        for Unit in units:
+            primary_path = Unit.get_primary()
+            img_meta = all_meta.get(primary_path, {})
+            for AutoRule in buffer_rules:
+                if AutoRule.matches(primary_path, img_meta):
+                    dest_dir = AutoRule.get_dest_dir(primary_path, img_meta)
+                    if dest_dir:
+                        routes += [(AutoRule, unit_path, dest_dir)
+                                            for unit_path in Unit.get_paths()]
+                        break
+            else:
+                unmatched += Unit.get_names()
+        return (routes, unmatched)
+
+    def __repr__(self):
+        return "RuleSet object with path:\n\t%s" % self.rules_path
+
+
+def get_img_date(img_path, img_meta):
+    """Returns YYYY-MM-DD date for item. Datestamp ORG put on name is used
+    first (st folders have always been named by it), then metadata."""
+    name_match = NAME_DATE_RE.match(os.path.basename(img_path))
+    if name_match:
+        return "%s-%s-%s" % name_match.groups()
+    date_parts = meta_cache.get_date_parts(img_path, img_meta)
+    if date_parts:
+        return "%s-%s-%s" % date_parts[:3]
+    return None
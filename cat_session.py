@@ -0,0 +1,196 @@
+import os
+import time
+import json
+import queue
+import threading
+
+from idevice_media_offload import copy_engine
+
+
+DATETIME_FORMAT = "%Y-%m-%dT%H%M%S"  # Global format
+
+SESSION_FILE_NAME = "cat_session.jsonl"  # Stored next to Cat_Buffer in BU root
+
+
+# Journal of a Categorizer (photo_transfer) session, so an interrupted session
+# can pick up where it left off: manual dirs entered, position in buffer, and
+# every decision made.
+# Decisions are applied by a background worker so user never waits on file
+# I/O between images. Each one is marked applied in the journal once done, so
+# any still pending when interrupted get re-applied on resume. Re-applying is
+# safe since moves whose source is gone are skipped and repeated copies are
+# recognized as identical files.
+# Collisions found by worker are journaled and held for one review at end of
+# session (carried over if session is resumed).
+# Writes are synced to disk as a group whenever worker catches up with user
+# (see copy_engine.commit()), and only then marked applied.
+
+class CatSession(object):
+    """Represents journal file for a photo_transfer session plus worker
+    applying its decisions. apply_func is called in worker thread with
+    (copy_jobs, delete_paths) and returns list of unresolved conflicts."""
+    def __init__(self, buffer_root, apply_func):
+        self.buffer_root = buffer_root
+        self.session_path = os.path.join(os.path.dirname(
+                            os.path.normpath(buffer_root)), SESSION_FILE_NAME)
+        self.apply_func = apply_func
+
+        self.seq = 0
+        self.journal_file = None
+        self.decision_queue = queue.Queue()
+        self.conflicts = []
+        self.errors = []
+        self.lock = threading.Lock()
+        self.worker_thread = None
+
+    def get_session_path(self):
+        return self.session_path
+
+    def has_unfinished(self):
+        return os.path.exists(self.session_path)
+
+    def load_unfinished(self):
+        """Reads journal left by interrupted session. Returns dict with
+        manual_dirs (list), position (img name or None), started (timestamp
+        str), pending (list of decision dicts not yet applied), and conflicts
+        (list of conflicts not yet reviewed)."""
+        session_state = {"manual_dirs": [], "position": None,
+                         "started": None, "pending": [], "conflicts": []}
+        decisions = {}
+        applied = set()
+        with open(self.session_path, "r") as session_file:
+            for line in session_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line may be partly written if killed mid-write.
+                    continue
+                if entry["op"] == "start":
+                    session_state["started"] = entry["time"]
+                elif entry["op"] == "manual_dir":
+                    if entry["path"] not in session_state["manual_dirs"]:
+                        session_state["manual_dirs"].append(entry["path"])
+                elif entry["op"] == "position":
+                    session_state["position"] = entry["img"]
+                elif entry["op"] == "decide":
+                    decisions[entry["seq"]] = entry
+                    self.seq = max(self.seq, entry["seq"])
+                elif entry["op"] == "applied":
+                    applied.add(entry["seq"])
+                elif entry["op"] == "conflict":
+                    session_state["conflicts"].append(tuple(entry["conflict"]))
+                elif entry["op"] == "conflicts_reviewed":
+                    session_state["conflicts"] = []
+        session_state["pending"] = [decisions[seq] for seq in sorted(decisions)
+                                                        if seq not in applied]
+        return session_state
+
+    def start(self, resume_state=None):
+        """Opens journal (appending if resuming) and starts worker. Decisions
+        still pending from resumed session are queued first."""
+        if not resume_state and os.path.exists(self.session_path):
+            os.remove(self.session_path)
+        # Line-buffered so every entry hits the file as soon as it's recorded.
+        self.journal_file = open(self.session_path, "a", buffering=1)
+        if resume_state:
+            self.conflicts = list(resume_state.get("conflicts", []))
+            for decision in resume_state["pending"]:
+                self.decision_queue.put(decision)
+        else:
+            self.write({"op": "start", "time": time.strftime(DATETIME_FORMAT)})
+
+        self.worker_thread = threading.Thread(target=self.worker,
+                                            name="CatSession", daemon=True)
+        self.worker_thread.start()
+
+    def write(self, entry):
+        with self.lock:
+            self.journal_file.write(json.dumps(entry) + "\n")
+
+    def record_manual_dir(self, dir_path):
+        self.write({"op": "manual_dir", "path": dir_path})
+
+    def record_position(self, img_name):
+        self.write({"op": "position", "img": img_name})
+
+    def submit(self, copy_jobs=None, delete_paths=None):
+        """Journals a decision then queues it for worker.
+        copy_jobs in form copy_batch_to_target() takes."""
+        with self.lock:
+            self.seq += 1
+            decision = {"op": "decide", "seq": self.seq,
+                        "copy_jobs": copy_jobs or [],
+                        "delete_paths": delete_paths or []}
+        self.write(decision)
+        self.decision_queue.put(decision)
+
+    def worker(self):
+        uncommitted_seqs = []
+        while True:
+            decision = self.decision_queue.get()
+            try:
+                if decision is None:
+                    self.commit(uncommitted_seqs)
+                else:
+                    conflicts = self.apply_func([tuple(copy_job) for copy_job
+                                                in decision["copy_jobs"]],
+                                                decision["delete_paths"])
+                    for conflict in conflicts:
+                        self.write({"op": "conflict", "seq": decision["seq"],
+                                                    "conflict": list(conflict)})
+                    with self.lock:
+                        self.conflicts += conflicts
+                    uncommitted_seqs.append(decision["seq"])
+                    if self.decision_queue.empty():
+                        # Caught up. Sync everything applied since last time
+                        # at once.
+                        self.commit(uncommitted_seqs)
+            except Exception as error:
+                # Anything failing (not just file I/O, e.g. a malformed entry
+                # from resumed journal) is reported at end of session, and
+                # worker keeps going so wait() and finish() don't hang.
+                # Decision left unapplied in journal so it's retried on resume.
+                with self.lock:
+                    self.errors.append((decision, error))
+            finally:
+                self.decision_queue.task_done()
+            if decision is None:
+                break
+
+    def commit(self, uncommitted_seqs):
+        """Syncs applied decisions' writes to disk, then marks them applied
+        in journal. Empties uncommitted_seqs."""
+        if not uncommitted_seqs:
+            return
+        copy_engine.commit()
+        for seq in uncommitted_seqs:
+            self.write({"op": "applied", "seq": seq})
+        del uncommitted_seqs[:]
+
+    def wait(self):
+        """Blocks until every decision submitted so far is applied."""
+        self.decision_queue.join()
+
+    def get_conflicts(self):
+        with self.lock:
+            return list(self.conflicts)
+
+    def record_conflicts_reviewed(self):
+        # Called once conflicts from get_conflicts() have been reviewed.
+        with self.lock:
+            self.conflicts = []
+        self.write({"op": "conflicts_reviewed"})
+
+    def finish(self):
+        """Waits for worker to apply everything, stops it, and returns
+        list of (decision, error) for decisions that failed. Journal removed
+        if nothing failed so next session starts fresh."""
+        self.decision_queue.put(None)
+        self.worker_thread.join()
+        self.journal_file.close()
+        if not self.errors:
+            os.remove(self.session_path)
+        return self.errors
+
+    def __repr__(self):
+        return "CatSession object with path:\n\t%s" % self.session_path
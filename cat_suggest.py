@@ -0,0 +1,177 @@
+import os
+import re
+import time
+import json
+import math
+import threading
+
+from idevice_media_offload import meta_cache
+
+
+HISTORY_FILE_NAME = "cat_history.jsonl"  # Stored next to Cat_Buffer in BU root
+SMOOTHING = 1.0  # Laplace smoothing for feature counts
+MIN_SUGGEST_CONFIDENCE = 0.3  # Below this, no suggestion shown
+AUTO_ROUTE_MIN_EXAMPLES = 20  # Dest needs this many past decisions to auto-route
+CAPTION_WORD_RE = re.compile(r"[a-z0-9]{3,}")
+
+
+# Suggests destination for each Cat_Buffer item based on where earlier items
+# went. Every photo_transfer decision is appended to a history file along
+# with features of the item (capture date, GPS area, device, caption words,
+# file type). Suggestions come from a naive Bayes model over those features,
+# retrained from history at start of each session (just counting, so fast).
+# Runs entirely offline.
+
+class CatSuggester(object):
+    """Represents decision history plus model trained on it."""
+    def __init__(self, history_dir):
+        self.history_path = os.path.join(history_dir, HISTORY_FILE_NAME)
+        self.lock = threading.Lock()
+        self.suggestions = {}  # img path: (dest, confidence)
+        self.train()
+
+    def get_history_path(self):
+        return self.history_path
+
+    def load_history(self):
+        history = []
+        if os.path.exists(self.history_path):
+            with open(self.history_path, "r") as history_file:
+                for line in history_file:
+                    try:
+                        history.append(json.loads(line))
+                    except ValueError:
+                        continue
+        return history
+
+    def train(self):
+        self.dest_counts = {}
+        self.feature_counts = {}  # dest: {feature: count}
+        self.feature_totals = {}  # dest: total feature count
+        self.vocab = set()
+        for decision in self.load_history():
+            self.learn(decision["dest"], decision["features"])
+
+    def learn(self, dest, features):
+        self.dest_counts[dest] = self.dest_counts.get(dest, 0) + 1
+        dest_features = self.feature_counts.setdefault(dest, {})
+        for feature in features:
+            dest_features[feature] = dest_features.get(feature, 0) + 1
+            self.feature_totals[dest] = self.feature_totals.get(dest, 0) + 1
+            self.vocab.add(feature)
+
+    def record(self, img_path, dest, features):
+        """Appends decision to history and updates model with it."""
+        decision = {"time": time.strftime("%Y-%m-%dT%H%M%S"),
+                    "img": os.path.basename(img_path),
+                    "dest": dest, "features": features}
+        with self.lock:
+            with open(self.history_path, "a") as history_file:
+                history_file.write(json.dumps(decision) + "\n")
+            self.learn(dest, features)
+
+    def suggest(self, features):
+        """Returns (dest, confidence) for most likely destination, or
+        (None, 0) if no history. Confidence is posterior probability."""
+        with self.lock:
+            dests = [dest for dest in self.dest_counts if os.path.isdir(dest)]
+            if not dests:
+                return (None, 0)
+            total_decisions = sum(self.dest_counts[dest] for dest in dests)
+            vocab_size = len(self.vocab) + 1
+            log_probs = {}
+            for dest in dests:
+                log_prob = math.log(self.dest_counts[dest] / total_decisions)
+                dest_features = self.feature_counts[dest]
+                denominator = (self.feature_totals.get(dest, 0)
+                                                    + SMOOTHING * vocab_size)
+                for feature in features:
+                    log_prob += math.log((dest_features.get(feature, 0)
+                                                    + SMOOTHING) / denominator)
+                log_probs[dest] = log_prob
+
+        # Normalize in log space to avoid underflow.
+        max_log_prob = max(log_probs.values())
+        norm = sum(math.exp(log_prob - max_log_prob)
+                                            for log_prob in log_probs.values())
+        best_dest = max(log_probs, key=log_probs.get)
+        return (best_dest, 1 / norm)
+
+    def score_all(self, img_paths, Cache):
+        """Computes suggestions for all given items using metadata from
+        Cache (MetaCache), fetched in batches. Meant to run in background.
+        Results read with get_suggestion()."""
+        all_meta = Cache.get_many(img_paths)
+        for img_path in img_paths:
+            features = get_features(img_path, all_meta.get(img_path, {}))
+            suggestion = self.suggest(features)
+            with self.lock:
+                self.suggestions[img_path] = suggestion
+
+    def score_in_background(self, img_paths, Cache):
+        score_thread = threading.Thread(target=self.score_all,
+                        args=(img_paths, Cache), name="CatSuggester", daemon=True)
+        score_thread.start()
+        return score_thread
+
+    def get_suggestion(self, img_path):
+        """Returns (dest, confidence) if scored and confident enough to show,
+        otherwise None."""
+        with self.lock:
+            suggestion = self.suggestions.get(img_path)
+        if suggestion and suggestion[0] and suggestion[1] >= MIN_SUGGEST_CONFIDENCE:
+            return suggestion
+        return None
+
+    def can_auto_route(self, suggestion, min_confidence):
+        if not suggestion or min_confidence is None:
+            return False
+        (dest, confidence) = suggestion
+        return (confidence >= min_confidence
+                and self.dest_counts.get(dest, 0) >= AUTO_ROUTE_MIN_EXAMPLES
+                and os.path.isdir(dest))
+
+    def __repr__(self):
+        return "CatSuggester object with history path:\n\t%s" % self.history_path
+
+
+def get_features(img_path, img_meta):
+    """Returns list of feature strings for an item from its metadata."""
+    img_name = os.path.basename(img_path)
+    features = ["ext:%s" % os.path.splitext(img_name)[-1].upper()]
+
+    date_parts = meta_cache.get_date_parts(img_path, img_meta)
+    if date_parts:
+        (year, month, day, hour) = date_parts
+        features += ["year:%s" % year, "yrmon:%s-%s" % (year, month),
+                     "date:%s-%s-%s" % (year, month, day)]
+        try:
+            weekday = time.strftime("%a", time.strptime("%s-%s-%s"
+                                            % (year, month, day), "%Y-%m-%d"))
+            features.append("weekday:%s" % weekday)
+        except ValueError:
+            pass
+        if hour:
+            features.append("hour:%d" % (int(hour) // 6))  # 6-hr bucket
+
+    lat = img_meta.get("Composite:GPSLatitude")
+    lon = img_meta.get("Composite:GPSLongitude")
+    if lat is not None and lon is not None:
+        try:
+            # Roughly 10 km and 100 km squares.
+            features += ["gps:%.1f,%.1f" % (float(lat), float(lon)),
+                         "gps_area:%d,%d" % (round(float(lat)), round(float(lon)))]
+        except ValueError:
+            pass
+    else:
+        features.append("gps:none")
+
+    make = img_meta.get("EXIF:Make") or img_meta.get("QuickTime:Make")
+    model = img_meta.get("EXIF:Model") or img_meta.get("QuickTime:Model")
+    features.append("device:%s %s" % (make, model) if (make or model)
+                                                        else "device:none")
+
+    caption = meta_cache.get_caption(img_meta)
+    for word in sorted(set(CAPTION_WORD_RE.findall(caption.lower()))):
+        features.append("cap:%s" % word)
+    return features
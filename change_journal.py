@@ -0,0 +1,187 @@
+import os
+import time
+import json
+import threading
+
+
+DATETIME_FORMAT = "%Y-%m-%dT%H%M%S"  # Global format
+
+JOURNAL_DIR_NAME = "change_journals"
+SYNC_STATE_NAME = "synced.json"
+# Marks for syncs run by the rsync scripts in a separate terminal. Written as
+# pending, renamed to done by the terminal's shell only if rsync succeeds.
+MARK_PENDING_SUFFIX = "_mark_pending"
+MARK_DONE_SUFFIX = "_mark_done"
+
+
+# Journal of every path the OFFLOAD, ORG, and CAT programs create, move, or
+# delete. NAS syncs read back only the paths under their source root so they
+# don't have to walk the whole archive.
+# Recording is a no-op unless a journal has been started (e.g. when the tools
+# are used standalone), in which case syncs fall back on a full tree walk.
+# Normally one journal (in the BU root) records everything. When several BU
+# roots are written at once (multi-device offload), each has its own journal
+# recording only paths under that root.
+
+_ActiveJournals = []
+
+
+class ChangeJournal(object):
+    """Represents journal dir holding one append-only change file per run plus
+    a record of how far each sync source root has been synced."""
+    def __init__(self, journal_dir, root_path=None):
+        self.journal_dir = journal_dir
+        # Only paths under root_path recorded. None for all paths.
+        self.root_path = (os.path.normpath(os.path.abspath(root_path))
+                                                    if root_path else None)
+        if not os.path.exists(self.journal_dir):
+            os.makedirs(self.journal_dir)
+        self.journal_path = os.path.join(self.journal_dir,
+                                "%s_changes" % time.strftime(DATETIME_FORMAT))
+        self.state_path = os.path.join(self.journal_dir, SYNC_STATE_NAME)
+        self.lock = threading.Lock()
+        # Line-buffered so every entry hits the file as soon as it's recorded.
+        self.journal_file = open(self.journal_path, "a", buffering=1)
+        # rsync runs from earlier sessions that never reported success. Their
+        # changes are still pending, so they'll be included in next sync.
+        for name in os.listdir(self.journal_dir):
+            if name.endswith(MARK_PENDING_SUFFIX):
+                os.remove(os.path.join(self.journal_dir, name))
+        self.apply_done_marks()
+
+    def get_journal_path(self):
+        return self.journal_path
+
+    def covers(self, path):
+        return (self.root_path is None
+                or os.path.abspath(path).startswith(self.root_path + os.sep))
+
+    def record(self, op, path):
+        # op is '+' for path created or modified, '-' for path removed.
+        with self.lock:
+            self.journal_file.write("%s %s\n" % (op, os.path.abspath(path)))
+
+    def list_journal_files(self):
+        return sorted(os.path.join(self.journal_dir, name)
+                        for name in os.listdir(self.journal_dir)
+                                            if name.endswith("_changes"))
+
+    def load_sync_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as state_file:
+                return json.load(state_file)
+        else:
+            return {}
+
+    def pending_changes(self, src_root):
+        """Returns (rel_paths, mark) where rel_paths is sorted list of every
+        path under src_root touched since that root was last synced (relative
+        to src_root) and mark gets passed to mark_synced() once sync succeeds.
+        Includes paths from earlier runs whose sync never completed."""
+        self.apply_done_marks()
+        root_key = os.path.normpath(os.path.abspath(src_root))
+        root_prefix = root_key + os.sep
+        synced_lines = self.load_sync_state().get(root_key, {})
+
+        touched = set()
+        mark = {}
+        with self.lock:
+            self.journal_file.flush()
+            for journal_path in self.list_journal_files():
+                journal_name = os.path.basename(journal_path)
+                skip_lines = synced_lines.get(journal_name, 0)
+                with open(journal_path, "r") as journal_file:
+                    lines = journal_file.read().splitlines()
+                mark[journal_name] = len(lines)
+                for line in lines[skip_lines:]:
+                    path = line[2:]
+                    if path.startswith(root_prefix):
+                        touched.add(os.path.relpath(path, root_key))
+        return (sorted(touched), mark)
+
+    def mark_synced(self, src_root, mark):
+        root_key = os.path.normpath(os.path.abspath(src_root))
+        with self.lock:
+            sync_state = self.load_sync_state()
+            sync_state[root_key] = mark
+            with open(self.state_path + ".tmp", "w") as state_file:
+                json.dump(sync_state, state_file)
+            os.replace(self.state_path + ".tmp", self.state_path)
+
+    def write_sync_mark(self, src_root, mark, job_name):
+        """Saves mark for a sync run outside this program (rsync script).
+        Returns (pending_path, done_path). Caller's script renames pending
+        file to done_path only if it succeeds, and mark is applied next time
+        changes are read. Until then changes stay pending."""
+        mark_base = os.path.join(self.journal_dir, "%s_%s"
+                                    % (time.strftime(DATETIME_FORMAT), job_name))
+        with open(mark_base + MARK_PENDING_SUFFIX, "w") as mark_file:
+            json.dump({"src_root": src_root, "mark": mark}, mark_file)
+        return (mark_base + MARK_PENDING_SUFFIX, mark_base + MARK_DONE_SUFFIX)
+
+    def apply_done_marks(self):
+        # Records syncs the rsync scripts reported finished (see
+        # write_sync_mark()).
+        for name in sorted(os.listdir(self.journal_dir)):
+            if not name.endswith(MARK_DONE_SUFFIX):
+                continue
+            mark_path = os.path.join(self.journal_dir, name)
+            with open(mark_path, "r") as mark_file:
+                sync_mark = json.load(mark_file)
+            self.mark_synced(sync_mark["src_root"], sync_mark["mark"])
+            os.remove(mark_path)
+
+    def write_files_from(self, rel_paths, job_name):
+        """Writes list in form rsync's --files-from option expects.
+        Returns list file's path."""
+        list_path = os.path.join(self.journal_dir, "%s_%s_files"
+                                    % (time.strftime(DATETIME_FORMAT), job_name))
+        with open(list_path, "w") as list_file:
+            for rel_path in rel_paths:
+                list_file.write(rel_path + "\n")
+        return list_path
+
+    def close(self):
+        self.journal_file.close()
+
+    def __repr__(self):
+        return "ChangeJournal object with path:\n\t%s" % self.journal_path
+
+
+def start_journal(journal_dir, root_path=None):
+    """Starts journal recording every path, replacing any active ones. If
+    root_path given, journal only records paths under it and is added
+    alongside other journals with their own roots."""
+    if root_path is None:
+        for Journal in _ActiveJournals:
+            Journal.close()
+        _ActiveJournals[:] = []
+    NewJournal = ChangeJournal(journal_dir, root_path)
+    _ActiveJournals.append(NewJournal)
+    return NewJournal
+
+
+def get_active_journal(path=None):
+    """Returns journal recording path (first active one if no path given),
+    or None."""
+    for Journal in _ActiveJournals:
+        if path is None or Journal.covers(path):
+            return Journal
+    return None
+
+
+def record_created(path):
+    for Journal in _ActiveJournals:
+        if Journal.covers(path):
+            Journal.record("+", path)
+
+
+def record_deleted(path):
+    for Journal in _ActiveJournals:
+        if Journal.covers(path):
+            Journal.record("-", path)
+
+
+def record_moved(src_path, dest_path):
+    record_deleted(src_path)
+    record_created(dest_path)
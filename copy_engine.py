@@ -0,0 +1,392 @@
+import os
+import re
+import time
+import errno
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+
+MIN_BLOCK_SIZE = 256 * 1024  # 256 KiB
+DEFAULT_BLOCK_SIZE = 1024 * 1024  # 1 MiB
+MAX_BLOCK_SIZE = 16 * 1024 * 1024  # 16 MiB
+KERNEL_COPY_CHUNK = 64 * 1024 * 1024  # Bytes per copy_file_range/sendfile call
+BLOCK_RESIZE_AFTER = 4  # Blocks timed before block size adjusted
+MOUNTS_PATH = "/proc/self/mounts"
+TEMP_PREFIX = ".ido_part_"  # Hidden name file is written under until complete
+# Temp name is TEMP_PREFIX + writing process's pid + "_" + real name.
+TEMP_OWNER_RE = re.compile(r"^%s(\d+)_" % re.escape(TEMP_PREFIX))
+COMMIT_WORKERS = 8  # Parallel fsyncs so filesystem can merge them in one commit
+HASH_BLOCK_SIZE = 1024 * 1024  # 1 MiB
+
+# errnos meaning a kernel copy call isn't supported for this pair of files,
+# so fall back to next method (nothing has been written yet).
+KERNEL_COPY_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                           errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+
+
+# Shared file copy used for every copy in the package (offload from device,
+# ORG/CAT copies and moves, merges).
+# Data goes through the fastest path that works for the two files:
+#   1. copy_file_range() - in-kernel, and server-side on NFS/SMB mounts
+#      that support it.
+#   2. sendfile() - in-kernel, no copy through Python.
+#   3. read/write loop with block size adapted to measured throughput.
+# FUSE sources (gvfs iDevice mount) go straight to 3, since the kernel calls
+# either fail there or split into small FUSE requests. Large blocks mean fewer
+# round trips over AFC.
+# Progress reported in bytes through a callback, so a multi-GB video doesn't
+# look frozen.
+#
+# Crash safety: a file is written under a hidden temp name in the destination
+# dir and only renamed to its real name once complete, so a power cut can't
+# leave a truncated file under a real name (which would later look "already
+# present"). Temp name includes pid of process writing it. Leftover temp
+# files are removed by clean_temp_files() once that process is gone, so a copy
+# still in progress (another thread, or another instance writing into same
+# dir) is never pulled out from under it.
+# Rather than fsync each file as it's written (slow), written files and
+# changed dirs are tracked and synced together by commit() at folder
+# boundaries (offload month, ORG folder, batch of CAT decisions). Callers
+# record anything that depends on files being there (mirror entries, journal
+# marks) only after commit.
+
+_fs_types = None  # mount point: fs type, read once from /proc
+_fs_types_lock = threading.Lock()
+
+_pending_files = set()  # written files not yet fsync'd
+_pending_dirs = set()  # dirs with entries added/removed not yet fsync'd
+_pending_lock = threading.Lock()
+
+
+def get_fs_type(path):
+    """Returns type of filesystem path is on (e.g. 'ext4',
+    'fuse.gvfsd-fuse'), or None if mount table unavailable."""
+    global _fs_types
+    with _fs_types_lock:
+        if _fs_types is None:
+            _fs_types = {}
+            try:
+                with open(MOUNTS_PATH, "r") as mounts_file:
+                    for line in mounts_file:
+                        fields = line.split()
+                        if len(fields) >= 3:
+                            # Spaces in mount points escaped as \040.
+                            mount_point = fields[1].replace("\\040", " ")
+                            _fs_types[mount_point] = fields[2]
+            except OSError:
+                pass
+    real_path = os.path.realpath(path)
+    while True:
+        if real_path in _fs_types:
+            return _fs_types[real_path]
+        parent_path = os.path.dirname(real_path)
+        if parent_path == real_path:
+            return None
+        real_path = parent_path
+
+
+def is_fuse_path(path):
+    fs_type = get_fs_type(path)
+    return bool(fs_type) and fs_type.startswith("fuse")
+
+
+def copy_file(src_path, dest_path, progress_callback=None, keep_stat=True,
+                                                                hasher=None):
+    """Copies file contents (and timestamps/permissions unless keep_stat is
+    False) like shutil.copy2. progress_callback is called with number of
+    bytes as each piece lands. If hasher (hashlib object) given, it's updated
+    with the data as it's copied (forces read/write loop). Returns number of
+    bytes copied."""
+    if os.path.isdir(dest_path):
+        dest_path = os.path.join(dest_path, os.path.basename(src_path))
+    tmp_path = get_temp_path(dest_path)
+    try:
+        with open(src_path, "rb") as src_file, open(tmp_path, "wb") as dest_file:
+            bytes_copied = None
+            if not is_fuse_path(src_path) and hasher is None:
+                bytes_copied = kernel_copy(src_file, dest_file,
+                                                            progress_callback)
+            if bytes_copied is None:
+                bytes_copied = block_copy(src_file, dest_file,
+                                                    progress_callback, hasher)
+        if keep_stat:
+            shutil.copystat(src_path, tmp_path)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        # Incl. KeyboardInterrupt. Don't leave partial file behind.
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    track_write(dest_path)
+    return bytes_copied
+
+
+def kernel_copy(src_file, dest_file, progress_callback=None):
+    """Copies with copy_file_range, or sendfile if that's not supported.
+    Returns bytes copied, or None if neither works for these files (nothing
+    written in that case)."""
+    src_fd = src_file.fileno()
+    dest_fd = dest_file.fileno()
+    for copy_func in [getattr(os, "copy_file_range", None),
+                      getattr(os, "sendfile", None)]:
+        if copy_func is None:
+            continue
+        bytes_copied = 0
+        try:
+            while True:
+                if copy_func is os.sendfile:
+                    sent = os.sendfile(dest_fd, src_fd, None, KERNEL_COPY_CHUNK)
+                else:
+                    sent = copy_func(src_fd, dest_fd, KERNEL_COPY_CHUNK)
+                if sent == 0:
+                    return bytes_copied
+                bytes_copied += sent
+                if progress_callback:
+                    progress_callback(sent)
+        except OSError as error:
+            if bytes_copied or error.errno not in KERNEL_COPY_UNSUPPORTED:
+                raise
+            # Not supported here. Try next method.
+    return None
+
+
+def block_copy(src_file, dest_file, progress_callback=None, hasher=None):
+    """Read/write loop. Starts at DEFAULT_BLOCK_SIZE and doubles block size
+    while that keeps raising throughput (halves if it drops), within
+    MIN_BLOCK_SIZE and MAX_BLOCK_SIZE. Returns bytes copied."""
+    block_size = DEFAULT_BLOCK_SIZE
+    best_rate = 0
+    bytes_copied = 0
+    window_bytes = 0
+    window_blocks = 0
+    window_start = time.monotonic()
+    while True:
+        chunk = src_file.read(block_size)
+        if not chunk:
+            return bytes_copied
+        dest_file.write(chunk)
+        if hasher:
+            hasher.update(chunk)
+        bytes_copied += len(chunk)
+        if progress_callback:
+            progress_callback(len(chunk))
+
+        window_bytes += len(chunk)
+        window_blocks += 1
+        if window_blocks >= BLOCK_RESIZE_AFTER:
+            elapsed = time.monotonic() - window_start
+            rate = window_bytes / elapsed if elapsed else float("inf")
+            if rate >= best_rate:
+                best_rate = rate
+                block_size = min(block_size * 2, MAX_BLOCK_SIZE)
+            else:
+                block_size = max(block_size // 2, MIN_BLOCK_SIZE)
+            window_bytes = 0
+            window_blocks = 0
+            window_start = time.monotonic()
+
+
+def move_file(src_path, dest_path, progress_callback=None):
+    """Moves file like shutil.move. Renames when src and dest are on same
+    filesystem, otherwise copies then removes source."""
+    if os.path.isdir(dest_path):
+        dest_path = os.path.join(dest_path, os.path.basename(src_path))
+    try:
+        os.rename(src_path, dest_path)
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+    else:
+        track_rename(src_path, dest_path)
+        if progress_callback:
+            progress_callback(os.path.getsize(dest_path))
+        return dest_path
+    copy_file(src_path, dest_path, progress_callback)
+    # Only copy of the data until source removed, so this one can't wait
+    # for group commit.
+    commit([dest_path])
+    os.remove(src_path)
+    track_rename(src_path, None)
+    return dest_path
+
+
+def get_temp_path(dest_path):
+    return os.path.join(os.path.dirname(dest_path), "%s%d_%s"
+                    % (TEMP_PREFIX, os.getpid(), os.path.basename(dest_path)))
+
+
+def is_temp_name(file_name):
+    return file_name.startswith(TEMP_PREFIX)
+
+
+def is_owner_alive(file_name):
+    """Returns True if process that wrote temp file is still running (so
+    copy may be in progress). Temp names without a pid are from before pid
+    was included and always orphaned."""
+    owner_match = TEMP_OWNER_RE.match(file_name)
+    if not owner_match:
+        return False
+    owner_pid = int(owner_match.group(1))
+    if owner_pid == os.getpid():
+        return True
+    try:
+        os.kill(owner_pid, 0)
+    except (ProcessLookupError, OverflowError):
+        # Gone (or number too big to be a pid).
+        return False
+    except PermissionError:
+        # Running under another user.
+        return True
+    return True
+
+
+def clean_temp_files(dir_path, dir_contents=None):
+    """Removes temp files left in dir_path by copies interrupted by a crash
+    (writing process no longer running). dir_contents can be passed if caller
+    already listed dir. Returns dir_contents without temp names."""
+    if dir_contents is None:
+        dir_contents = os.listdir(dir_path)
+    clean_contents = []
+    for file_name in dir_contents:
+        if is_temp_name(file_name):
+            if is_owner_alive(file_name):
+                # Copy in progress in this or another process.
+                continue
+            try:
+                os.remove(os.path.join(dir_path, file_name))
+            except OSError:
+                pass
+        else:
+            clean_contents.append(file_name)
+    return clean_contents
+
+
+def track_write(file_path):
+    file_path = os.path.normpath(file_path)
+    with _pending_lock:
+        _pending_files.add(file_path)
+        _pending_dirs.add(os.path.dirname(file_path))
+
+
+def track_rename(src_path, dest_path):
+    """Records that src_path was moved to dest_path (or removed, if
+    dest_path is None), so next commit syncs right dirs and file."""
+    src_path = os.path.normpath(src_path)
+    if dest_path:
+        dest_path = os.path.normpath(dest_path)
+    with _pending_lock:
+        _pending_dirs.add(os.path.dirname(src_path))
+        if dest_path:
+            _pending_dirs.add(os.path.dirname(dest_path))
+        if src_path in _pending_files:
+            _pending_files.discard(src_path)
+            if dest_path:
+                _pending_files.add(dest_path)
+
+
+def track_dir_change(dir_path):
+    # e.g. file deleted or dir made
+    with _pending_lock:
+        _pending_dirs.add(os.path.normpath(dir_path))
+        _pending_dirs.add(os.path.dirname(os.path.normpath(dir_path)))
+
+
+def commit(paths=None):
+    """Makes writes durable. Pending files under given paths (files or dirs;
+    all pending writes if None) are fsync'd in parallel, then dirs holding
+    them, so renames into place are durable too."""
+    if paths is not None:
+        prefixes = [os.path.normpath(path) for path in paths]
+        def selected(pending_path):
+            return any(pending_path == prefix
+                    or pending_path.startswith(prefix.rstrip("/") + "/")
+                                                        for prefix in prefixes)
+    with _pending_lock:
+        if paths is None:
+            sync_files = set(_pending_files)
+            sync_dirs = set(_pending_dirs)
+        else:
+            sync_files = set(path for path in _pending_files if selected(path))
+            sync_dirs = set(os.path.dirname(path) for path in sync_files)
+            sync_dirs |= set(path for path in _pending_dirs if selected(path))
+        _pending_files.difference_update(sync_files)
+        _pending_dirs.difference_update(sync_dirs)
+    if sync_files:
+        with ThreadPoolExecutor(max_workers=COMMIT_WORKERS) as executor:
+            # list() so any error in a worker is raised here.
+            list(executor.map(fsync_path, sorted(sync_files)))
+    for dir_path in sorted(sync_dirs):
+        fsync_path(dir_path)
+
+
+def fsync_path(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        # Moved or deleted since. Its new location is tracked separately.
+        return
+    try:
+        os.fsync(fd)
+    except OSError as error:
+        # Some FUSE/network filesystems don't support fsync on dirs.
+        if error.errno not in (errno.EINVAL, errno.EBADF, errno.ENOTSUP,
+                                                            errno.EOPNOTSUPP):
+            raise
+    finally:
+        os.close(fd)
+
+
+class CopyProgress(object):
+    """Represents progress bar for a batch of copies, counting bytes (with
+    ETA from total size found in pre-scan) and files. Safe to update from
+    several threads."""
+    def __init__(self, total_bytes, total_files, desc=None, position=None,
+                                                    leave=True, colour=None):
+        self.total_files = total_files
+        self.files_done = 0
+        self.lock = threading.Lock()
+        self.progress_bar = tqdm(total=total_bytes, unit="B", unit_scale=True,
+                                unit_divisor=1024, desc=desc, position=position,
+                                                    leave=leave, colour=colour)
+        self.progress_bar.set_postfix_str(self.get_file_count())
+
+    def get_file_count(self):
+        return "%d/%d files" % (self.files_done, self.total_files)
+
+    def add_bytes(self, byte_count):
+        with self.lock:
+            self.progress_bar.update(byte_count)
+
+    def file_done(self):
+        with self.lock:
+            self.files_done += 1
+            self.progress_bar.set_postfix_str(self.get_file_count())
+
+    def close(self):
+        self.progress_bar.close()
+
+    def __repr__(self):
+        return "CopyProgress object (%s)" % self.get_file_count()
+
+
+def scan_sizes(file_paths):
+    """Returns total size of given files (pre-scan for CopyProgress).
+    Files that can't be stat'd count as 0."""
+    total_bytes = 0
+    for file_path in file_paths:
+        try:
+            total_bytes += os.path.getsize(file_path)
+        except OSError:
+            pass
+    return total_bytes
+
+
+def file_hash(file_path):
+    sha1_hash = hashlib.sha1()
+    with open(file_path, 'rb') as file_obj:
+        for chunk in iter(lambda: file_obj.read(HASH_BLOCK_SIZE), b""):
+            sha1_hash.update(chunk)
+    return sha1_hash.hexdigest()
@@ -6,6 +6,7 @@ import time
 import exiftool
 
 from idevice_media_offload.pic_categorize_tool import copy_to_target, display_photo
+from idevice_media_offload import policy
 
 
 # class ImgTypeError(Exception):
@@ -329,8 +330,8 @@ def add_datestamp(img_path, long_stamp=False):
     elif img_name[:4] != 'IMG_':
         # Detect presence of non-standard naming (could be pre-existing
         # alternate datestamp)
-        rename_choice = input("%s has non-standard naming. "
-                "Add %s datestamp anyway? [y/n]\n> " % (img_name, datestamp))
+        rename_choice = policy.get_input("%s has non-standard naming. Add %s "
+                    "datestamp anyway? [y/n]\n> " % (img_name, datestamp))
         if rename_choice and rename_choice.lower() == 'y':
             safe_rename(img_path, datestamp + '_' + img_name)
         else:
@@ -495,16 +496,22 @@ def get_img_date(img_path, skip_unknown=True):
         return return_vals[0]
 
 
-def spec_manual_date(img_path):
+def spec_manual_date(img_path, decision_class="date_fallback"):
     """Prompts user to enter a timestamp for displayed pic. Returns a
     struct_time object or "s" to skip this file or None if user accepts
-    (caller-defined) fallback option."""
-
-    list_all_img_dates(img_path, skip_unknown=False)
-    display_photo(img_path)
-    man_date_response = input("Manually specify datestamp in YYYY-MM-DD "
-                                    "format, enter nothing to accept fallback, "
-                               "or enter 's' to skip organizing this file.\n> ")
+    (caller-defined) fallback option.
+    decision_class is the policy class that answers prompt in unattended
+    runs."""
+
+    Policy = policy.get_active_policy()
+    if not (Policy and Policy.has_answer(decision_class)):
+        # No point displaying anything if policy answers.
+        list_all_img_dates(img_path, skip_unknown=False)
+        display_photo(img_path)
+    man_date_response = policy.ask(decision_class, "Manually specify datestamp "
+                                "in YYYY-MM-DD format, enter nothing to accept "
+                        "fallback, or enter 's' to skip organizing this file.\n> ",
+                                                            subject=img_path)
     if man_date_response in ["s", "S"]:
         return "s"
     elif man_date_response:
@@ -514,7 +521,7 @@ def spec_manual_date(img_path):
             return man_img_time_struct
         except ValueError:
             print("Invalid reponse. Confirm proper date format.\n")
-            return spec_manual_date(img_path)
+            return spec_manual_date(img_path, decision_class)
     else:
         # If nothing valid specified, indicate to caller fxn to use fallback
         return None
@@ -574,8 +581,12 @@ def get_comment(img_path, print_type=False):
         if len(caption_set) == 1:
             return caption_set.pop()
         if len(caption_set) > 1:
-            input("Found unique captions in multiple EXIF tags for %s. "
-                                    "Unhandled case. Press enter to continue"
+            if policy.is_unattended():
+                print("Found unique captions in multiple EXIF tags for %s. "
+                                "Unhandled case." % os.path.basename(img_path))
+            else:
+                policy.get_input("Found unique captions in multiple EXIF tags "
+                            "for %s. Unhandled case. Press enter to continue"
                                                 % os.path.basename(img_path))
             return None
         else:
@@ -609,8 +620,9 @@ def append_img_comment(input_path, extra_chars=0, comment_prompt=True,
                 "Can't add URL to filename.\n" % (img_name, str(img_comment)))
     else:
         if comment_prompt:
-            add_comment = input("Comment found in %s EXIF data: \n\t'%s'\n"
-                    "Append to filename? [Y/N]\n> " % (img_name, str(img_comment)))
+            add_comment = policy.ask("caption_append", "Comment found in %s "
+                    "EXIF data: \n\t'%s'\nAppend to filename? [Y/N]\n> "
+                            % (img_name, str(img_comment)), subject=img_path)
         if (not comment_prompt) or add_comment in ["y", "Y"]:
             # https://stackoverflow.com/questions/1976007/what-characters-are-forbidden-in-windows-and-linux-directory-names
             # Only character not allowed in UNIX filename is the forward slash.
@@ -5,7 +5,14 @@ from tqdm import tqdm
 from mediadapt import format_convert
 
 from idevice_media_offload import date_compare
-from idevice_media_offload.pic_categorize_tool import copy_to_target
+from idevice_media_offload import change_journal
+from idevice_media_offload import policy
+from idevice_media_offload.pic_categorize_tool import copy_to_target, copy_batch_to_target
+from idevice_media_offload import copy_engine
+from idevice_media_offload import meta_cache
+from idevice_media_offload import media_catalog
+from idevice_media_offload import dir_watch
+from idevice_media_offload import media_unit
 from idevice_media_offload.pic_offload_tool import RawOffloadGroup
 
 
@@ -34,6 +41,29 @@ class OrganizedGroup(object):
                         "Pics not organized. Terminating" % self.date_root_path)
         # Initialize object dictionary.
         self.yr_objs = {}
+        # Cat buffer copies queued while a folder is being organized (see
+        # org_folder()). None when not batching.
+        self.buffer_copy_jobs = None
+        # Catalog of Organized dir. Files queued as inserted and added per
+        # folder so metadata is read in bulk. None when not batching.
+        self.Catalog = media_catalog.MediaCatalog(self.bu_root_path)
+        self.MetaCache = meta_cache.MetaCache(self.bu_root_path)
+        self.catalog_queue = None
+        # Caption suffix (e.g. "_beach" or "") of media unit being inserted,
+        # taken from its primary file and reused for rest of unit. None when
+        # not inserting unit members (each file's own caption read).
+        self.unit_caption = None
+        self.last_caption = ""  # Suffix MoDir.insert_img() last applied
+        if not self.Catalog.is_backfilled():
+            print("Media catalog has no record of files organized before it "
+                  "existed. Run backfill once to add them:\n"
+                  "\tpython -m idevice_media_offload.media_catalog %s backfill"
+                                                        % self.bu_root_path)
+
+        # Live listings of year and month dirs, so searches (search_img())
+        # don't re-list every month dir and still see changes made by hand.
+        # None if inotify unavailable (dirs listed each time instead).
+        self.Watch = dir_watch.watch(self.date_root_path, depth=2)
 
         # Instantiate year objects.
         yr_list = self.get_yr_list()
@@ -46,6 +76,46 @@ class OrganizedGroup(object):
     def get_buffer_root_path(self):
         return self.buffer_root_path
 
+    def queue_buffer_copy(self, img_path, new_name, move_op=False):
+        """Copies img into cat buffer, or queues copy if a folder is being
+        organized so buffer collisions can be resolved in one batch."""
+        if self.buffer_copy_jobs is None:
+            copy_to_target(img_path, self.buffer_root_path, new_name=new_name,
+                                                            move_op=move_op)
+        else:
+            self.buffer_copy_jobs.append((img_path, self.buffer_root_path,
+                                                            new_name, move_op))
+
+    def drop_buffer_copy(self, img_name):
+        """Removes queued cat buffer copy that would be named img_name.
+        Returns True if one was queued. A queued move's source is deleted
+        since it would otherwise have been moved and deleted."""
+        for copy_job in list(self.buffer_copy_jobs or []):
+            (img_path, target_dir, new_name, move_op) = copy_job
+            if new_name == img_name:
+                self.buffer_copy_jobs.remove(copy_job)
+                if move_op and os.path.exists(img_path):
+                    os.remove(img_path)
+                    change_journal.record_deleted(img_path)
+                return True
+        return False
+
+    def flush_buffer_copies(self):
+        copy_jobs = self.buffer_copy_jobs or []
+        self.buffer_copy_jobs = None
+        copy_batch_to_target(copy_jobs)
+
+    def queue_catalog(self, img_path):
+        if self.catalog_queue is None:
+            self.Catalog.add_files([img_path], self.MetaCache)
+        else:
+            self.catalog_queue.append(img_path)
+
+    def flush_catalog(self):
+        catalog_queue = self.catalog_queue or []
+        self.catalog_queue = None
+        self.Catalog.add_files(catalog_queue, self.MetaCache)
+
     def get_yr_list(self):
         # Refresh date_root_path every time in case dir changes.
         year_list = os.listdir(self.get_root_path())
@@ -104,11 +174,39 @@ class OrganizedGroup(object):
         if img_path_found and remove:
             if debug: print("\nRemoving %s" % img_path_found)
             os.remove(img_path_found)
+            change_journal.record_deleted(img_path_found)
+            # Drop its catalog row (and any queued add for this folder).
+            self.Catalog.remove_files([img_path_found])
+            if self.catalog_queue:
+                self.catalog_queue = [img_path for img_path in self.catalog_queue
+                                                if img_path != img_path_found]
 
         return img_path_found # will default to None if none found
 
 
-    def insert_img(self, img_orig_path, man_img_date=False):
+    def insert_unit(self, Unit):
+        """Inserts all files of a media unit (see media_unit). Date (and
+        caption) read once from primary file and used for the rest, so a
+        Live Photo's video or an edited version lands next to its photo."""
+        self.last_caption = ""
+        unit_time = self.insert_img(Unit.get_primary())
+        if not unit_time:
+            # Primary skipped (or not inserted, e.g. AAE). Rest handled one
+            # by one as before.
+            for member_path in Unit.get_members():
+                self.insert_img(member_path)
+            return
+        self.unit_caption = self.last_caption
+        try:
+            for member_path in Unit.get_members():
+                self.insert_img(member_path, unit_time=unit_time)
+        finally:
+            self.unit_caption = None
+
+    def insert_img(self, img_orig_path, man_img_date=False, unit_time=None):
+        """Returns time img was inserted under, or None if not inserted.
+        unit_time is time already found for primary file of img's media
+        unit, used instead of reading img's own."""
         # Allow a manually-specified img_time to be passed and substituted.
         if man_img_date:
             img_time = man_img_date
@@ -141,6 +239,13 @@ class OrganizedGroup(object):
             print("Using file mod time %s for %s."
                     % (time.strftime(date_compare.DATE_FORMAT, img_time),
                        os.path.basename(img_orig_path)))
+        elif unit_time:
+            # Rest of a media unit. Same date as its primary file.
+            img_path = img_orig_path
+            img_time = unit_time
+            # Primary already went through any age warning.
+            bypass_age_warn = True
+            man_img_date = True
         elif os.path.basename(img_orig_path)[:5] == "IMG_E":
             # Don't need to search or prompt for date if original pic is in
             # org group. Get its datestamp.
@@ -169,7 +274,7 @@ class OrganizedGroup(object):
 
         if not img_time:
             # If user said to skip file when asked to spec time.
-            return
+            return None
 
         yr_str = str(img_time.tm_year)
         # Have to zero-pad single-digit months pulled from struct_time
@@ -201,15 +306,16 @@ class OrganizedGroup(object):
                                 "warning and copies into older dir anyway."
                                                         % (yr_str, mo_str))
 
-            man_date_output = date_compare.spec_manual_date(img_path)
+            man_date_output = date_compare.spec_manual_date(img_path,
+                                                    decision_class="age_warning")
             # will be a time_struct object if a date entered.
             if isinstance(man_date_output, time.struct_time):
                 # If user entered a date:
-                self.insert_img(img_path, man_date_output)
+                return self.insert_img(img_path, man_date_output)
                 # bypass_age_warn will be set True within function.
             elif man_date_output=="s":
                 # Skip
-                return
+                return None
             elif yr_str in self.get_yr_list():
                 # If user chose fallback but still in valid years, continue
                 # with operation anyway
@@ -220,6 +326,7 @@ class OrganizedGroup(object):
                 self.make_year(yr_str)
                 self.yr_objs[yr_str].insert_img(img_path, img_time,
                                                         bypass_age_warn=True)
+        return img_time
 
     def run_org(self):
         ROG = RawOffloadGroup(self.bu_root_path)
@@ -230,14 +337,47 @@ class OrganizedGroup(object):
             print("Organizing from raw offload folder %s/%s (%s of %s)" %
                             (LastRawOffload.get_dir_name(), APPLE_dir, str(n+1),
                                                         len(src_APPLE_folders)))
+            self.org_folder(LastRawOffload.get_APPLE_folder_path(APPLE_dir))
 
-            for img in tqdm(LastRawOffload.get_APPLE_contents(APPLE_dir)):
-                full_img_path = os.path.join(
-                                  LastRawOffload.get_APPLE_folder_path(APPLE_dir), img)
-                self.insert_img(full_img_path)
+        print("\nCategorization buffer populated.")
+
+    def run_org_pipelined(self, folder_queue):
+        """Same as run_org() but organizes each month folder of a new offload
+        as soon as NewRawOffload puts its path on folder_queue. Returns once
+        it gets None."""
+        n = 0
+        while True:
+            folder_path = folder_queue.get()
+            if folder_path is None:
+                break
+            n += 1
+            print("Organizing from raw offload folder %s (%d so far)"
+                        % (os.path.relpath(folder_path,
+                              os.path.dirname(os.path.dirname(folder_path))), n))
+            self.org_folder(folder_path)
 
         print("\nCategorization buffer populated.")
 
+    def org_folder(self, folder_path):
+        # Partial copies left by a crash aren't real contents.
+        folder_contents = copy_engine.clean_temp_files(folder_path)
+        folder_contents.sort()
+        # Batch cat buffer copies for the folder. Flushed even if interrupted
+        # so nothing already in date-organized dirs is missing from buffer.
+        self.buffer_copy_jobs = []
+        self.catalog_queue = []
+        # Files from one capture (Live Photo video, edits, sidecars) inserted
+        # together.
+        folder_units = media_unit.build_units(folder_contents, folder_path)
+        try:
+            for Unit in tqdm(folder_units):
+                self.insert_unit(Unit)
+        finally:
+            self.flush_buffer_copies()
+            # Everything written for this folder synced to disk together.
+            copy_engine.commit()
+            self.flush_catalog()
+
     def __repr__(self):
         return "OrganizedGroup object with path:\n\t%s" % self.get_root_path()
 
@@ -343,10 +483,14 @@ class YearDir(object):
                     # Remove from cat buffer (already removed from date-org dir).
                     img_buffer_path = os.path.join(
                                  self.OrgGroup.get_buffer_root_path(), img_name)
-                    if os.path.exists(img_buffer_path):
+                    if self.OrgGroup.drop_buffer_copy(img_name):
+                        # Original's buffer copy hadn't happened yet.
+                        pass
+                    elif os.path.exists(img_buffer_path):
                         # Might not exist if the newly-edited pic had its
                         # original offloaded and categorized previously.
                         os.remove(img_buffer_path)
+                        change_journal.record_deleted(img_buffer_path)
 
             # Continue to next conditional. Edited ("IMG_E") file is xfered.
             # If original version of IMG_E not found, treated as standard img.
@@ -381,7 +525,8 @@ class YearDir(object):
               "month dir exists, so timestamp may be wrong.\nFallback bypasses "
                             "warning and copies into older dir anyway." % yrmon)
 
-            man_date_output = date_compare.spec_manual_date(img_orig_path)
+            man_date_output = date_compare.spec_manual_date(img_orig_path,
+                                                    decision_class="age_warning")
             # will be a time_struct object if a date entered.
             if isinstance(man_date_output, time.struct_time):
                 # If user entered a date:
@@ -396,8 +541,8 @@ class YearDir(object):
                     self.make_yrmonth(yrmon)
                 self.mo_objs[yrmon].insert_img(img_orig_path, img_time)
 
-                ignore = input("Ignore future warnings for this month? "
-                                                                    "[Y/N]\n> ")
+                ignore = policy.ask("ignore_month_warnings", "Ignore future "
+                            "warnings for this month? [Y/N]\n> ", subject=yrmon)
                 if ignore and ignore.lower() == "y":
                     self.no_prompt_months.add(yrmon)
 
@@ -424,7 +569,10 @@ class MoDir(object):
         return self.yrmonth_path
 
     def get_img_list(self):
-        self.img_list = os.listdir(self.yrmonth_path)
+        Watch = self.YrDir.OrgGroup.Watch
+        self.img_list = Watch.get_names(self.yrmonth_path) if Watch else None
+        if self.img_list is None:
+            self.img_list = os.listdir(self.yrmonth_path)
         self.img_list.sort()
         return self.img_list
 
@@ -436,14 +584,29 @@ class MoDir(object):
         datestamp_prefix = time.strftime("%Y-%m-%d", img_time) + "_"
         # Reserve 2 extra characters to account for potential collision-resolving
         # underscore + digit applied in copy_to_target()
-        captioned_name = date_compare.append_img_comment(img_orig_path,
+        OrgGroup = self.YrDir.OrgGroup
+        (img_stem, img_ext) = os.path.splitext(os.path.basename(img_orig_path))
+        if OrgGroup.unit_caption is None:
+            captioned_name = date_compare.append_img_comment(img_orig_path,
                                             extra_chars=len(datestamp_prefix)+2,
                                             comment_prompt=comment_prompt,
                                             rename_in_place=False)
+            if comment_prompt:
+                # Not for JPG converted from a HEIC (recursive call below).
+                OrgGroup.last_caption = os.path.splitext(captioned_name)[0][
+                                                                len(img_stem):]
+        else:
+            # Rest of a media unit gets caption of its primary file.
+            captioned_name = img_stem + OrgGroup.unit_caption + img_ext
 
         stamped_name = datestamp_prefix + captioned_name
         # Copy into the dated directory
-        copy_to_target(img_orig_path, self.yrmonth_path, new_name=stamped_name)
+        org_path = copy_to_target(img_orig_path, self.yrmonth_path,
+                                                        new_name=stamped_name)
+        # Add to catalog under name actually written (suffixed if collision
+        # resolved by keeping both). Nothing added if skipped.
+        if org_path:
+            self.YrDir.OrgGroup.queue_catalog(org_path)
 
         # Also copy the img into the cat buffer for next step in prog.
         # If file is a converted version of a WEBP file, move instead of copy
@@ -453,9 +616,9 @@ class MoDir(object):
         if (img_ext.upper() != ".WEBP") and os.path.exists(webp_version):
             move_file = True
 
-        # Copy or move to cat buffer
-        copy_to_target(img_orig_path, self.YrDir.OrgGroup.get_buffer_root_path(),
-                                       new_name=stamped_name, move_op=move_file)
+        # Copy or move to cat buffer (queued until end of folder)
+        self.YrDir.OrgGroup.queue_buffer_copy(img_orig_path, stamped_name,
+                                                            move_op=move_file)
 
         # For an HEIF file, convert then copy/move converted version to both destinations.
         if img_ext.upper() == ".HEIC":
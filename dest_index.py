@@ -0,0 +1,170 @@
+import os
+import re
+import time
+import json
+import threading
+
+
+INDEX_FILE_NAME = "dest_index.json"  # Stored next to Cat_Buffer in BU root
+RECENCY_HALF_LIFE = 30 * 24 * 3600  # seconds. Use count halves in weight.
+DOMINANT_RATIO = 3  # Top match used outright if this many times next score.
+MAX_LISTED_MATCHES = 5
+TOKEN_SPLIT_RE = re.compile(r"[/_\-\s.]+")
+
+
+# Persistent index of every destination dir Categorizer has sent anything to
+# (CAT_DIRS entries and manually entered paths), so keyword lookup works
+# across sessions.
+# Paths are split into lowercase words that go into a prefix trie, so a
+# keyword matches any path with a word starting with it (e.g. "vac" matches
+# ".../2019_Vacation/"). Keyword with several words must match all of them.
+# Plain substring matching still works as before.
+# Matches ranked by how often and how recently each dir was used.
+
+class DestIndex(object):
+    """Represents destination index file. Each entry maps dir path to use
+    count and time last used."""
+    def __init__(self, index_dir):
+        self.index_path = os.path.join(index_dir, INDEX_FILE_NAME)
+        self.entries = self.load()
+        self.lock = threading.Lock()
+        self.trie = {}
+        for dir_path in self.entries:
+            self.add_to_trie(dir_path)
+
+    def get_index_path(self):
+        return self.index_path
+
+    def load(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as index_file:
+                return json.load(index_file)
+        else:
+            return {}
+
+    def save(self):
+        with open(self.index_path + ".tmp", "w") as index_file:
+            json.dump(self.entries, index_file, indent=1)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def get_paths(self):
+        return list(self.entries.keys())
+
+    def add_to_trie(self, dir_path):
+        # Every node holds set of all paths with a word passing through it,
+        # so a prefix lookup is one walk down the trie.
+        for word in path_words(dir_path):
+            node = self.trie
+            for char in word:
+                node = node.setdefault(char, {})
+                node.setdefault("", set()).add(dir_path)
+
+    def add(self, dir_path):
+        """Adds dir to index without counting a use."""
+        with self.lock:
+            if dir_path in self.entries:
+                return
+            self.entries[dir_path] = {"count": 0, "last_used": 0}
+            self.add_to_trie(dir_path)
+            self.save()
+
+    def record_use(self, dir_path):
+        with self.lock:
+            if dir_path not in self.entries:
+                self.entries[dir_path] = {"count": 0, "last_used": 0}
+                self.add_to_trie(dir_path)
+            self.entries[dir_path]["count"] += 1
+            self.entries[dir_path]["last_used"] = int(time.time())
+            self.save()
+
+    def score(self, dir_path):
+        entry = self.entries[dir_path]
+        age = max(time.time() - entry["last_used"], 0)
+        # +1 so never-used dirs still rank by recency of being added.
+        return (entry["count"] + 1) * 0.5 ** (age / RECENCY_HALF_LIFE)
+
+    def prefix_matches(self, word):
+        node = self.trie
+        for char in word:
+            node = node.get(char)
+            if node is None:
+                return set()
+        return set(node.get("", set()))
+
+    def search(self, keyword):
+        """Returns list of indexed paths matching keyword, best first.
+        Dirs that no longer exist are left out."""
+        keyword_lower = keyword.lower()
+        matches = set(dir_path for dir_path in self.entries
+                                        if keyword_lower in dir_path.lower())
+        words = path_words(keyword)
+        if words:
+            word_matches = self.prefix_matches(words[0])
+            for word in words[1:]:
+                word_matches &= self.prefix_matches(word)
+            matches |= word_matches
+        matches = [dir_path for dir_path in matches if os.path.isdir(dir_path)]
+        return sorted(matches, key=self.score, reverse=True)
+
+    def resolve(self, keyword):
+        """Returns (path, matches) where path is best match if unambiguous
+        (only one, or top one ranked far enough ahead) or None."""
+        matches = self.search(keyword)
+        if len(matches) == 1:
+            return (matches[0], matches)
+        elif len(matches) > 1:
+            if self.score(matches[0]) >= DOMINANT_RATIO * self.score(matches[1]):
+                return (matches[0], matches)
+        return (None, matches)
+
+    def complete(self, text):
+        """Returns completions for partial input text: matching paths from
+        index, then matching filesystem paths if text looks like a path."""
+        if not text:
+            return []
+        completions = []
+        if not text.startswith("/"):
+            completions += self.search(text)
+        else:
+            completions += [dir_path for dir_path in sorted(self.entries,
+                                                key=self.score, reverse=True)
+                                            if dir_path.startswith(text)]
+            parent_dir = os.path.dirname(text)
+            if os.path.isdir(parent_dir):
+                partial_name = os.path.basename(text)
+                for name in sorted(os.listdir(parent_dir)):
+                    name_path = os.path.join(parent_dir, name)
+                    if name.startswith(partial_name) and os.path.isdir(name_path):
+                        completions.append(name_path + "/")
+        # Drop duplicates, keep order.
+        return list(dict.fromkeys(completions))
+
+    def __repr__(self):
+        return "DestIndex object with path:\n\t%s" % self.index_path
+
+
+def path_words(path):
+    return [word for word in TOKEN_SPLIT_RE.split(path.lower()) if word]
+
+
+def enable_completion(Index, extra_keys=()):
+    """Sets up tab completion for input() prompts using Index (plus
+    extra_keys, e.g. CAT_DIRS keys). No-op where readline not available."""
+    try:
+        import readline
+    except ImportError:
+        return
+
+    def completer(text, state):
+        if state == 0:
+            completer.options = [key for key in extra_keys
+                                        if key.startswith(text)] + Index.complete(text)
+        if state < len(completer.options):
+            return completer.options[state]
+        return None
+    completer.options = []
+
+    readline.set_completer(completer)
+    # Whole line is one path, so only newline separates completion words.
+    readline.set_completer_delims("\n")
+    readline.parse_and_bind("tab: complete")
@@ -0,0 +1,135 @@
+import os
+import asyncio
+import hashlib
+
+from idevice_media_offload import copy_engine
+
+
+DEVICE_IO_CONCURRENCY = 8  # Max simultaneous requests sent over gvfs/AFC.
+DEVICE_MTIME_TOLERANCE = 1  # seconds. Allow for mtime rounding by gvfs.
+
+
+# Async access to iDevice DCIM folder at gvfs mount point.
+# gvfs (FUSE) has no native async file API, so every blocking call runs in a
+# worker thread. A semaphore caps how many requests are outstanding at once so
+# the AFC link isn't flooded.
+# iDeviceDCIM (pic_offload_tool) wraps these coroutines in blocking methods so
+# NewRawOffload and MirrorTree callers don't change.
+
+class AsyncDCIMReader(object):
+    """Represents async view of a DCIM dir. Paths passed to methods are
+    APPLE folder names and image names relative to DCIM_path."""
+    def __init__(self, DCIM_path, concurrency=DEVICE_IO_CONCURRENCY,
+                                                        shared_limiter=None):
+        self.DCIM_path = DCIM_path
+        self.concurrency = concurrency
+        # Optional threading semaphore shared between readers for several
+        # devices so their combined I/O is capped too.
+        self.shared_limiter = shared_limiter
+        # Semaphore gets created inside the running loop (see get_semaphore())
+        # since each run_sync() call runs its own loop.
+        self.semaphore = None
+
+    def get_root(self):
+        return self.DCIM_path
+
+    def get_semaphore(self):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.semaphore
+
+    def call_limited(self, func, *args):
+        # Runs in worker thread, so blocking on shared limiter doesn't stall
+        # event loop.
+        if self.shared_limiter is None:
+            return func(*args)
+        with self.shared_limiter:
+            return func(*args)
+
+    async def run_blocking(self, func, *args):
+        async with self.get_semaphore():
+            return await asyncio.to_thread(self.call_limited, func, *args)
+
+    async def list_folder(self, APPLE_folder):
+        contents = await self.run_blocking(os.listdir,
+                                    os.path.join(self.DCIM_path, APPLE_folder))
+        contents.sort()
+        return contents
+
+    async def list_folders(self, APPLE_folders):
+        """Returns dict mapping each APPLE folder name to its sorted contents.
+        All folders listed concurrently."""
+        contents_lists = await asyncio.gather(*[self.list_folder(APPLE_folder)
+                                            for APPLE_folder in APPLE_folders])
+        return dict(zip(APPLE_folders, contents_lists))
+
+    async def stat_folder(self, APPLE_folder):
+        folder_stat = await self.run_blocking(os.stat,
+                                    os.path.join(self.DCIM_path, APPLE_folder))
+        return int(folder_stat.st_mtime)
+
+    async def stat_folders(self, APPLE_folders):
+        """Returns dict mapping each APPLE folder name to its mtime.
+        All folders stat'd concurrently."""
+        mtimes = await asyncio.gather(*[self.stat_folder(APPLE_folder)
+                                            for APPLE_folder in APPLE_folders])
+        return dict(zip(APPLE_folders, mtimes))
+
+    async def stat_file(self, APPLE_folder, img_name):
+        img_stat = await self.run_blocking(os.stat,
+                          os.path.join(self.DCIM_path, APPLE_folder, img_name))
+        return (img_stat.st_size, int(img_stat.st_mtime))
+
+    async def stat_files(self, APPLE_folder, img_names):
+        """Returns dict mapping image name to (size, mtime) tuple.
+        All files stat'd concurrently."""
+        stats = await asyncio.gather(*[self.stat_file(APPLE_folder, img_name)
+                                                    for img_name in img_names])
+        return dict(zip(img_names, stats))
+
+    async def copy_file(self, APPLE_folder, img_name, dest_dir,
+                                        progress_callback=None, digests=None):
+        """Copies one file (contents and timestamps) into dest_dir with
+        copy_engine, which picks block size for gvfs. Holds one semaphore slot
+        for the whole file. progress_callback gets byte counts. If digests
+        dict given, SHA-1 of data copied is stored in it under img_name."""
+        dest_path = os.path.join(dest_dir, img_name)
+        hasher = hashlib.sha1() if digests is not None else None
+        async with self.get_semaphore():
+            await asyncio.to_thread(self.call_limited, copy_engine.copy_file,
+                        os.path.join(self.DCIM_path, APPLE_folder, img_name),
+                                dest_path, progress_callback, True, hasher)
+        if hasher:
+            digests[img_name] = hasher.hexdigest()
+        return dest_path
+
+    async def copy_files(self, APPLE_folder, img_names, dest_dir,
+                        done_callback=None, progress_callback=None, digests=None):
+        """Copies files concurrently. Returns dict mapping each image name
+        to None if copied or the OSError raised if not. done_callback is called
+        with (img_name, error) as each copy finishes. progress_callback gets
+        byte counts as data lands. digests as in copy_file()."""
+        async def copy_one(img_name):
+            try:
+                await self.copy_file(APPLE_folder, img_name, dest_dir,
+                                                    progress_callback, digests)
+            except OSError as error:
+                result = error
+            else:
+                result = None
+            if done_callback:
+                done_callback(img_name, result)
+            return result
+
+        results = await asyncio.gather(*[copy_one(img_name)
+                                                    for img_name in img_names])
+        return dict(zip(img_names, results))
+
+    def run_sync(self, coroutine):
+        """Blocking facade for the coroutines above. Each call runs in a fresh
+        event loop, so semaphore has to be re-created for it."""
+        self.semaphore = None
+        return asyncio.run(coroutine)
+
+    def __repr__(self):
+        return "AsyncDCIMReader object with path:\n\t%s" % self.DCIM_path
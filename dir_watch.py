@@ -0,0 +1,210 @@
+import os
+import struct
+import ctypes
+import ctypes.util
+import threading
+
+from idevice_media_offload import dir_names
+from idevice_media_offload import copy_engine
+
+
+class WatchError(Exception):
+    pass
+
+
+# inotify constants (linux/inotify.h)
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+                            | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, name length
+READ_SIZE = 64 * 1024
+
+
+# Live listings of a dir tree kept current with inotify, so code holding a
+# view of Cat_Buffer or Organized/ doesn't go stale when files are renamed,
+# deleted, or added outside the program (or need to re-list to find out).
+# No background thread. Events queued by the kernel are read whenever a
+# listing is asked for, so changes made by this program itself (which are
+# queued before the call that made them returns) are always reflected.
+# If kernel queue overflows, the whole tree is re-listed.
+# Linux only. watch() returns None where inotify isn't available, and callers
+# fall back to listing dirs themselves.
+
+class DirWatcher(object):
+    """Represents inotify watch on a dir and its subdirs down to depth
+    (0 for dir itself only). Keeps set of names in each watched dir, plus
+    renames seen (old path: new path)."""
+    def __init__(self, root_path, depth=0):
+        self.root_path = os.path.normpath(root_path)
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                                                                use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatchError("inotify_init1 failed: %s"
+                                        % os.strerror(ctypes.get_errno()))
+        self.wd_paths = {}  # watch descriptor: dir path
+        self.listings = {}  # dir path: set of names
+        self.renames = {}  # old path: new path
+        self.pending_moves = {}  # cookie: old path, until matching MOVED_TO
+        self.add_tree(self.root_path, 0)
+
+    def get_root_path(self):
+        return self.root_path
+
+    def add_tree(self, dir_path, level):
+        # Watch added before listing so nothing created in between is missed.
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path),
+                                                                WATCH_MASK)
+        if wd < 0:
+            if dir_path == self.root_path:
+                raise WatchError("Can't watch %s: %s" % (dir_path,
+                                            os.strerror(ctypes.get_errno())))
+            return
+        self.wd_paths[wd] = dir_path
+        try:
+            names = [name for name in os.listdir(dir_path)
+                                        if not copy_engine.is_temp_name(name)]
+        except FileNotFoundError:
+            return
+        self.listings[dir_path] = set(names)
+        if level < self.depth:
+            for name in names:
+                sub_path = os.path.join(dir_path, name)
+                if os.path.isdir(sub_path):
+                    self.add_tree(sub_path, level + 1)
+
+    def get_level(self, dir_path):
+        rel_path = os.path.relpath(dir_path, self.root_path)
+        return 0 if rel_path == "." else rel_path.count(os.sep) + 1
+
+    def rescan(self):
+        for wd in list(self.wd_paths):
+            self.libc.inotify_rm_watch(self.fd, wd)
+        self.wd_paths = {}
+        self.listings = {}
+        self.pending_moves = {}
+        self.add_tree(self.root_path, 0)
+
+    def drain(self):
+        """Reads and applies all queued events."""
+        with self.lock:
+            while True:
+                try:
+                    data = os.read(self.fd, READ_SIZE)
+                except BlockingIOError:
+                    break
+                self.apply_events(data)
+            # A MOVED_FROM with no MOVED_TO in same batch went out of tree.
+            self.pending_moves = {}
+
+    def apply_events(self, data):
+        offset = 0
+        need_rescan = False
+        while offset < len(data):
+            (wd, mask, cookie, name_len) = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset+name_len].rstrip(b"\0"))
+            offset += name_len
+
+            if mask & IN_Q_OVERFLOW:
+                need_rescan = True
+                continue
+            dir_path = self.wd_paths.get(wd)
+            if dir_path is None:
+                continue
+            if mask & IN_IGNORED:
+                # Watch removed (dir deleted or unmounted).
+                self.wd_paths.pop(wd, None)
+                self.listings.pop(dir_path, None)
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if dir_path == self.root_path:
+                    need_rescan = True
+                continue
+            if mask & IN_ISDIR and mask & (IN_MOVED_FROM | IN_MOVED_TO):
+                # Paths of watches under a moved dir change. Rare enough to
+                # just re-list.
+                need_rescan = True
+                continue
+            if copy_engine.is_temp_name(name):
+                # Partial copy. Final name shows up when renamed into place.
+                continue
+
+            names = self.listings.setdefault(dir_path, set())
+            file_path = os.path.join(dir_path, name)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                names.add(name)
+                old_path = self.pending_moves.pop(cookie, None)
+                if mask & IN_MOVED_TO and old_path:
+                    self.renames[old_path] = file_path
+                    # Name reused by another file. Old rename no longer applies.
+                    self.renames.pop(file_path, None)
+                if (mask & IN_ISDIR
+                        and self.get_level(dir_path) < self.depth):
+                    self.add_tree(file_path, self.get_level(dir_path) + 1)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                names.discard(name)
+                if mask & IN_MOVED_FROM:
+                    self.pending_moves[cookie] = file_path
+        if need_rescan:
+            self.rescan()
+
+    def get_names(self, dir_path=None):
+        """Returns sorted names in watched dir (root if none given), or None
+        if dir isn't watched."""
+        self.drain()
+        with self.lock:
+            names = self.listings.get(os.path.normpath(dir_path
+                                                        or self.root_path))
+            return sorted(names) if names is not None else None
+
+    def get_dirs(self):
+        """Returns sorted paths of all watched dirs."""
+        self.drain()
+        with self.lock:
+            return sorted(self.listings)
+
+    def follow_rename(self, file_path):
+        """Returns path file is now at if renamed (in a watched dir) since
+        watch started, otherwise file_path unchanged."""
+        self.drain()
+        with self.lock:
+            seen = set()
+            new_path = os.path.normpath(file_path)
+            while new_path in self.renames and new_path not in seen:
+                seen.add(new_path)
+                new_path = self.renames[new_path]
+            return new_path if seen else file_path
+
+    def close(self):
+        with self.lock:
+            if self.fd >= 0:
+                os.close(self.fd)
+                self.fd = -1
+
+    def __repr__(self):
+        return "DirWatcher object with path:\n\t%s" % self.root_path
+
+
+def watch(dir_path, depth=0):
+    """Returns DirWatcher on dir_path, or None if inotify isn't available
+    (not Linux, out of watches) or watching is turned off in dir_names."""
+    if not getattr(dir_names, "WATCH_DIRS", True):
+        return None
+    try:
+        return DirWatcher(dir_path, depth)
+    except (OSError, AttributeError, WatchError):
+        return None
@@ -0,0 +1,119 @@
+import re
+import calendar
+
+from idevice_media_offload import meta_cache
+
+
+BURST_GAP = 2.0  # seconds. Shots closer than this are one burst.
+EVENT_GAP = 3 * 3600  # seconds. Shots closer than this are one event.
+
+# Capture time tags in order of preference. Composite:SubSecDateTimeOriginal
+# has fractional seconds and time zone if camera recorded them.
+# QuickTime:CreationDate (iPhone videos) has time zone. QuickTime:CreateDate
+# left out since it's UTC and would be hours off from photos without a zone.
+TIME_TAGS = ["Composite:SubSecDateTimeOriginal", "EXIF:DateTimeOriginal",
+             "QuickTime:CreationDate", "EXIF:CreateDate"]
+TIME_RE = re.compile(r"(\d{4})[:-](\d{2})[:-](\d{2})[ T](\d{2}):(\d{2}):(\d{2})"
+                                    r"(\.\d+)?\s*(Z|[+-]\d{2}:?\d{2})?")
+ZONE_RE = re.compile(r"^(Z|[+-]\d{2}:?\d{2})$")
+# Tags whose zone, if not in the time itself, is in EXIF:OffsetTimeOriginal.
+OFFSET_TAGS = ["Composite:SubSecDateTimeOriginal", "EXIF:DateTimeOriginal"]
+
+
+# Groups Cat_Buffer items by how close together in time they were taken.
+# Sorted by capture time, then split wherever gap between neighbors is
+# over a threshold: bursts (seconds apart, e.g. burst mode or several tries
+# at one shot) and events (no gap of a few hours, e.g. a day at the beach).
+# Times come from MetaCache in one batched pass. Items with no capture time
+# aren't grouped.
+# One convention for all items: UTC if every item has a time zone, otherwise
+# local time for all, zones ignored. Mixing the two would put items without
+# a zone hours away from ones with it.
+
+def get_capture_time(img_path, img_meta):
+    """Returns (local time, UTC offset) of capture: local time as seconds
+    since epoch (float) treated as UTC (only differences between times
+    matter), offset in seconds or None if no zone recorded. Returns None if
+    no time in metadata."""
+    for tag in TIME_TAGS:
+        time_match = TIME_RE.search(str(img_meta.get(tag, "")))
+        if time_match:
+            break
+    else:
+        return None
+    (year, month, day, hour, minute, second, subsec,
+                                            zone) = time_match.groups()
+    try:
+        capture_time = calendar.timegm((int(year), int(month), int(day),
+                                        int(hour), int(minute), int(second)))
+    except ValueError:
+        return None
+    if subsec:
+        capture_time += float(subsec)
+    elif tag == "EXIF:DateTimeOriginal" and img_meta.get("EXIF:SubSecTimeOriginal"):
+        capture_time += float("0." + str(img_meta["EXIF:SubSecTimeOriginal"]))
+    if not zone and tag in OFFSET_TAGS:
+        zone_match = ZONE_RE.search(str(img_meta.get("EXIF:OffsetTimeOriginal",
+                                                                "")).strip())
+        zone = zone_match.group(1) if zone_match else None
+    if not zone:
+        return (capture_time, None)
+    elif zone == "Z":
+        return (capture_time, 0)
+    zone_mins = int(zone[1:3]) * 60 + int(zone[-2:])
+    return (capture_time, (1 if zone[0] == "+" else -1) * zone_mins * 60)
+
+
+def split_by_gap(timed_items, max_gap):
+    """Splits list of (time, item) sorted by time wherever gap exceeds
+    max_gap. Returns list of lists of (time, item)."""
+    groups = []
+    for timed_item in timed_items:
+        if groups and timed_item[0] - groups[-1][-1][0] <= max_gap:
+            groups[-1].append(timed_item)
+        else:
+            groups.append([timed_item])
+    return groups
+
+
+def group_by_time(img_paths, Cache, burst_gap=BURST_GAP, event_gap=EVENT_GAP):
+    """Returns list of events in time order. Each event is list of bursts,
+    and each burst a list of img paths in time order. Metadata read through
+    Cache (MetaCache) in bulk."""
+    img_paths = sorted(set(img_paths))
+    all_meta = Cache.get_many(img_paths)
+    capture_times = {}  # img path: (local time, UTC offset)
+    for img_path in img_paths:
+        capture_time = get_capture_time(img_path, all_meta.get(img_path, {}))
+        if capture_time is not None:
+            capture_times[img_path] = capture_time
+    use_zones = all(offset is not None
+                            for (local_time, offset) in capture_times.values())
+    timed_items = sorted(((local_time - offset if use_zones else local_time),
+                                img_path) for (img_path, (local_time, offset))
+                                                    in capture_times.items())
+
+    events = []
+    for timed_event in split_by_gap(timed_items, event_gap):
+        events.append([[img_path for (capture_time, img_path) in timed_burst]
+                            for timed_burst in split_by_gap(timed_event, burst_gap)])
+    return events
+
+
+def describe_event(event_paths, Cache):
+    """Returns text like '2019-07-05 09:12 to 2019-07-05 17:40' for an
+    event's time span (from cached metadata)."""
+    date_strs = []
+    for img_path in (event_paths[0], event_paths[-1]):
+        img_meta = Cache.get(img_path, fetch=False) or {}
+        time_match = None
+        for tag in TIME_TAGS:
+            time_match = TIME_RE.search(str(img_meta.get(tag, "")))
+            if time_match:
+                break
+        if time_match:
+            date_strs.append("%s-%s-%s %s:%s" % time_match.groups()[:5])
+        else:
+            date_parts = meta_cache.get_date_parts(img_path, img_meta)
+            date_strs.append("%s-%s-%s" % date_parts[:3] if date_parts else "?")
+    return "%s to %s" % tuple(date_strs)
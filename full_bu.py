@@ -1,10 +1,18 @@
 import subprocess
 import os
 import time
+import queue
+import threading
+import argparse
 
 import idevice_media_offload.pic_offload_tool as offload_tool
 import idevice_media_offload.date_organize_tool as org_tool
 import idevice_media_offload.pic_categorize_tool as cat_tool
+import idevice_media_offload.nas_sync_tool as sync_tool
+import idevice_media_offload.offload_verify as verify_tool
+import idevice_media_offload.change_journal as change_journal
+import idevice_media_offload.policy as policy
+import idevice_media_offload.dir_names as dir_names
 
 from idevice_media_offload.dir_names import IPHONE_BU_ROOT_J, IPHONE_BU_ROOT_M, IPAD_BU_ROOT_7, IPAD_BU_ROOT_10, ST_VID_ROOT
 from idevice_media_offload.dir_names import NAS_BU_ROOT, NAS_ST_DIR
@@ -19,6 +27,18 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 LOCAL_BU_ROOT=None
 LOCAL_BUFFER_ROOT=None
 
+# Set False to fall back on launching the rsync scripts in a new terminal.
+USE_INTERNAL_SYNC = True
+# (NASSync object, thread, journal mark) for syncs still running in background.
+PENDING_SYNCS = []
+
+# Device-selection answers and the BU roots they map to.
+BU_ROOT_CHOICES = {"oj": IPHONE_BU_ROOT_J, "om": IPHONE_BU_ROOT_M,
+                   "a7": IPAD_BU_ROOT_7, "a10": IPAD_BU_ROOT_10}
+# Max simultaneous device reads across all devices in multi-device mode.
+MULTI_DEVICE_IO_LIMIT = 8
+PHASE_NAMES = ["offload", "verify", "org", "cat"]
+
 
 def run_offload():
     print('\n\t', '*' * 10, 'OFFLOAD program', '*' * 10)
@@ -35,20 +55,31 @@ def run_offload():
         else:
             pass
 
-    if "ipad" in LOCAL_BU_ROOT.lower():
-        bu_root_for_sync = os.path.dirname(LOCAL_BU_ROOT[:-1]) # must strip trailing slash
-    else:
-        bu_root_for_sync = LOCAL_BU_ROOT
+    bu_root_for_sync = get_bu_root_for_sync(LOCAL_BU_ROOT)
 
     offload_dir = os.path.join(bu_root_for_sync, "Raw_Offload/")
-    call_rs_script("NAS_BU_sync.sh", offload_dir, NAS_BU_ROOT, NAS_BU_ROOT_SSH)
+    sync_to_nas("NAS_BU_sync.sh", offload_dir, NAS_BU_ROOT, NAS_BU_ROOT_SSH)
 
     print('\t', '*' * 10, 'OFFLOAD program complete', '*' * 10, "\n")
+    if policy.is_unattended():
+        return
     input("You should proceed to run the ORGANIZE program, even if not "
             "intending to run the CAT program right now.\nThe only reason "
             "not to run ORG after OFFLOAD is if you never intend to CAT this "
             "offload.\n")
 
+def run_verify(full=False):
+    print('\n\t', '*' * 10, 'VERIFY program', '*' * 10)
+    # Check latest offload against device it came from.
+    rog = offload_tool.RawOffloadGroup(LOCAL_BU_ROOT)
+    LatestOffload = rog.get_latest_offload_obj()
+    if not LatestOffload:
+        print("No offload found to verify.")
+        return
+    verify_tool.verify_offload(LatestOffload, offload_tool.iDeviceDCIM(),
+                                                                    full=full)
+    print('\t', '*' * 10, 'VERIFY program complete', '*' * 10, '\n')
+
 def run_org():
     print('\n\t', '*' * 10, 'ORGANIZE program', '*' * 10)
     # Instantiate an OrganizedGroup instance then call its run_org() method.
@@ -63,14 +94,11 @@ def run_org():
         else:
             pass
 
-    if "ipad" in LOCAL_BU_ROOT.lower():
-        bu_root_for_sync = os.path.dirname(LOCAL_BU_ROOT[:-1]) # must strip trailing slash
-    else:
-        bu_root_for_sync = LOCAL_BU_ROOT
+    bu_root_for_sync = get_bu_root_for_sync(LOCAL_BU_ROOT)
 
     # run rsync script to copy new data to NAS
     org_dir = os.path.join(bu_root_for_sync, "Organized/")
-    call_rs_script("NAS_BU_sync.sh", org_dir, NAS_BU_ROOT, NAS_BU_ROOT_SSH)
+    sync_to_nas("NAS_BU_sync.sh", org_dir, NAS_BU_ROOT, NAS_BU_ROOT_SSH)
 
     print('\t', '*' * 10, 'ORGANIZE program complete', '*' * 10, '\n')
 
@@ -82,7 +110,11 @@ def run_cat():
     # Then automatically categorize all.
     try:
         Cat.run_auto_cat()
-        Cat.photo_transfer()
+        if policy.is_unattended():
+            # Categorizing by hand needs someone there.
+            policy.get_active_policy().defer("manual_cat", LOCAL_BUFFER_ROOT)
+        else:
+            Cat.photo_transfer()
     except KeyboardInterrupt:
         response = input("\nReceived kbd interrupt. Run rsync job? "
                     "Press Enter to continue then quit or 'q' to quit now.\n> ")
@@ -92,7 +124,7 @@ def run_cat():
             pass
 
     # run rsync script to copy new data to NAS
-    call_rs_script("NAS_ST_sync.sh", ST_VID_ROOT, NAS_ST_DIR, NAS_ST_DIR_SSH)
+    sync_to_nas("NAS_ST_sync.sh", ST_VID_ROOT, NAS_ST_DIR, NAS_ST_DIR_SSH)
 
     print('\t', '*' * 10, 'CATEGORIZE program complete', '*' * 10, "\n")
 
@@ -101,32 +133,298 @@ def run_all():
     run_org()
     run_cat()
 
+def run_pipelined():
+    """Runs OFFLOAD and ORGANIZE concurrently. ORG organizes each month
+    folder as soon as OFFLOAD finishes it instead of waiting for whole
+    offload. Then runs CAT as usual."""
+    print('\n\t', '*' * 10, 'OFFLOAD + ORGANIZE programs (pipelined)', '*' * 10)
+    rog = offload_tool.RawOffloadGroup(LOCAL_BU_ROOT)
+    orgg = org_tool.OrganizedGroup(LOCAL_BU_ROOT, LOCAL_BUFFER_ROOT)
+
+    folder_queue = queue.Queue()
+    org_errors = []
+    def org_worker():
+        try:
+            orgg.run_org_pipelined(folder_queue)
+        except Exception as error:
+            org_errors.append(error)
+    # Daemon so a second interrupt can quit while ORG is waiting at a prompt.
+    # Prompts from both threads go through policy.get_input() (one at a
+    # time).
+    org_thread = threading.Thread(target=org_worker, name="ORG", daemon=True)
+    org_thread.start()
 
-def call_rs_script(script, src_dir, dest_dir, dest_dir_ssh):
+    try:
+        rog.create_new_offload(folder_queue=folder_queue)
+    except KeyboardInterrupt:
+        # Offload stopped before it could tell ORG it was done.
+        folder_queue.put(None)
+        print("\nReceived kbd interrupt. Waiting for ORG to finish folders "
+                            "already offloaded. Interrupt again to quit now.")
+    try:
+        # Timed joins so KeyboardInterrupt gets through.
+        while org_thread.is_alive():
+            org_thread.join(0.5)
+    except KeyboardInterrupt:
+        print("\nQuit without waiting for ORG. Run ORGANIZE again to "
+                                        "finish folders it didn't get to.")
+        quit()
+    if org_errors:
+        raise org_errors[0]
+    # Deferred from create_new_offload() since ORG was still reading.
+    rog.merge_todays_offloads()
+
+    bu_root_for_sync = get_bu_root_for_sync(LOCAL_BU_ROOT)
+    for job_dir in ["Raw_Offload/", "Organized/"]:
+        sync_to_nas("NAS_BU_sync.sh", os.path.join(bu_root_for_sync, job_dir),
+                                                    NAS_BU_ROOT, NAS_BU_ROOT_SSH)
+
+    print('\t', '*' * 10, 'OFFLOAD + ORGANIZE programs complete', '*' * 10, '\n')
+    run_cat()
 
-    while True:
-        if not os.path.isdir(dest_dir):
-            # NAS not reachable
-            input("\nCan't reach NAS share to run %s. Check network connection "
-                                        "and ensure NAS share is mounted.\n"
-                                        "Press Enter to try again." % script)
+
+def run_multi_offload():
+    """Offloads every connected iDevice concurrently, each into the BU root
+    mapped to its serial number (DEVICE_BU_ROOTS in dir_names, which maps
+    serial to one of the BU_ROOT_CHOICES keys). Prompts for any device not
+    mapped. ORG and CAT still have to be run per device afterward."""
+    print('\n\t', '*' * 10, 'OFFLOAD program (all devices)', '*' * 10)
+    serial_map = getattr(dir_names, "DEVICE_BU_ROOTS", {})
+    devices = offload_tool.discover_iDevices()
+    if not devices:
+        print("No iDevices found in %s." % dir_names.IDEVICE_MOUNT_POINT)
+        return
+
+    device_roots = {}
+    for serial, handle in sorted(devices.items()):
+        root_choice = serial_map.get(serial)
+        while root_choice not in BU_ROOT_CHOICES and root_choice != "skip":
+            root_choice = policy.ask("unmapped_device", "Which device is S/N "
+                                "%s? %s or 'skip'\n> " % (serial,
+                        sorted(BU_ROOT_CHOICES.keys())), subject=serial).lower()
+        if root_choice == "skip":
+            print("Skipping S/N %s." % serial)
             continue
+        if BU_ROOT_CHOICES[root_choice] in device_roots.values():
+            print("Two devices map to %s. Skipping S/N %s." % (root_choice,
+                                                                        serial))
+            continue
+        device_roots[handle] = BU_ROOT_CHOICES[root_choice]
+
+    # Set up everything that might prompt before starting any threads.
+    io_limiter = threading.BoundedSemaphore(MULTI_DEVICE_IO_LIMIT)
+    jobs = []
+    for handle, bu_root in device_roots.items():
+        print("\n%s -> %s" % (handle, bu_root))
+        # Each BU root's own journal, same one single-device runs use.
+        change_journal.start_journal(os.path.join(bu_root,
+                            change_journal.JOURNAL_DIR_NAME), root_path=bu_root)
+        rog = offload_tool.RawOffloadGroup(bu_root)
+        Device = offload_tool.iDeviceDCIM(handle=handle, io_limiter=io_limiter)
+        jobs.append({"rog": rog, "device": Device, "offload": None,
+                                                                "error": None})
+
+    def offload_worker(job):
+        try:
+            job["offload"] = offload_tool.NewRawOffload(job["rog"],
+                            iDevice_DCIM=job["device"], caption_prompt=False)
+        except Exception as error:
+            job["error"] = error
+
+    offload_threads = [threading.Thread(target=offload_worker, args=(job,),
+                                                    name=str(job["device"]))
+                       for job in jobs]
+    for offload_thread in offload_threads:
+        offload_thread.start()
+    for offload_thread in offload_threads:
+        offload_thread.join()
+
+    # Prompts deferred until all offloads done.
+    for job in jobs:
+        if job["error"]:
+            print("\nOffload from %s failed: %r" % (job["device"], job["error"]))
+            continue
+        print("\nFinishing offload into %s" % job["rog"].get_RO_root())
+        job["offload"].prompt_caption_transfer()
+        job["rog"].merge_todays_offloads()
+        offload_dir = os.path.join(get_bu_root_for_sync(job["rog"].get_BU_root()),
+                                                                "Raw_Offload/")
+        sync_to_nas("NAS_BU_sync.sh", offload_dir, NAS_BU_ROOT, NAS_BU_ROOT_SSH)
+
+    print('\t', '*' * 10, 'OFFLOAD program (all devices) complete', '*' * 10,
+                                                                        "\n")
+    print("Run ORGANIZE and CATEGORIZE for each device separately.")
+
+
+def run_phases(phases, pipelined=False, full_verify=False):
+    """Runs given phases (subset of PHASE_NAMES) in order without the menu.
+    If pipelined, OFFLOAD and ORG run as in run_pipelined()."""
+    if pipelined and "offload" in phases and "org" in phases:
+        run_pipelined()
+        return
+    if "offload" in phases:
+        run_offload()
+    if "verify" in phases:
+        run_verify(full=full_verify)
+    if "org" in phases:
+        run_org()
+    if "cat" in phases:
+        run_cat()
+
+
+def print_policy_summary():
+    Policy = policy.get_active_policy()
+    if Policy:
+        Policy.print_summary()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Back up iDevice media. "
+                "Run with no arguments for interactive menus. Pass --device, "
+                "--phases, and --policy for an unattended run.")
+    parser.add_argument("--device", choices=sorted(BU_ROOT_CHOICES) + ["all"],
+                help="Device to back up ('all' offloads every connected "
+                                                    "device into its BU root)")
+    parser.add_argument("--phases", type=parse_phases,
+                help="Comma-separated phases to run in order, from %s"
+                                                        % ",".join(PHASE_NAMES))
+    parser.add_argument("--pipelined", action="store_true",
+                help="Run OFFLOAD and ORG pipelined if both in --phases")
+    parser.add_argument("--policy",
+                help="JSON policy file answering prompts (see policy.py)")
+    parser.add_argument("--full-verify", action="store_true",
+                help="In verify phase, re-read every device file rather than "
+                                    "reusing digests recorded during offload")
+    return parser.parse_args()
+
+
+def parse_phases(phases_str):
+    phases = [phase.strip().lower() for phase in phases_str.split(",")
+                                                                if phase.strip()]
+    for phase in phases:
+        if phase not in PHASE_NAMES:
+            raise argparse.ArgumentTypeError("Unknown phase '%s'. Expected "
+                            "comma-separated list from %s" % (phase, PHASE_NAMES))
+    return phases
+
+
+def get_bu_root_for_sync(bu_root):
+    # iPad BU roots are subdirs of one shared root that gets synced instead.
+    if "ipad" in bu_root.lower():
+        return os.path.dirname(os.path.normpath(bu_root)) # must strip trailing slash
+    else:
+        return bu_root
+
+
+def wait_for_nas(dest_dir, script):
+    while not os.path.isdir(dest_dir):
+        # NAS not reachable
+        policy.ask("nas_retry", "\nCan't reach NAS share to run %s. Check "
+                            "network connection and ensure NAS share is "
+                "mounted.\nPress Enter to try again." % script, subject=dest_dir)
+
+
+def sync_to_nas(script, src_dir, dest_dir, dest_dir_ssh):
+    """Copies new data to NAS in background thread using in-process sync
+    engine. Destination layout matches what the given rsync script produces.
+    Falls back on call_rs_script() if USE_INTERNAL_SYNC is False."""
+    if not USE_INTERNAL_SYNC:
+        call_rs_script(script, src_dir, dest_dir, dest_dir_ssh)
+        return
+
+    wait_for_nas(dest_dir, script)
+    src_parent = os.path.dirname(os.path.normpath(src_dir))
+    if script == "NAS_BU_sync.sh":
+        # NAS BU root/<iPhone_Pictures or iPad_Pictures>/<Raw_Offload or Organized>
+        sync_dest = os.path.join(dest_dir, os.path.basename(src_parent),
+                                    os.path.basename(os.path.normpath(src_dir)))
+    else:
+        sync_dest = dest_dir
+    os.makedirs(sync_dest, exist_ok=True)
+
+    # Limit sync to paths touched this run (and any earlier unsynced runs).
+    # Full tree walk only if no change journal active.
+    Journal = change_journal.get_active_journal(src_dir)
+    if Journal:
+        (rel_paths, journal_mark) = Journal.pending_changes(src_dir)
+        if not rel_paths:
+            print("\nNo changes in %s to sync to NAS.\n" % src_dir)
+            return
+    else:
+        (rel_paths, journal_mark) = (None, None)
+
+    Sync = sync_tool.NASSync(src_dir, sync_dest, state_root=src_parent)
+    print("\nRunning NAS sync of %s in background.\n" % Sync.job_name)
+    PENDING_SYNCS.append((Sync, Sync.run_in_background(rel_paths),
+                                                                journal_mark))
+
+
+def wait_for_syncs():
+    """Blocks until all background NAS syncs finish and prints summaries."""
+    if PENDING_SYNCS:
+        print("\nWaiting for NAS sync(s) to finish.")
+    for Sync, sync_thread, journal_mark in PENDING_SYNCS:
+        sync_thread.join()
+        if Sync.result:
+            sync_tool.print_sync_result(Sync.result)
+            if journal_mark and not Sync.result["files_failed"]:
+                Journal = change_journal.get_active_journal(Sync.get_src_root())
+                Journal.mark_synced(Sync.get_src_root(), journal_mark)
         else:
-            print("\nRunning NAS rsync in new terminal.\n")
-            time.sleep(2) # Pause for two seconds so user sees above message.
-            break
+            print("\n%s sync did not complete. Check for errors above."
+                                                                % Sync.job_name)
+    PENDING_SYNCS.clear()
+
+
+def call_rs_script(script, src_dir, dest_dir, dest_dir_ssh):
 
-    shell_command = ("gnome-terminal --tab -- /bin/bash -c \"%s/%s %s %s %d; "
-        "/bin/bash\"" % (SCRIPT_DIR, script, src_dir, dest_dir_ssh, SSH_PORT))
+    wait_for_nas(dest_dir, script)
+
+    # Pass rsync only the paths touched since last sync (via --files-from) so
+    # it doesn't have to walk the whole tree on both ends.
+    files_from_arg = ""
+    mark_cmd = ""
+    Journal = change_journal.get_active_journal(src_dir)
+    if Journal:
+        (rel_paths, journal_mark) = Journal.pending_changes(src_dir)
+        if not rel_paths:
+            print("\nNo changes in %s to sync to NAS.\n" % src_dir)
+            return
+        job_name = os.path.basename(os.path.normpath(src_dir)).replace(" ", "_")
+        files_from_arg = " '%s'" % Journal.write_files_from(rel_paths, job_name)
+        # Changes only count as synced once script exits successfully, which
+        # the terminal signals by renaming the mark file. Picked up next time
+        # changes are read (this run or a later one).
+        (pending_path, done_path) = Journal.write_sync_mark(src_dir,
+                                                    journal_mark, job_name)
+        mark_cmd = " && mv '%s' '%s'" % (pending_path, done_path)
+
+    print("\nRunning NAS rsync in new terminal.\n")
+    time.sleep(2) # Pause for two seconds so user sees above message.
+
+    shell_command = ("gnome-terminal --tab -- /bin/bash -c \"%s/%s %s %s %d%s%s; "
+        "/bin/bash\"" % (SCRIPT_DIR, script, src_dir, dest_dir_ssh, SSH_PORT,
+                                                    files_from_arg, mark_cmd))
 
     subprocess.run([shell_command],
                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
 
 if __name__ == "__main__":
     # Don't run if module being imported. Only if script being run directly.
+    args = parse_args()
+    if args.policy:
+        try:
+            policy.load_policy(args.policy)
+        except policy.PolicyFileError as error:
+            print(error)
+            quit()
+
+    device_type = args.device
     while True:
-        device_type = input("Backing up iPhone or iPad? ['oj' for J iPhone, '"
-                                        "om' for M iPhone, 'a' for iPad]\n> ")
+        if not device_type:
+            device_type = input("Backing up iPhone or iPad? ['oj' for J iPhone, '"
+                                        "om' for M iPhone, 'a' for iPad, "
+                            "'all' to offload every connected device]\n> ")
         if device_type.lower() in ['oj', 'o']:
             LOCAL_BU_ROOT = IPHONE_BU_ROOT_J
             break
@@ -144,27 +442,54 @@ if __name__ == "__main__":
             else:
                 print("Input not recognized. Expected '7' or '10'. "
                                                         "Got %s\n" % device_ver)
+                device_type = None
                 continue # Try again.
+        elif device_type.lower() in BU_ROOT_CHOICES:
+            # e.g. 'a7' from --device
+            LOCAL_BU_ROOT = BU_ROOT_CHOICES[device_type.lower()]
+            break
+        elif device_type.lower() == 'all':
+            run_multi_offload()
+            wait_for_syncs()
+            print_policy_summary()
+            quit()
         elif device_type.lower() == 'q':
             quit()
         else:
             print("Input not recognized.")
+            device_type = None
 
     LOCAL_BUFFER_ROOT = os.path.join(LOCAL_BU_ROOT, "Cat_Buffer/")
+    change_journal.start_journal(os.path.join(LOCAL_BU_ROOT,
+                                                change_journal.JOURNAL_DIR_NAME))
+
+    if args.phases:
+        # Batch run. Skip menu.
+        run_phases(args.phases, pipelined=args.pipelined,
+                                                full_verify=args.full_verify)
+        wait_for_syncs()
+        print_policy_summary()
+        quit()
 
     # Main loop
     while True:
         prog = input("Choose program to run:\n"
                     "\tType 'f' to run the OFFLOAD program only.\n"
+                    "\tType 'v' to VERIFY latest offload against device.\n"
                     "\tType 'g' to run the ORGANIZE (by date) program only.\n"
                     "\tType 'c' to run the CATEGORIZE program only.\n"
                     "\tType 'a' or press Enter to run all three programs.\n"
+                    "\tType 'p' to run all three with OFFLOAD and ORGANIZE "
+                                                            "pipelined.\n"
                     "\tType 'q' to quit.\n"
                     "\tType 'h' for help.\n> ")
 
         if prog.lower() == 'f':
             run_offload()
 
+        elif prog.lower() == 'v':
+            run_verify(full=args.full_verify)
+
         elif prog.lower() == 'g':
             run_org()
 
@@ -172,10 +497,17 @@ if __name__ == "__main__":
             run_cat()
 
         elif prog.lower() == 'q':
+            wait_for_syncs()
             break
 
         elif prog.lower() == 'a':
             run_all()
+            wait_for_syncs()
+            break
+
+        elif prog.lower() == 'p':
+            run_pipelined()
+            wait_for_syncs()
             break
 
         elif prog.lower() == 'h':
@@ -188,3 +520,5 @@ if __name__ == "__main__":
 
         else:
             print("Invalid response. Try again.")
+
+    print_policy_summary()
@@ -0,0 +1,308 @@
+import os
+import re
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from idevice_media_offload import meta_cache
+from idevice_media_offload.copy_engine import file_hash
+
+
+DATETIME_FORMAT = "%Y-%m-%dT%H%M%S"  # Global format
+
+CATALOG_FILE_NAME = "media_catalog.db"  # Stored in BU root
+CATALOG_HASH_WORKERS = 4
+CATALOG_BATCH_SIZE = 500  # Files per metadata batch/transaction in backfill
+IMG_NUM_RE = re.compile(r"IMG_E?(\d{4})")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,  -- relative to Organized root
+    name TEXT NOT NULL,
+    img_num INTEGER,        -- e.g. 4821 for IMG_4821.JPG / IMG_E4821.JPG
+    capture_date TEXT,      -- YYYY-MM-DD
+    capture_hour INTEGER,
+    yrmon TEXT,             -- YYYY-MM (name of month dir)
+    size INTEGER,
+    mtime INTEGER,
+    sha1 TEXT,
+    caption TEXT,
+    lat REAL,
+    lon REAL,
+    make TEXT,
+    model TEXT,
+    added TEXT
+);
+CREATE INDEX IF NOT EXISTS files_img_num ON files (img_num);
+CREATE INDEX IF NOT EXISTS files_yrmon ON files (yrmon);
+CREATE INDEX IF NOT EXISTS files_capture_date ON files (capture_date);
+CREATE INDEX IF NOT EXISTS files_sha1 ON files (sha1);
+CREATE TABLE IF NOT EXISTS catalog_info (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+# SQLite catalog of Organized library, one row per file, so lookups ("where
+# is IMG_4821", "what's from 2019-07", "which files have captions") don't
+# need a walk of Organized/ and a run of exiftool.
+# ORG adds each file as it's inserted (batched per folder, with metadata from
+# MetaCache in bulk). Files organized before catalog existed are added by a
+# one-time backfill (see CLI below), which can be re-run any time to pick up
+# changes made by hand.
+# Run as script for queries:
+#   python -m idevice_media_offload.media_catalog <BU root> find 4821
+
+class MediaCatalog(object):
+    """Represents catalog database for a BU root's Organized dir."""
+    def __init__(self, bu_root_path):
+        self.org_root = os.path.join(bu_root_path, "Organized/")
+        self.db_path = os.path.join(bu_root_path, CATALOG_FILE_NAME)
+        # ORG may run in a worker thread (pipelined mode).
+        self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock:
+            # WAL so CLI queries can run while ORG is adding files.
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(SCHEMA)
+
+    def get_db_path(self):
+        return self.db_path
+
+    def get_info(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM catalog_info "
+                                                "WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def set_info(self, key, value):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO catalog_info "
+                                        "(key, value) VALUES (?, ?)", (key, value))
+
+    def is_backfilled(self):
+        return self.get_info("backfilled") is not None
+
+    def get_rel_path(self, file_path):
+        return os.path.relpath(file_path, self.org_root)
+
+    def get_full_path(self, rel_path):
+        return os.path.join(self.org_root, rel_path)
+
+    def add_files(self, file_paths, Cache):
+        """Adds (or updates) rows for given files in Organized. Metadata
+        read through Cache (MetaCache) in bulk, digests computed in
+        parallel."""
+        file_paths = [file_path for file_path in file_paths
+                                                if os.path.isfile(file_path)]
+        if not file_paths:
+            return
+        all_meta = Cache.get_many(file_paths)
+        with ThreadPoolExecutor(max_workers=CATALOG_HASH_WORKERS) as executor:
+            digests = dict(zip(file_paths, executor.map(file_hash, file_paths)))
+        rows = [self.make_row(file_path, all_meta.get(file_path, {}),
+                                digests[file_path]) for file_path in file_paths]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO files VALUES "
+                        "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def remove_files(self, file_paths):
+        """Deletes rows for given files (removed from Organized)."""
+        rel_paths = [(self.get_rel_path(file_path),) for file_path in file_paths]
+        if not rel_paths:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM files WHERE path = ?",
+                                                                    rel_paths)
+
+    def make_row(self, file_path, file_meta, digest):
+        file_name = os.path.basename(file_path)
+        file_stat = os.stat(file_path)
+        img_num_match = IMG_NUM_RE.search(file_name)
+        date_parts = meta_cache.get_date_parts(file_path, file_meta)
+        if date_parts:
+            capture_date = "%s-%s-%s" % date_parts[:3]
+            capture_hour = int(date_parts[3]) if date_parts[3] else None
+        else:
+            capture_date = None
+            capture_hour = None
+        rel_path = self.get_rel_path(file_path)
+        # Month dir name (YYYY-MM) from path, since that's where ORG put it.
+        path_parts = rel_path.split(os.sep)
+        yrmon = path_parts[-2] if len(path_parts) >= 2 else None
+        return (rel_path, file_name,
+                int(img_num_match.group(1)) if img_num_match else None,
+                capture_date, capture_hour, yrmon,
+                file_stat.st_size, int(file_stat.st_mtime), digest,
+                meta_cache.get_caption(file_meta) or None,
+                get_float(file_meta.get("Composite:GPSLatitude")),
+                get_float(file_meta.get("Composite:GPSLongitude")),
+                file_meta.get("EXIF:Make") or file_meta.get("QuickTime:Make"),
+                file_meta.get("EXIF:Model") or file_meta.get("QuickTime:Model"),
+                time.strftime(DATETIME_FORMAT))
+
+    def backfill(self, Cache):
+        """Catalogs every file in Organized not already cataloged with same
+        size and mtime, and drops rows for files no longer there. Returns
+        (added, removed) counts."""
+        with self.lock:
+            known = dict((row["path"], (row["size"], row["mtime"])) for row
+                    in self.connection.execute("SELECT path, size, mtime FROM files"))
+        found = set()
+        to_add = []
+        for dir_path, dir_names, file_names in os.walk(self.org_root):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(dir_path, file_name)
+                rel_path = self.get_rel_path(file_path)
+                found.add(rel_path)
+                file_stat = os.stat(file_path)
+                if known.get(rel_path) != (file_stat.st_size,
+                                                    int(file_stat.st_mtime)):
+                    to_add.append(file_path)
+
+        print("Cataloging %d file(s)." % len(to_add))
+        for n in range(0, len(to_add), CATALOG_BATCH_SIZE):
+            self.add_files(to_add[n:n+CATALOG_BATCH_SIZE], Cache)
+            print("\t%d/%d" % (min(n + CATALOG_BATCH_SIZE, len(to_add)),
+                                                                len(to_add)))
+        gone = [(rel_path,) for rel_path in known if rel_path not in found]
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM files WHERE path = ?", gone)
+        self.set_info("backfilled", time.strftime(DATETIME_FORMAT))
+        return (len(to_add), len(gone))
+
+    def query(self, where="1", params=(), order="capture_date, path"):
+        with self.lock:
+            return self.connection.execute("SELECT * FROM files WHERE %s "
+                                "ORDER BY %s" % (where, order), params).fetchall()
+
+    def find_by_number(self, img_num):
+        return self.query("img_num = ?", (int(img_num),))
+
+    def find_by_name(self, name_pattern):
+        # Shell-style pattern, e.g. "*IMG_48*"
+        return self.query("name GLOB ?", (name_pattern,))
+
+    def find_by_month(self, yrmon):
+        # YYYY-MM
+        return self.query("yrmon = ?", (yrmon,))
+
+    def find_by_date(self, date_from, date_to=None):
+        # YYYY-MM-DD, inclusive
+        return self.query("capture_date BETWEEN ? AND ?",
+                                                (date_from, date_to or date_from))
+
+    def find_captioned(self, text=None):
+        if text:
+            return self.query("caption LIKE ?", ("%" + text + "%",))
+        return self.query("caption IS NOT NULL")
+
+    def find_by_camera(self, text):
+        return self.query("(make || ' ' || model) LIKE ?", ("%" + text + "%",))
+
+    def find_by_digest(self, digest):
+        return self.query("sha1 = ?", (digest,))
+
+    def find_duplicates(self):
+        """Rows whose content appears more than once in library."""
+        return self.query("sha1 IN (SELECT sha1 FROM files WHERE sha1 IS NOT "
+                    "NULL GROUP BY sha1 HAVING COUNT(*) > 1)", order="sha1, path")
+
+    def get_stats(self):
+        with self.lock:
+            row = self.connection.execute("SELECT COUNT(*) AS files, "
+                    "SUM(size) AS bytes, COUNT(caption) AS captioned, "
+                    "COUNT(lat) AS located, MIN(capture_date) AS first, "
+                    "MAX(capture_date) AS last FROM files").fetchone()
+        return dict(row)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __repr__(self):
+        return "MediaCatalog object with path:\n\t%s" % self.db_path
+
+
+def get_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def print_rows(rows, Catalog):
+    for row in rows:
+        details = [row["capture_date"] or "no date"]
+        if row["make"] or row["model"]:
+            details.append(("%s %s" % (row["make"] or "",
+                                            row["model"] or "")).strip())
+        if row["lat"] is not None:
+            details.append("%.4f,%.4f" % (row["lat"], row["lon"]))
+        if row["caption"]:
+            details.append('"%s"' % row["caption"])
+        print("%s\n\t%s" % (Catalog.get_full_path(row["path"]),
+                                                        "  ".join(details)))
+    print("%d file(s)" % len(rows))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query media catalog of a "
+                                                    "BU root's Organized dir.")
+    parser.add_argument("bu_root", help="BU root containing Organized dir")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("backfill", help="Catalog files not yet cataloged "
+                                        "and drop rows for files now gone")
+    subparsers.add_parser("stats", help="Summary of catalog")
+    find_parser = subparsers.add_parser("find",
+                                help="Find by image number (4821) or name "
+                                                        "pattern (*IMG_48*)")
+    find_parser.add_argument("target")
+    month_parser = subparsers.add_parser("month", help="Files from YYYY-MM")
+    month_parser.add_argument("yrmon")
+    date_parser = subparsers.add_parser("date",
+                                help="Files captured in date range (YYYY-MM-DD)")
+    date_parser.add_argument("date_from")
+    date_parser.add_argument("date_to", nargs="?")
+    captions_parser = subparsers.add_parser("captions",
+                                help="Files with captions (containing text)")
+    captions_parser.add_argument("text", nargs="?")
+    camera_parser = subparsers.add_parser("camera",
+                                        help="Files from matching make/model")
+    camera_parser.add_argument("text")
+    subparsers.add_parser("dups", help="Files with identical content")
+    args = parser.parse_args(argv)
+
+    Catalog = MediaCatalog(args.bu_root)
+    if args.command == "backfill":
+        (added, removed) = Catalog.backfill(meta_cache.MetaCache(args.bu_root))
+        print("%d file(s) cataloged, %d stale row(s) removed." % (added, removed))
+    elif args.command == "stats":
+        for key, value in Catalog.get_stats().items():
+            print("%s:\t%s" % (key, value))
+        if not Catalog.is_backfilled():
+            print("(Not backfilled. Files organized before catalog existed "
+                                                            "are missing.)")
+    elif args.command == "find":
+        if args.target.isdigit():
+            print_rows(Catalog.find_by_number(args.target), Catalog)
+        else:
+            print_rows(Catalog.find_by_name(args.target), Catalog)
+    elif args.command == "month":
+        print_rows(Catalog.find_by_month(args.yrmon), Catalog)
+    elif args.command == "date":
+        print_rows(Catalog.find_by_date(args.date_from, args.date_to), Catalog)
+    elif args.command == "captions":
+        print_rows(Catalog.find_captioned(args.text), Catalog)
+    elif args.command == "camera":
+        print_rows(Catalog.find_by_camera(args.text), Catalog)
+    elif args.command == "dups":
+        print_rows(Catalog.find_duplicates(), Catalog)
+    Catalog.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,119 @@
+import os
+import re
+
+
+# iOS names: IMG_1234.HEIC, IMG_E1234.HEIC (edited), IMG_O1234.AAE (original
+# adjustments). ORG prepends YYYY-MM-DD_ datestamp and may append caption.
+UNIT_NAME_RE = re.compile(r"^(\d{4}-\d{2}-\d{2}_)?IMG_([EO]?)(\d{4})(?=[._ ]|$)",
+                                                                re.IGNORECASE)
+# Order files of a unit are listed in. First is primary (the one metadata is
+# read from). Stills ahead of video (Live Photo) ahead of sidecars.
+IMAGE_EXTS = [".HEIC", ".JPG", ".JPEG", ".DNG", ".CR2", ".PNG", ".GIF", ".WEBP"]
+VIDEO_EXTS = [".MOV", ".MP4", ".M4V", ".3GP"]
+SIDECAR_EXTS = [".AAE"]
+# Can be displayed in Categorizer (HEIC and RAW shown through a JPG).
+DISPLAY_EXTS = [".JPG", ".JPEG", ".PNG", ".GIF", ".WEBP"] + VIDEO_EXTS
+
+
+# Media units: all files from one capture handled as one item.
+# A Live Photo is HEIC + MOV, an edit adds IMG_E version(s) and AAE sidecars,
+# RAW+JPG is DNG + JPG, and ORG adds a JPG converted from each HEIC. All share
+# an image number.
+# Capture identity is image number plus datestamp ORG put on name (if any)
+# within one dir. Numbers wrap every 10000 images, but not within one DCIM
+# folder or one day. Other names are grouped by name without extension.
+# Units built from a dir listing in one pass (build_units()).
+
+class MediaUnit(object):
+    """Represents files in a dir from one capture."""
+    def __init__(self, dir_path, key):
+        self.dir_path = dir_path
+        self.key = key
+        self.names = []
+
+    def add(self, name):
+        self.names.append(name)
+        self.names.sort(key=member_rank)
+
+    def get_key(self):
+        return self.key
+
+    def get_names(self):
+        return list(self.names)
+
+    def get_paths(self):
+        return [os.path.join(self.dir_path, name) for name in self.names]
+
+    def get_primary(self):
+        return os.path.join(self.dir_path, self.names[0])
+
+    def get_members(self):
+        """Returns paths of files other than primary."""
+        return self.get_paths()[1:]
+
+    def get_display_path(self):
+        """Returns path of first file that can be displayed, or None."""
+        for name in self.names:
+            if os.path.splitext(name)[-1].upper() in DISPLAY_EXTS:
+                return os.path.join(self.dir_path, name)
+        return None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return "MediaUnit object with files:\n\t%s" % "\n\t".join(
+                                                            self.get_paths())
+
+
+def get_unit_key(name):
+    """Returns key shared by files of same capture. Name without extension
+    if it doesn't follow iOS naming (so a HEIC still goes with its JPG)."""
+    name_match = UNIT_NAME_RE.match(name)
+    if not name_match:
+        return os.path.splitext(name)[0]
+    return "%sIMG_%s" % (name_match.group(1) or "", name_match.group(3))
+
+
+def member_rank(name):
+    name_match = UNIT_NAME_RE.match(name)
+    variant = name_match.group(2).upper() if name_match else ""
+    ext = os.path.splitext(name)[-1].upper()
+    if ext in IMAGE_EXTS:
+        ext_rank = IMAGE_EXTS.index(ext)
+    elif ext in VIDEO_EXTS:
+        ext_rank = len(IMAGE_EXTS) + VIDEO_EXTS.index(ext)
+    elif ext in SIDECAR_EXTS:
+        ext_rank = len(IMAGE_EXTS) + len(VIDEO_EXTS) + 1
+    else:
+        ext_rank = len(IMAGE_EXTS) + len(VIDEO_EXTS)
+    # Originals first, then edited (E), then original-adjustment (O) files.
+    return (["", "E", "O"].index(variant), ext_rank, name)
+
+
+def build_units(names, dir_path=""):
+    """Groups names (files in dir_path) into media units. Returns list of
+    MediaUnit, ordered by first name of each in sorted order."""
+    units = {}  # key: MediaUnit
+    for name in sorted(names):
+        unit_key = get_unit_key(name)
+        if unit_key not in units:
+            units[unit_key] = MediaUnit(dir_path, unit_key)
+        units[unit_key].add(name)
+    return list(units.values())
+
+
+def map_units(units):
+    """Returns dict mapping each file name to its MediaUnit."""
+    return dict((name, Unit) for Unit in units for name in Unit.get_names())
+
+
+def complete_names(done_names, all_names):
+    """Returns names from done_names whose whole unit (among all_names) is
+    in done_names."""
+    done_names = set(done_names)
+    complete = []
+    for Unit in build_units(all_names):
+        if all(name in done_names for name in Unit.get_names()):
+            complete += Unit.get_names()
+    return complete
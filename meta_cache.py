@@ -0,0 +1,157 @@
+import os
+import re
+import json
+import threading
+
+import exiftool
+
+
+CACHE_FILE_NAME = "meta_cache.json"  # Stored next to Cat_Buffer in BU root
+META_BATCH_SIZE = 100  # Files per exiftool call
+
+# Tags kept for each file. Enough for dating (to fraction of a second, for
+# event grouping), locating, and captions.
+META_TAGS = ["EXIF:DateTimeOriginal", "EXIF:CreateDate", "QuickTime:CreateDate",
+             "Composite:SubSecDateTimeOriginal", "EXIF:SubSecTimeOriginal",
+             "QuickTime:CreationDate", "EXIF:OffsetTimeOriginal",
+             "EXIF:Make", "EXIF:Model", "QuickTime:Make", "QuickTime:Model",
+             "Composite:GPSLatitude", "Composite:GPSLongitude",
+             "EXIF:ImageDescription", "IPTC:Caption-Abstract",
+             "QuickTime:Comment", "XMP:Description", "File:Comment",
+             "File:MIMEType"]
+CAPTION_TAGS = ["EXIF:ImageDescription", "IPTC:Caption-Abstract",
+                "QuickTime:Comment", "XMP:Description", "File:Comment"]
+DATE_RE = re.compile(r"(\d{4})[:-](\d{2})[:-](\d{2})[ T_]?(\d{2})?")
+
+
+# Cache of selected metadata so exiftool runs once per file, in batches,
+# rather than once per file per lookup.
+# Entries keyed by file name, size, and mtime rather than path, so they stay
+# valid as files move from Cat_Buffer to their destination. Each entry also
+# keeps path file was last seen at ("SourceFile", as exiftool reports it) so
+# entries for files since deleted can be dropped.
+
+class MetaCache(object):
+    """Represents metadata cache file."""
+    def __init__(self, cache_dir):
+        self.cache_path = os.path.join(cache_dir, CACHE_FILE_NAME)
+        self.entries = self.load()
+        self.lock = threading.Lock()
+
+    def get_cache_path(self):
+        return self.cache_path
+
+    def load(self):
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, "r") as cache_file:
+                return json.load(cache_file)
+        else:
+            return {}
+
+    def save(self):
+        """Writes entries merged with what's on disk, since ORG and CAT each
+        have their own instance. Entries whose file no longer exists (or
+        that predate "SourceFile" being kept) are dropped."""
+        with self.lock:
+            entries = self.load()
+            entries.update(self.entries)
+            self.entries = dict((key, entry) for (key, entry) in entries.items()
+                                if os.path.exists(entry.get("SourceFile", "")))
+            # Unique per writer so instances saving at once don't collide.
+            tmp_path = "%s.%d.%d.tmp" % (self.cache_path, os.getpid(),
+                                                        threading.get_ident())
+            with open(tmp_path, "w") as cache_file:
+                json.dump(self.entries, cache_file)
+            os.replace(tmp_path, self.cache_path)
+
+    def get(self, file_path, fetch=True):
+        """Returns metadata dict for one file (empty if none), or None if not
+        cached and fetch is False."""
+        if fetch:
+            return self.get_many([file_path]).get(file_path, {})
+        elif not os.path.isfile(file_path):
+            return None
+        entry = self.entries.get(cache_key(file_path))
+        return get_tags(entry) if entry is not None else None
+
+    def get_many(self, file_paths):
+        """Returns dict mapping each path to its metadata dict. Files not
+        already cached are read with exiftool in batches. Cache saved once
+        at end if anything changed."""
+        results = {}
+        to_fetch = []
+        moved = False  # Cached file now seen at a different path
+        for file_path in file_paths:
+            if not os.path.isfile(file_path):
+                continue
+            entry = self.entries.get(cache_key(file_path))
+            if entry is None:
+                to_fetch.append(file_path)
+            else:
+                if entry.get("SourceFile") != file_path:
+                    with self.lock:
+                        entry["SourceFile"] = file_path
+                    moved = True
+                results[file_path] = get_tags(entry)
+        if not to_fetch:
+            if moved:
+                self.save()
+            return results
+
+        with exiftool.ExifToolHelper() as et:
+            for n in range(0, len(to_fetch), META_BATCH_SIZE):
+                batch_paths = to_fetch[n:n+META_BATCH_SIZE]
+                try:
+                    batch_meta = et.get_tags(batch_paths, tags=META_TAGS)
+                except Exception:
+                    # One bad file fails whole call. Retry one by one.
+                    batch_meta = []
+                    for file_path in batch_paths:
+                        try:
+                            batch_meta += et.get_tags([file_path], tags=META_TAGS)
+                        except Exception:
+                            batch_meta.append({"SourceFile": file_path})
+                for file_path, file_meta in zip(batch_paths, batch_meta):
+                    file_meta = get_tags(file_meta)
+                    with self.lock:
+                        self.entries[cache_key(file_path)] = dict(file_meta,
+                                                        SourceFile=file_path)
+                    results[file_path] = file_meta
+        self.save()
+        return results
+
+    def __repr__(self):
+        return "MetaCache object with path:\n\t%s" % self.cache_path
+
+
+def cache_key(file_path):
+    file_stat = os.stat(file_path)
+    return "%s|%d|%d" % (os.path.basename(file_path), file_stat.st_size,
+                                                        int(file_stat.st_mtime))
+
+
+def get_tags(entry):
+    # Metadata tags only (without path exiftool or cache keeps in entry).
+    return dict((tag, value) for (tag, value) in entry.items()
+                                                    if tag != "SourceFile")
+
+
+def get_date_parts(file_path, file_meta):
+    """Returns (year, month, day, hour) strings for file's capture date from
+    its metadata, or from datestamp in its name if no date tag. hour may be
+    None. Returns None if no date found."""
+    date_str = (file_meta.get("EXIF:DateTimeOriginal")
+                or file_meta.get("EXIF:CreateDate")
+                or file_meta.get("QuickTime:CreateDate")
+                # ORG prepends YYYY-MM-DD_ datestamp to names
+                or os.path.basename(file_path))
+    date_match = DATE_RE.search(str(date_str))
+    if date_match:
+        return date_match.groups()
+    return None
+
+
+def get_caption(file_meta):
+    """Returns all caption/comment text found in metadata as one string."""
+    return " ".join(str(file_meta[tag]) for tag in CAPTION_TAGS
+                                                        if file_meta.get(tag))
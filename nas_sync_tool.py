@@ -0,0 +1,333 @@
+import os
+import shutil
+import time
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+
+
+class NASSyncError(Exception):
+    pass
+
+
+DATETIME_FORMAT = "%Y-%m-%dT%H%M%S"  # Global format
+
+SYNC_WORKERS = 4
+SYNC_BLOCK_SIZE = 1024 * 1024  # 1 MiB
+PARTIAL_SUFFIX = ".sync_partial"
+DIGEST_DIR_NAME = "sync_digests"
+SYNC_LOG_DIR_NAME = "sync_logs"
+
+
+# In-process replacement for NAS_BU_sync.sh/NAS_ST_sync.sh.
+# Copies new or changed files (size or mtime differs, like rsync's quick check)
+# from a local tree to a destination path, which is normally the mounted NAS
+# share but can be any local directory.
+# Interrupted transfers leave a partial file next to the destination that is
+# resumed on the next run. Every transferred file is verified against the
+# source digest recorded during transfer.
+# Digests are kept per job. When only a file's mtime changed (touched,
+# restored from backup, re-stamped) and destination still holds what was last
+# sent, source is hashed locally and, if it matches stored digest, only the
+# destination's mtime is updated instead of re-sending the file.
+
+class NASSync(object):
+    """Represents one sync job from a local source tree to a destination tree.
+    state_root holds the digest manifest and logs (analogous to where the rsync
+    scripts keep rsync_logs and rsync_partials)."""
+    def __init__(self, src_root, dest_root, state_root, job_name=None,
+                 workers=SYNC_WORKERS, verify=True, progress_callback=None):
+        self.src_root = src_root
+        self.dest_root = dest_root
+        self.state_root = state_root
+        if not job_name:
+            job_name = os.path.basename(os.path.normpath(src_root))
+        self.job_name = job_name
+        self.workers = workers
+        self.verify = verify
+        # Called with a dict for every progress event. Defaults to tqdm bar.
+        self.progress_callback = progress_callback
+
+        if not os.path.isdir(self.src_root):
+            raise NASSyncError("Sync source %s not found." % self.src_root)
+        if not os.path.isdir(self.dest_root):
+            raise NASSyncError("Sync destination %s not reachable."
+                                                            % self.dest_root)
+
+        self.digest_path = os.path.join(self.state_root, DIGEST_DIR_NAME,
+                                                    "%s.json" % self.job_name)
+        self.digests = self.load_digests()
+        self.digest_lock = threading.Lock()
+        self.progress_lock = threading.Lock()
+        self.result = None
+
+    def get_src_root(self):
+        return self.src_root
+
+    def get_dest_root(self):
+        return self.dest_root
+
+    def load_digests(self):
+        if os.path.exists(self.digest_path):
+            with open(self.digest_path, "r") as digest_file:
+                return json.load(digest_file)
+        else:
+            return {}
+
+    def save_digests(self):
+        os.makedirs(os.path.dirname(self.digest_path), exist_ok=True)
+        with open(self.digest_path + ".tmp", "w") as digest_file:
+            json.dump(self.digests, digest_file)
+        os.replace(self.digest_path + ".tmp", self.digest_path)
+
+    def is_content_unchanged(self, rel_path, src_stat, dest_stat):
+        """Returns True if destination still holds what was last sent (size
+        and mtime recorded with digest) and source content still matches
+        stored digest. Hashes source (local) only, never destination."""
+        entry = self.digests.get(rel_path)
+        if (not entry or entry[0] != src_stat.st_size
+                      or dest_stat.st_size != entry[0]
+                      or int(dest_stat.st_mtime) != entry[1]):
+            return False
+        return file_digest(os.path.join(self.src_root, rel_path)) == entry[2]
+
+    def store_digest(self, rel_path, src_stat, digest):
+        with self.digest_lock:
+            self.digests[rel_path] = [src_stat.st_size, int(src_stat.st_mtime),
+                                                                        digest]
+
+    def plan(self, rel_paths=None):
+        """Returns (to_transfer, to_touch): list of (rel_path, size) tuples
+        needing transfer and list of rel_paths whose content is unchanged but
+        need destination mtime updated. Walks whole source tree unless
+        rel_paths (relative to src_root) given."""
+        if rel_paths is None:
+            rel_paths = []
+            for dir_path, dir_names, file_names in os.walk(self.src_root,
+                                                            followlinks=True):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    rel_paths.append(os.path.relpath(
+                            os.path.join(dir_path, file_name), self.src_root))
+
+        to_transfer = []
+        to_touch = []
+        for rel_path in rel_paths:
+            src_path = os.path.join(self.src_root, rel_path)
+            if not os.path.isfile(src_path):
+                continue
+            src_stat = os.stat(src_path)
+            dest_path = os.path.join(self.dest_root, rel_path)
+            try:
+                dest_stat = os.stat(dest_path)
+            except FileNotFoundError:
+                to_transfer.append((rel_path, src_stat.st_size))
+                continue
+            if dest_stat.st_size != src_stat.st_size:
+                to_transfer.append((rel_path, src_stat.st_size))
+            elif int(dest_stat.st_mtime) != int(src_stat.st_mtime):
+                if self.is_content_unchanged(rel_path, src_stat, dest_stat):
+                    to_touch.append(rel_path)
+                else:
+                    to_transfer.append((rel_path, src_stat.st_size))
+        return (to_transfer, to_touch)
+
+    def touch_unchanged(self, rel_paths):
+        """Copies source mtime to destination for files whose content is
+        already there (see plan()). Returns number of files updated."""
+        touched = 0
+        for rel_path in rel_paths:
+            src_path = os.path.join(self.src_root, rel_path)
+            try:
+                shutil.copystat(src_path, os.path.join(self.dest_root, rel_path))
+            except OSError:
+                continue
+            self.store_digest(rel_path, os.stat(src_path),
+                                                    self.digests[rel_path][2])
+            touched += 1
+        return touched
+
+    def apply_deletions(self, rel_paths):
+        """Removes destination counterparts of given paths that no longer exist
+        in the source. Deepest paths first so emptied dirs can be removed.
+        Returns number of paths removed."""
+        removed = 0
+        for rel_path in sorted(rel_paths, key=lambda path: path.count(os.sep),
+                                                                reverse=True):
+            if os.path.lexists(os.path.join(self.src_root, rel_path)):
+                continue
+            dest_path = os.path.join(self.dest_root, rel_path)
+            if os.path.isdir(dest_path) and not os.path.islink(dest_path):
+                if not os.listdir(dest_path):
+                    os.rmdir(dest_path)
+                    removed += 1
+            elif os.path.lexists(dest_path):
+                os.remove(dest_path)
+                removed += 1
+        return removed
+
+    def transfer_file(self, rel_path):
+        """Copies one file into place through a resumable partial file.
+        Returns number of bytes actually sent (excludes resumed prefix)."""
+        src_path = os.path.join(self.src_root, rel_path)
+        dest_path = os.path.join(self.dest_root, rel_path)
+        dest_dir = os.path.dirname(dest_path)
+        partial_path = os.path.join(dest_dir,
+                            "." + os.path.basename(dest_path) + PARTIAL_SUFFIX)
+        os.makedirs(dest_dir, exist_ok=True)
+
+        src_stat = os.stat(src_path)
+        src_hash = hashlib.sha1()
+        offset = 0
+        if os.path.exists(partial_path):
+            # Resume from end of partial left by an interrupted run, but only
+            # if it's no longer than the source. Prefix is re-read from the
+            # source to keep the digest correct.
+            if os.path.getsize(partial_path) <= src_stat.st_size:
+                offset = os.path.getsize(partial_path)
+            else:
+                os.remove(partial_path)
+
+        bytes_sent = 0
+        with open(src_path, "rb") as src_file:
+            if offset:
+                remaining = offset
+                while remaining:
+                    chunk = src_file.read(min(SYNC_BLOCK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    src_hash.update(chunk)
+                    remaining -= len(chunk)
+            with open(partial_path, "ab") as partial_file:
+                while True:
+                    chunk = src_file.read(SYNC_BLOCK_SIZE)
+                    if not chunk:
+                        break
+                    src_hash.update(chunk)
+                    partial_file.write(chunk)
+                    bytes_sent += len(chunk)
+                    self.report({"event": "bytes", "path": rel_path,
+                                                            "bytes": len(chunk)})
+        digest = src_hash.hexdigest()
+        self.store_digest(rel_path, src_stat, digest)
+
+        # Re-read what landed at the destination and check it against the
+        # digest stored for the source.
+        if self.verify and file_digest(partial_path) != digest:
+            os.remove(partial_path)
+            raise NASSyncError("Verification failed for %s. Partial removed; "
+                                        "will be re-sent next run." % rel_path)
+
+        shutil.copystat(src_path, partial_path)
+        os.replace(partial_path, dest_path)
+        return bytes_sent
+
+    def report(self, event):
+        if self.progress_callback:
+            with self.progress_lock:
+                self.progress_callback(event)
+
+    def run(self, rel_paths=None, quiet=False):
+        """Executes sync and returns result dict summarizing transfer.
+        If rel_paths given (e.g. from change journal), only those paths are
+        considered, and any of them missing from source are deleted from the
+        destination."""
+        start_time = time.time()
+        files_deleted = 0
+        if rel_paths is not None:
+            files_deleted = self.apply_deletions(rel_paths)
+        (to_transfer, to_touch) = self.plan(rel_paths)
+        files_touched = self.touch_unchanged(to_touch)
+        bytes_total = sum(size for (rel_path, size) in to_transfer)
+
+        progress_bar = None
+        if not self.progress_callback and not quiet and to_transfer:
+            progress_bar = tqdm(total=bytes_total, unit="B", unit_scale=True,
+                                unit_divisor=1024, desc=" %s sync" % self.job_name)
+            self.progress_callback = lambda event: (progress_bar.update(
+                    event["bytes"]) if event["event"] == "bytes" else None)
+
+        self.report({"event": "start", "files_total": len(to_transfer),
+                                                    "bytes_total": bytes_total})
+        failures = []
+        bytes_sent = 0
+        files_done = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.transfer_file, rel_path): rel_path
+                                            for (rel_path, size) in to_transfer}
+            for future in as_completed(futures):
+                rel_path = futures[future]
+                try:
+                    bytes_sent += future.result()
+                except (OSError, NASSyncError) as error:
+                    failures.append((rel_path, str(error)))
+                    self.report({"event": "file_failed", "path": rel_path,
+                                                            "error": str(error)})
+                else:
+                    files_done += 1
+                    self.report({"event": "file_done", "path": rel_path,
+                                 "files_done": files_done,
+                                 "files_total": len(to_transfer)})
+        self.save_digests()
+
+        if progress_bar:
+            progress_bar.close()
+            self.progress_callback = None
+
+        elapsed = time.time() - start_time
+        self.result = {"job": self.job_name,
+                       "files_transferred": files_done,
+                       "files_failed": failures,
+                       "files_deleted": files_deleted,
+                       "files_touched": files_touched,
+                       "bytes_sent": bytes_sent,
+                       "seconds": elapsed,
+                       "bytes_per_sec": bytes_sent / elapsed if elapsed else 0}
+        self.report(dict(self.result, event="finish"))
+        self.log_result()
+        return self.result
+
+    def run_in_background(self, rel_paths=None):
+        """Starts sync in separate thread so next phase can overlap it.
+        Join returned thread then read self.result."""
+        sync_thread = threading.Thread(target=self.run,
+                                kwargs={"rel_paths": rel_paths, "quiet": True},
+                                name="NASSync-%s" % self.job_name)
+        sync_thread.start()
+        return sync_thread
+
+    def log_result(self):
+        log_dir = os.path.join(self.state_root, SYNC_LOG_DIR_NAME)
+        os.makedirs(log_dir, exist_ok=True)
+        log_path = os.path.join(log_dir, "%s_%s" % (
+                                time.strftime(DATETIME_FORMAT), self.job_name))
+        with open(log_path, "w") as log_file:
+            log_file.write("SRC: %s\nDEST: %s\n" % (self.src_root, self.dest_root))
+            log_file.write(json.dumps(self.result, indent=2) + "\n")
+
+    def __str__(self):
+        return "%s -> %s" % (self.src_root, self.dest_root)
+
+    def __repr__(self):
+        return "NASSync object:\n\t%s\n\t-> %s" % (self.src_root, self.dest_root)
+
+
+def file_digest(file_path):
+    file_hash = hashlib.sha1()
+    with open(file_path, "rb") as file_obj:
+        for chunk in iter(lambda: file_obj.read(SYNC_BLOCK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def print_sync_result(result):
+    print("\n%s sync: %d file(s), %.1f MB in %.1f s (%.1f MB/s), %d deleted, "
+          "%d unchanged (mtime only)"
+            % (result["job"], result["files_transferred"],
+               result["bytes_sent"] / 1e6, result["seconds"],
+               result["bytes_per_sec"] / 1e6, result["files_deleted"],
+               result.get("files_touched", 0)))
+    for rel_path, error in result["files_failed"]:
+        print("\tFAILED: %s (%s)" % (rel_path, error))
@@ -0,0 +1,180 @@
+import os
+import json
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import PIL.Image
+
+from idevice_media_offload import meta_cache
+from idevice_media_offload.preview_cache import IMAGE_EXTS
+
+
+HASH_CACHE_FILE_NAME = "near_dup_hashes.json"  # Stored next to Cat_Buffer in BU root
+HASH_WORKERS = os.cpu_count() or 2
+HASH_CHUNK_SIZE = 8  # Images per task sent to a worker process
+HASH_BYTES = 8  # 64-bit dHash and 64-bit pHash
+DHASH_MAX_DISTANCE = 10  # Differing bits (of 64) still counted near-duplicate
+PHASH_MAX_DISTANCE = 12
+COMPARE_BLOCK_ROWS = 256  # Rows compared against all others at once
+DCT_SIZE = 32  # pHash image size (pixels square) before DCT
+
+# Bits set in each byte value, for Hamming distance over packed hashes.
+POPCOUNT = np.array([bin(n).count("1") for n in range(256)], dtype=np.uint8)
+
+
+# Finds near-duplicates in Cat_Buffer (bursts, repeated screenshots, edited
+# copies IMG_E logic doesn't catch) so Categorizer can show each cluster
+# together and apply one decision to all of it.
+# Each image gets a dHash (brightness gradient) and pHash (low DCT
+# frequencies), computed in a process pool and cached by name, size, and
+# mtime. Two images are near-duplicates if both hashes are within a few bits.
+# All pairs compared at once with NumPy (XOR of packed hashes, then bit count
+# by lookup table), in blocks of rows to bound memory. Pairs joined into
+# clusters with union-find.
+
+class NearDupIndex(object):
+    """Represents perceptual hash cache file."""
+    def __init__(self, cache_dir):
+        self.cache_path = os.path.join(cache_dir, HASH_CACHE_FILE_NAME)
+        self.entries = self.load()
+        self.lock = threading.Lock()
+
+    def get_cache_path(self):
+        return self.cache_path
+
+    def load(self):
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, "r") as cache_file:
+                return json.load(cache_file)
+        else:
+            return {}
+
+    def save(self):
+        with self.lock:
+            with open(self.cache_path + ".tmp", "w") as cache_file:
+                json.dump(self.entries, cache_file)
+            os.replace(self.cache_path + ".tmp", self.cache_path)
+
+    def get_hashes(self, img_paths):
+        """Returns dict mapping each hashable image path to its hashes (hex
+        string). Images not already cached are hashed in a process pool."""
+        results = {}
+        to_hash = []
+        for img_path in img_paths:
+            if (os.path.splitext(img_path)[-1].upper() not in IMAGE_EXTS
+                                            or not os.path.isfile(img_path)):
+                continue
+            entry = self.entries.get(meta_cache.cache_key(img_path))
+            if entry is None:
+                to_hash.append(img_path)
+            elif entry:
+                # Empty entry means image couldn't be read last time.
+                results[img_path] = entry
+        if not to_hash:
+            return results
+
+        print("Hashing %d image(s) to find near-duplicates." % len(to_hash))
+        with ProcessPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            for img_path, img_hashes in zip(to_hash, executor.map(
+                            get_image_hashes, to_hash, chunksize=HASH_CHUNK_SIZE)):
+                with self.lock:
+                    self.entries[meta_cache.cache_key(img_path)] = img_hashes or ""
+                if img_hashes:
+                    results[img_path] = img_hashes
+        self.save()
+        return results
+
+    def find_clusters(self, img_paths):
+        """Returns list of near-duplicate clusters among img_paths, each a
+        sorted list of two or more paths, in order of first member."""
+        img_paths = sorted(set(img_paths))
+        all_hashes = self.get_hashes(img_paths)
+        hashed_paths = [img_path for img_path in img_paths
+                                                    if img_path in all_hashes]
+        if len(hashed_paths) < 2:
+            return []
+        packed = np.array([bytearray.fromhex(all_hashes[img_path])
+                            for img_path in hashed_paths], dtype=np.uint8)
+        pairs = find_close_pairs(packed[:, :HASH_BYTES], packed[:, HASH_BYTES:])
+
+        # Union-find over pairs.
+        parents = list(range(len(hashed_paths)))
+        def find_root(n):
+            while parents[n] != n:
+                parents[n] = parents[parents[n]]
+                n = parents[n]
+            return n
+        for n1, n2 in pairs:
+            root1 = find_root(n1)
+            root2 = find_root(n2)
+            if root1 != root2:
+                parents[max(root1, root2)] = min(root1, root2)
+
+        clusters = {}  # root index: list of paths
+        for n, img_path in enumerate(hashed_paths):
+            clusters.setdefault(find_root(n), []).append(img_path)
+        return [clusters[root] for root in sorted(clusters)
+                                                if len(clusters[root]) > 1]
+
+    def __repr__(self):
+        return "NearDupIndex object with path:\n\t%s" % self.cache_path
+
+
+def get_image_hashes(img_path):
+    """Returns dHash and pHash of image as one hex string, or None if it
+    can't be read. Runs in worker process."""
+    try:
+        with PIL.Image.open(img_path) as img:
+            # Lets JPEG decoder skip to a reduced size. Much faster.
+            img.draft("L", (DCT_SIZE * 2, DCT_SIZE * 2))
+            gray_img = img.convert("L")
+            dhash_pixels = np.asarray(gray_img.resize((HASH_BYTES + 1,
+                                    HASH_BYTES), PIL.Image.LANCZOS), dtype=np.int16)
+            phash_pixels = np.asarray(gray_img.resize((DCT_SIZE, DCT_SIZE),
+                                        PIL.Image.LANCZOS), dtype=np.float64)
+    except (OSError, ValueError, PIL.Image.DecompressionBombError):
+        return None
+
+    # dHash: is each pixel brighter than its left neighbor.
+    dhash_bits = dhash_pixels[:, 1:] > dhash_pixels[:, :-1]
+    # pHash: 8x8 lowest frequencies of 2D DCT, compared to their median (DC
+    # term left out of median since it's just overall brightness).
+    dct_coeffs = DCT_MATRIX @ phash_pixels @ DCT_MATRIX.T
+    low_freqs = dct_coeffs[:HASH_BYTES, :HASH_BYTES].flatten()
+    phash_bits = low_freqs > np.median(low_freqs[1:])
+    return (np.packbits(dhash_bits).tobytes()
+                                    + np.packbits(phash_bits).tobytes()).hex()
+
+
+def get_dct_matrix(size):
+    # Orthonormal DCT-II basis, so 2D DCT is matrix @ img @ matrix.T
+    rows = np.arange(size)[:, None]
+    cols = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * cols + 1) * rows / (2 * size))
+    matrix[0, :] *= np.sqrt(1 / size)
+    matrix[1:, :] *= np.sqrt(2 / size)
+    return matrix
+
+DCT_MATRIX = get_dct_matrix(DCT_SIZE)
+
+
+def find_close_pairs(dhashes, phashes):
+    """Returns list of (i, j) index pairs (i < j) whose dHashes and pHashes
+    are both within max distance. Hashes are (N, 8) uint8 arrays."""
+    pairs = []
+    count = len(dhashes)
+    for start in range(0, count, COMPARE_BLOCK_ROWS):
+        stop = min(start + COMPARE_BLOCK_ROWS, count)
+        # (rows, N) Hamming distances for this block against every hash.
+        dhash_dists = POPCOUNT[dhashes[start:stop, None, :]
+                                        ^ dhashes[None, :, :]].sum(axis=2)
+        phash_dists = POPCOUNT[phashes[start:stop, None, :]
+                                        ^ phashes[None, :, :]].sum(axis=2)
+        close = ((dhash_dists <= DHASH_MAX_DISTANCE)
+                                    & (phash_dists <= PHASH_MAX_DISTANCE))
+        # Each pair once.
+        close &= np.arange(count)[None, :] > np.arange(start, stop)[:, None]
+        for row, col in zip(*np.nonzero(close)):
+            pairs.append((start + int(row), int(col)))
+    return pairs
@@ -0,0 +1,292 @@
+import os
+import time
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from idevice_media_offload import device_io
+from idevice_media_offload import copy_engine
+from idevice_media_offload import policy
+from idevice_media_offload.copy_engine import file_hash
+
+
+DATETIME_FORMAT = "%Y-%m-%dT%H%M%S"  # Global format
+
+DIGEST_FILE_SUFFIX = "_digests.json"  # <offload name>_digests.json in RO root
+REPORT_FILE_SUFFIX = "_verify.json"  # <offload name>_verify.json in RO root
+LOCAL_HASH_WORKERS = 4  # Raw_Offload side
+# Device side limited same as offload copies so AFC link isn't flooded.
+DEVICE_HASH_WORKERS = device_io.DEVICE_IO_CONCURRENCY
+
+
+# Checks a Raw_Offload folder against the device it came from.
+# Every file's size is compared, then its content digest: the Raw_Offload
+# copy is hashed locally while the device source is hashed over gvfs, both
+# sides in parallel.
+# Offload records each file's source APPLE folder, device stats, and SHA-1 of
+# the data it copied in <offload name>_digests.json in Raw_Offload root. If
+# the device file's size and mtime still match, that digest stands in for
+# the device side so the device doesn't have to be read again (unless
+# full=True).
+# Report written to <offload name>_verify.json in Raw_Offload root. Files that
+# fail can be re-copied from device and checked again.
+
+def get_digest_path(RO_root, offload_dir_name):
+    return os.path.join(RO_root, offload_dir_name + DIGEST_FILE_SUFFIX)
+
+
+def load_digests(RO_root, offload_dir_name):
+    """Returns dict mapping "YYYYMM/img name" to record of copy: src (APPLE
+    folder), size, mtime, sha1. Empty if offload predates digest files."""
+    digest_path = get_digest_path(RO_root, offload_dir_name)
+    if os.path.exists(digest_path):
+        with open(digest_path, "r") as digest_file:
+            return json.load(digest_file)
+    else:
+        return {}
+
+
+def save_digests(RO_root, offload_dir_name, digests):
+    digest_path = get_digest_path(RO_root, offload_dir_name)
+    with open(digest_path + ".tmp", "w") as digest_file:
+        json.dump(digests, digest_file, indent=1, sort_keys=True)
+    os.replace(digest_path + ".tmp", digest_path)
+
+
+class OffloadVerifier(object):
+    """Represents verification of one Raw_Offload folder (RawOffload object)
+    against connected device (iDeviceDCIM object)."""
+    def __init__(self, Offload, iDevice_DCIM, full=False):
+        self.Offload = Offload
+        self.iDevice_DCIM = iDevice_DCIM
+        self.full = full
+        self.RO_root = self.Offload.get_parent().get_RO_root()
+        self.digests = load_digests(self.RO_root, self.Offload.get_dir_name())
+        self.results = {}  # "YYYYMM/img name": result dict
+
+    def get_report_path(self):
+        return os.path.join(self.RO_root,
+                            self.Offload.get_dir_name() + REPORT_FILE_SUFFIX)
+
+    def find_sources(self, rel_paths):
+        """Returns dict mapping each rel path to APPLE folder it came from
+        (None if no longer on device). Uses digest records where there are
+        any, otherwise looks for name in device folders for that month."""
+        sources = {}
+        unrecorded = [rel_path for rel_path in rel_paths
+                                                if rel_path not in self.digests]
+        for rel_path in rel_paths:
+            if rel_path in self.digests:
+                sources[rel_path] = self.digests[rel_path]["src"]
+        if unrecorded:
+            months = set(rel_path.split("/")[0] for rel_path in unrecorded)
+            APPLE_folders = [APPLE_folder for APPLE_folder
+                                    in self.iDevice_DCIM.list_APPLE_folders()
+                                                if APPLE_folder[:6] in months]
+            self.iDevice_DCIM.prefetch_APPLE_contents(APPLE_folders)
+            name_sources = {}  # (YYYYMM, img name): APPLE folder
+            for APPLE_folder in APPLE_folders:
+                for img_name in self.iDevice_DCIM.get_APPLE_contents(APPLE_folder):
+                    name_sources[(APPLE_folder[:6], img_name)] = APPLE_folder
+            for rel_path in unrecorded:
+                (dir_month, img_name) = rel_path.split("/")
+                sources[rel_path] = name_sources.get((dir_month, img_name))
+        # APPLE folder may be gone from device even if recorded.
+        for rel_path, APPLE_folder in sources.items():
+            if APPLE_folder not in self.iDevice_DCIM.list_APPLE_folders():
+                sources[rel_path] = None
+        return sources
+
+    def list_offload_files(self):
+        rel_paths = []
+        for dir_month in self.Offload.list_APPLE_folders():
+            for img_name in self.Offload.get_APPLE_contents(dir_month):
+                rel_paths.append("%s/%s" % (dir_month, img_name))
+        return rel_paths
+
+    def get_local_path(self, rel_path):
+        (dir_month, img_name) = rel_path.split("/")
+        return os.path.join(self.Offload.get_APPLE_folder_path(dir_month),
+                                                                    img_name)
+
+    def get_device_path(self, rel_path, APPLE_folder):
+        return os.path.join(self.iDevice_DCIM.get_APPLE_folder_path(
+                                    APPLE_folder), rel_path.split("/")[1])
+
+    def hash_device_file(self, device_path):
+        # Counts against shared I/O limit in multi-device mode.
+        return self.iDevice_DCIM.Reader.call_limited(file_hash, device_path)
+
+    def run(self, rel_paths=None):
+        """Verifies given files (whole offload by default) in one parallel
+        pass. Returns list of rel paths that failed."""
+        if rel_paths is None:
+            rel_paths = self.list_offload_files()
+        sources = self.find_sources(rel_paths)
+
+        # Device sizes/mtimes fetched concurrently per APPLE folder.
+        device_stats = {}  # rel path: (size, mtime)
+        folder_imgs = {}  # APPLE folder: list of (rel path, img name)
+        for rel_path in rel_paths:
+            if sources[rel_path]:
+                folder_imgs.setdefault(sources[rel_path], []).append(
+                                        (rel_path, rel_path.split("/")[1]))
+        for APPLE_folder, imgs in folder_imgs.items():
+            img_stats = self.iDevice_DCIM.stat_APPLE_contents(APPLE_folder,
+                                            [img_name for (rel_path, img_name)
+                                                                    in imgs])
+            for rel_path, img_name in imgs:
+                device_stats[rel_path] = img_stats[img_name]
+
+        local_futures = {}
+        device_futures = {}
+        Progress = copy_engine.CopyProgress(copy_engine.scan_sizes(
+                    [self.get_local_path(rel_path) for rel_path in rel_paths]),
+                                            len(rel_paths), desc=" Verify")
+        def hash_local(rel_path):
+            local_digest = file_hash(self.get_local_path(rel_path))
+            Progress.add_bytes(os.path.getsize(self.get_local_path(rel_path)))
+            return local_digest
+
+        with ThreadPoolExecutor(max_workers=LOCAL_HASH_WORKERS) as local_pool, \
+             ThreadPoolExecutor(max_workers=DEVICE_HASH_WORKERS) as device_pool:
+            for rel_path in rel_paths:
+                local_size = os.path.getsize(self.get_local_path(rel_path))
+                if not sources[rel_path]:
+                    self.results[rel_path] = {"status": "missing_on_device"}
+                    Progress.add_bytes(local_size)
+                    continue
+                if device_stats[rel_path][0] != local_size:
+                    self.results[rel_path] = {"status": "size_mismatch",
+                            "local_size": local_size,
+                            "device_size": device_stats[rel_path][0]}
+                    Progress.add_bytes(local_size)
+                    continue
+                local_futures[rel_path] = local_pool.submit(hash_local, rel_path)
+                if not self.get_recorded_digest(rel_path,
+                                                    device_stats[rel_path]):
+                    device_futures[rel_path] = device_pool.submit(
+                        self.hash_device_file, self.get_device_path(rel_path,
+                                                            sources[rel_path]))
+
+            for rel_path, local_future in local_futures.items():
+                try:
+                    local_digest = local_future.result()
+                    if rel_path in device_futures:
+                        device_digest = device_futures[rel_path].result()
+                        digest_source = "device"
+                    else:
+                        device_digest = self.get_recorded_digest(rel_path,
+                                                        device_stats[rel_path])
+                        digest_source = "recorded"
+                except OSError as error:
+                    self.results[rel_path] = {"status": "error",
+                                                        "error": str(error)}
+                else:
+                    self.results[rel_path] = {"status": "ok"
+                                    if local_digest == device_digest
+                                                    else "digest_mismatch",
+                                        "sha1": local_digest,
+                                        "device_sha1": device_digest,
+                                        "device_digest_from": digest_source}
+                Progress.file_done()
+        Progress.close()
+
+        failed = sorted(rel_path for rel_path in rel_paths
+                                if self.results[rel_path]["status"] != "ok")
+        self.write_report()
+        return failed
+
+    def get_recorded_digest(self, rel_path, device_stat):
+        """Returns digest recorded at copy time if device file looks
+        unchanged since (and not doing full check), otherwise None."""
+        record = self.digests.get(rel_path)
+        if self.full or not record or not record.get("sha1"):
+            return None
+        if (record["size"] != device_stat[0]
+                or abs(record["mtime"] - device_stat[1])
+                                        > device_io.DEVICE_MTIME_TOLERANCE):
+            return None
+        return record["sha1"]
+
+    def write_report(self):
+        status_counts = {}
+        for result in self.results.values():
+            status_counts[result["status"]] = (
+                                    status_counts.get(result["status"], 0) + 1)
+        report = {"offload": self.Offload.get_dir_name(),
+                  "device": self.iDevice_DCIM.get_root(),
+                  "time": time.strftime(DATETIME_FORMAT),
+                  "full": self.full,
+                  "counts": status_counts,
+                  "files": self.results}
+        report_path = self.get_report_path()
+        with open(report_path + ".tmp", "w") as report_file:
+            json.dump(report, report_file, indent=1, sort_keys=True)
+        os.replace(report_path + ".tmp", report_path)
+
+    def print_summary(self, failed):
+        print("\nVerified %d file(s) in %s: %d OK, %d failed."
+                % (len(self.results), self.Offload.get_dir_name(),
+                                    len(self.results) - len(failed), len(failed)))
+        for rel_path in failed:
+            print("\t%s: %s" % (rel_path, self.results[rel_path]["status"]))
+        print("Report written to %s" % self.get_report_path())
+
+    def recopy(self, failed):
+        """Copies failed files from device again (over Raw_Offload copy),
+        then verifies them again. Returns rel paths still failing.
+        Files no longer on device can't be re-copied and stay failed."""
+        sources = self.find_sources(failed)
+        folder_imgs = {}  # (APPLE folder, YYYYMM): img names
+        for rel_path in failed:
+            if sources[rel_path]:
+                (dir_month, img_name) = rel_path.split("/")
+                folder_imgs.setdefault((sources[rel_path], dir_month),
+                                                            []).append(img_name)
+        for (APPLE_folder, dir_month), img_names in sorted(folder_imgs.items()):
+            dest_dir = self.Offload.get_APPLE_folder_path(dir_month)
+            img_stats = self.iDevice_DCIM.stat_APPLE_contents(APPLE_folder,
+                                                                    img_names)
+            folder_digests = {}
+            copy_results = self.iDevice_DCIM.copy_APPLE_imgs(APPLE_folder,
+                                img_names, dest_dir, digests=folder_digests)
+            copy_engine.commit([dest_dir])
+            for img_name in img_names:
+                if copy_results[img_name] is None:
+                    self.digests["%s/%s" % (dir_month, img_name)] = {
+                                    "src": APPLE_folder,
+                                    "size": img_stats[img_name][0],
+                                    "mtime": img_stats[img_name][1],
+                                    "sha1": folder_digests.get(img_name)}
+        save_digests(self.RO_root, self.Offload.get_dir_name(), self.digests)
+        # Full re-read of device side for these, since just-recorded digest
+        # came from same read that may have been bad.
+        full = self.full
+        self.full = True
+        try:
+            return self.run(failed)
+        finally:
+            self.full = full
+
+    def __repr__(self):
+        return "OffloadVerifier object for %s" % self.Offload.get_dir_name()
+
+
+def verify_offload(Offload, iDevice_DCIM, full=False):
+    """Verifies an offload, offers to re-copy failures, and prints result.
+    Returns list of rel paths still failing."""
+    Verifier = OffloadVerifier(Offload, iDevice_DCIM, full=full)
+    print("\nVerifying %s against device." % Offload.get_dir_name())
+    failed = Verifier.run()
+    Verifier.print_summary(failed)
+    recopyable = [rel_path for rel_path in failed
+                    if Verifier.results[rel_path]["status"] != "missing_on_device"]
+    if recopyable:
+        recopy_response = policy.ask("verify_recopy", "\nRe-copy %d failed "
+                        "file(s) from device and check again? [Y/N]\n> "
+                        % len(recopyable), subject=Offload.get_full_path())
+        if recopy_response.lower() == "y":
+            still_failed = Verifier.recopy(recopyable)
+            failed = sorted(set(failed) - set(recopyable) | set(still_failed))
+            Verifier.print_summary(failed)
+    return failed
@@ -1,17 +1,33 @@
 import os
-import shutil
 import time
-from tqdm import tqdm
 import subprocess
-import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 from idevice_media_offload.dir_names import CAT_DIRS
+from idevice_media_offload import dir_names
+from idevice_media_offload import change_journal
+from idevice_media_offload import policy
+from idevice_media_offload import preview_cache
+from idevice_media_offload import cat_session
+from idevice_media_offload import dest_index
+from idevice_media_offload import meta_cache
+from idevice_media_offload import cat_suggest
+from idevice_media_offload import auto_rules
+from idevice_media_offload import copy_engine
+from idevice_media_offload import dir_watch
+from idevice_media_offload import event_group
+from idevice_media_offload import media_unit
 
 
 class MediaCatPathError(Exception):
     pass
 
 
+HASH_WORKERS = 4  # Parallel hashing of collision pairs in copy_batch_to_target()
+TRANSFER_WORKERS = 8  # Parallel moves for bulk (rule-based) categorization
+NEAR_DUP_MAX_DISPLAY = 4  # Near-duplicates/burst shots displayed alongside an item
+
+
 # Phase 3: Display pics one by one and prompt for where to copy each.
 # Have an option to ignore photo (not categorize and copy anywhere).
 # Check for name collisions in target directory.
@@ -22,19 +38,55 @@ class Categorizer(object):
     def __init__(self, buffer_root):
         self.buffer_root = buffer_root
         self.manual_dir_list = []
+        # Caches, journals, and history kept next to buffer in BU root.
+        self.state_dir = os.path.dirname(os.path.normpath(self.buffer_root))
+        # Downscaled previews displayed in place of originals.
+        self.Previews = preview_cache.PreviewCache(self.buffer_root)
+        self.Previews.prune()
+        # Journal of photo_transfer session in progress (see cat_session).
+        self.Session = None
+        # Live listing of buffer during photo_transfer (see dir_watch). None
+        # if inotify unavailable.
+        self.BufferWatch = None
+        # Buffer file name: MediaUnit it belongs to, built when
+        # photo_transfer lists buffer.
+        self.buffer_units = {}
+        # Every dir used in this or earlier sessions, for keyword lookup.
+        self.DestIndex = dest_index.DestIndex(self.state_dir)
+        for cat_path in CAT_DIRS.values():
+            self.DestIndex.add(cat_path)
+        # Destination suggestions learned from past decisions.
+        self.MetaCache = meta_cache.MetaCache(self.state_dir)
+        self.Suggester = cat_suggest.CatSuggester(self.state_dir)
+        # Perceptual hashes for grouping near-duplicates. Loaded when first
+        # needed (see get_near_dups()). Can be turned off in dir_names.
+        self.NearDups = None
+        self.find_near_dups = getattr(dir_names, "CAT_NEAR_DUPS", True)
+        # Suggestions at least this confident (0-1) are applied without
+        # prompting. None (default) means always prompt.
+        self.auto_route_confidence = getattr(dir_names,
+                                            "CAT_AUTO_ROUTE_CONFIDENCE", None)
+        # Rules for bulk routing in run_auto_cat. Rule file location can be
+        # set in dir_names, otherwise kept next to buffer.
+        self.Rules = auto_rules.RuleSet(getattr(dir_names, "CAT_RULES_FILE",
+                    os.path.join(self.state_dir, auto_rules.RULES_FILE_NAME)))
 
         # Display cat buffer
-        display_dir(self.buffer_root)
+        if not policy.is_unattended():
+            display_dir(self.buffer_root)
 
     def add_manual_dir(self, dir_path):
         # If it's already been added, don't add duplicate.
         if dir_path not in self.manual_dir_list:
             self.manual_dir_list.append(dir_path)
             self.manual_dir_list.sort()
+            self.DestIndex.add(dir_path)
+            if self.Session:
+                self.Session.record_manual_dir(dir_path)
 
     def find_stored_dir(self, keyword, silent=False):
-        """Retrieve directory path from preloaded list or from previously-used
-        manual paths entered in this session."""
+        """Retrieve directory path from preloaded list or from destination
+        index (manual paths entered in this or earlier sessions)."""
         # First see if keyword is itself a path to prevent finding a "match"
         # in the form of a longer path containing this path as a substring.
         if os.path.isdir(keyword):
@@ -44,31 +96,32 @@ class Categorizer(object):
         if CAT_DIRS.get(keyword):
             return CAT_DIRS[keyword]
 
-        # Then see if keyword is a substring of a previously-entered manual dir.
-        # Keyword referencing manually-entered path must be at least three
-        # characters long
+        # Then look keyword up in destination index (substring of a stored dir
+        # or prefix of words in it). Keyword referencing stored path must be
+        # at least three characters long
         if len(keyword) < 3:
             if not silent:
                 print("Input keyword for referencing stored dirs must be >3 "
                                                                 "characters\n")
             return None
 
-        dirs_found = []
-        for dir_path in self.manual_dir_list:
+        for dir_path in self.DestIndex.get_paths():
             if keyword.lower() == dir_path.lower():
                 # If an already-stored path is entered again, don't print.
                 return keyword
-            if keyword.lower() in dir_path.lower():
-                dirs_found.append(dir_path)
+        (dir_found, dirs_found) = self.DestIndex.resolve(keyword)
 
-        if len(dirs_found) == 1:
+        if dir_found:
+            # Only match, or used far more (or more recently) than others.
             if not silent: # Suppress duplicate output when called twice.
-                print("Interpreted '%s' as %s." % (keyword, dirs_found[0]))
-            return dirs_found[0]
+                print("Interpreted '%s' as %s." % (keyword, dir_found))
+            return dir_found
         elif len(dirs_found) > 1:
             # If more than one path found found with keyword (ambiguous),
             # inform user and don't return a path.
             print("Multiple matches in stored directories. Be more specific.")
+            for dir_path in dirs_found[:dest_index.MAX_LISTED_MATCHES]:
+                print("\t%s" % dir_path)
             return None
         elif len(dirs_found) == 0:
             # If 0 paths found with keyword, don't return a path.
@@ -77,58 +130,127 @@ class Categorizer(object):
             return None
 
     def run_auto_cat(self):
-        """Function to automatically categorize st media that user puts in
-        st_buffer.
-        Later may have other auto categorizing groups, but for now just st."""
-
-        # Initialize st buffer directory to automatically categorize from.
-        # Program will automatically categorize by date and move to st root.
-        st_buffer_path = os.path.join(self.buffer_root, "st_buffer/")
-        if not os.path.exists(st_buffer_path):
-            os.mkdir(st_buffer_path)
-
-        # Display cat buffer in new window.
-        display_dir(st_buffer_path)
-
-        # Prompt to move stuff in bulk before looping through img display.
-        input("\nDo any mass copies from categorization buffer now (e.g. "
-                "into st_buffer) before proceeding."
-                "\nPress Enter when ready to continue Cat program.")
-
-        st_buffer_imgs = os.listdir(st_buffer_path)
-        if st_buffer_imgs:
-            st_buffer_imgs.sort()
-
-            # Loop through st_buffer categorize.
-            print("\nCategorizing st_buffer media now. Progress:")
-            for img in tqdm(st_buffer_imgs):
-                img_path = os.path.join(st_buffer_path, img)
-                if not os.path.isfile(img_path):
-                    # Ignore. Shouldn't happen, but handling just in case.
-                    continue
-
-                target_dir = self.get_target_dir(img_path, "st")
-                if target_dir:
-                    copy_to_target(img_path, target_dir, move_op=True)
-                else:
-                    # If user chooses to discard img, None is returned by
-                    # get_target_dir. Delete image from buffer.
-                    os.remove(img_path)
-
-            print("Successfully categorized media from st_buffer.")
+        """Function to automatically categorize media using routing rules
+        (see auto_rules). Rules for an auto-buffer (e.g. st_buffer) take
+        media user puts in that Cat_Buffer subfolder. Rules with no buffer
+        take matching items from Cat_Buffer itself, leaving the rest for
+        photo_transfer."""
+
+        # Initialize auto-buffer directories to automatically categorize from.
+        # e.g. st media automatically categorized by date and moved to st root.
+        buffer_names = self.Rules.get_buffers()
+        for buffer_name in buffer_names:
+            auto_buffer_path = os.path.join(self.buffer_root, buffer_name + "/")
+            if not os.path.exists(auto_buffer_path):
+                os.mkdir(auto_buffer_path)
+
+        Policy = policy.get_active_policy()
+        if Policy and Policy.has_answer("buffer_prep"):
+            # Unattended. Categorize whatever is already in auto-buffers.
+            Policy.get_answer("buffer_prep", subject=self.buffer_root)
         else:
-            print("Nothing in st_buffer.")
-
+            # Display auto-buffers in new windows.
+            for buffer_name in buffer_names:
+                display_dir(os.path.join(self.buffer_root, buffer_name + "/"))
+
+            # Prompt to move stuff in bulk before looping through img display.
+            input("\nDo any mass copies from categorization buffer now (e.g. "
+                    "into %s) before proceeding."
+                    "\nPress Enter when ready to continue Cat program."
+                                                    % ", ".join(buffer_names))
+
+        for buffer_name in buffer_names:
+            self.route_buffer(buffer_name)
+        if self.Rules.get_rules(""):
+            self.route_buffer("")
+
+    def route_buffer(self, buffer_name):
+        """Moves every item in auto-buffer buffer_name ("" for Cat_Buffer
+        itself) that a rule matches, in one pass. All missing destination
+        folders made up front (each parent listed once), then moves run in
+        parallel batches. Collisions with earlier runs are reviewed together
+        at end."""
+        buffer_path = os.path.join(self.buffer_root, buffer_name)
+        buffer_label = buffer_name or os.path.basename(
+                                            os.path.normpath(self.buffer_root))
+        (routes, unmatched) = self.Rules.route(buffer_path, buffer_name,
+                                                                self.MetaCache)
+        if not routes:
+            if buffer_name and not unmatched:
+                print("Nothing in %s." % buffer_name)
+            elif buffer_name:
+                print("Nothing in %s matched a rule (%d item(s) left there)."
+                                            % (buffer_name, len(unmatched)))
+            return
+
+        parent_listings = {}  # parent dir: set of names in it
+        rule_counts = {}  # rule name: number of items routed by it
+        copy_jobs = []
+        for AutoRule, img_path, dest_dir in routes:
+            dest_parent = os.path.dirname(os.path.normpath(dest_dir))
+            if dest_parent not in parent_listings:
+                parent_listings[dest_parent] = set(os.listdir(dest_parent))
+            dest_name = os.path.basename(os.path.normpath(dest_dir))
+            if dest_name not in parent_listings[dest_parent]:
+                os.mkdir(dest_dir)
+                change_journal.record_created(dest_dir)
+                parent_listings[dest_parent].add(dest_name)
+            rule_counts[AutoRule.get_name()] = (
+                                    rule_counts.get(AutoRule.get_name(), 0) + 1)
+            copy_jobs.append((img_path, dest_dir, None, True))
+
+        print("\nCategorizing %s media now (%d item(s)):" % (buffer_label,
+                                                                len(copy_jobs)))
+        for rule_name in sorted(rule_counts):
+            print("\t%s:\t%d" % (rule_name, rule_counts[rule_name]))
+        copy_batch_to_target(copy_jobs, workers=TRANSFER_WORKERS)
+        copy_engine.commit()
+        if buffer_name and unmatched:
+            print("%d item(s) in %s matched no rule. Left there."
+                                                % (len(unmatched), buffer_name))
+        print("Successfully categorized media from %s." % buffer_label)
 
     def photo_transfer(self, start_point=""):
         """Master function to display images in buffer and prompt user
         where each should be copied. Execute copy. Start_point can be specified
-        (as img name) to skip processing earlier imgs."""
+        (as img name) to skip processing earlier imgs.
+        Buffer is listed once. A cursor moves through the listing, staying on
+        the same image for '&' and invalid input and jumping ahead for '+NN'."""
 
         # local buffer to be categorized manually
         CAT_DIRS['u'] = os.path.join(self.buffer_root, "manual_" +
                                                 time.strftime('%Y-%m-%d') + '/')
 
+        # Decisions get journaled and applied in background.
+        self.Session = cat_session.CatSession(self.buffer_root,
+                                                        self.apply_decision)
+        resume_state = None
+        if self.Session.has_unfinished():
+            resume_state = self.Session.load_unfinished()
+            resume_response = input("\nFound unfinished CAT session started "
+                    "%s (stopped at %s, %d decision(s) not yet applied, %d "
+                    "collision(s) not yet reviewed).\nResume it? [Y/N]\n> "
+                    % (resume_state["started"], resume_state["position"],
+                            len(resume_state["pending"]),
+                                            len(resume_state["conflicts"])))
+            if resume_response.lower() != "y":
+                resume_state = None
+        self.Session.start(resume_state)
+
+        # Names moved or deleted this session (e.g. JPG moved along with its
+        # HEIC) so they're skipped silently when cursor reaches them.
+        handled_imgs = set()
+        if resume_state:
+            for manual_dir in resume_state["manual_dirs"]:
+                self.add_manual_dir(manual_dir)
+            if resume_state["position"]:
+                start_point = resume_state["position"]
+            for decision in resume_state["pending"]:
+                handled_imgs.update(os.path.basename(copy_job[0]) for copy_job
+                                        in decision["copy_jobs"] if copy_job[3])
+                handled_imgs.update(os.path.basename(delete_path)
+                                    for delete_path in decision["delete_paths"])
+
         print("\nCategorizing images from buffer:\n\t%s\n" % self.buffer_root)
         # Print dict of directory mappings
         print("Target directories available (standard):")
@@ -138,71 +260,208 @@ class Categorizer(object):
         print("\nTarget directories available (manual):")
         for dir in self.manual_dir_list:
             print(("\t\t\t%s" % dir).expandtabs(2))
+        print("(Any part of a dir used before also works. Tab completes.)")
+        dest_index.enable_completion(self.DestIndex, CAT_DIRS.keys())
 
         print("\n(Append '&' to first choice if multiple destinations needed)\n"
                 "(Append '+' followed by a two-digit number to use same dest "
-                        "folder for subsequent [number] of pics)")
+                        "folder for subsequent [number] of pics)\n"
+                "(Append '@' to send rest of pic's event (pics taken without "
+                                    "a long break) to same dest folder)")
 
         # Initialize manual-sort directory
         if not os.path.exists(CAT_DIRS['u']):
             os.mkdir(CAT_DIRS['u'])
 
-        buffered_imgs = os.listdir(self.buffer_root)
+        # Partial copies left by a crash aren't real contents.
+        buffered_imgs = copy_engine.clean_temp_files(self.buffer_root)
         buffered_imgs.sort()
+        # Everything in buffer when listed (incl. anything before start point)
+        # so later additions can be told apart.
+        listed_imgs = set(buffered_imgs)
+        # Files from same capture (HEIC and its JPG, Live Photo video, edited
+        # versions) handled as one item.
+        self.buffer_units = media_unit.map_units(media_unit.build_units(
+                                                buffered_imgs, self.buffer_root))
+        # Watch buffer so items renamed, deleted, or added outside program
+        # during session are followed without re-listing.
+        self.BufferWatch = dir_watch.watch(self.buffer_root)
         if start_point:
             # If a start point is specified, truncate earlier images.
-            start_index = buffered_imgs.index(start_point)
-            buffered_imgs = buffered_imgs[start_index:]
-
-        for img in buffered_imgs:
+            # Start point may itself be gone if resuming.
+            buffered_imgs = [buffered_img for buffered_img in buffered_imgs
+                                                if buffered_img >= start_point]
+        # Listed but before start point. Kept out if buffer gets re-read.
+        skipped_imgs = listed_imgs - set(buffered_imgs)
+        # Generate previews and destination suggestions for whole buffer in
+        # background. One per media unit.
+        display_paths = list(dict.fromkeys(self.get_display_path(os.path.join(
+                                self.buffer_root, img)) for img in buffered_imgs))
+        self.Previews.fill(display_paths)
+        # Group by capture time. Reads metadata for whole buffer in one
+        # batched pass, so done before suggestion scoring (which then finds
+        # it all cached).
+        events = event_group.group_by_time(display_paths, self.MetaCache,
+                    getattr(dir_names, "CAT_BURST_GAP", event_group.BURST_GAP),
+                    getattr(dir_names, "CAT_EVENT_GAP", event_group.EVENT_GAP))
+        self.Suggester.score_in_background(display_paths, self.MetaCache)
+        event_paths_of = {}  # display path: all display paths in its event
+        for event in events:
+            event_paths = [img_path for burst in event for img_path in burst]
+            for img_path in event_paths:
+                event_paths_of[img_path] = event_paths
+        # Near-duplicates (repeated screenshots, missed edits) and bursts are
+        # shown together and one decision applies to the whole group.
+        related_groups = [burst for event in events for burst in event
+                                                            if len(burst) > 1]
+        NearDups = self.get_near_dups()
+        if NearDups:
+            related_groups += NearDups.find_clusters(display_paths)
+        related_paths_of = merge_groups(related_groups)  # display path: group
+        if related_paths_of:
+            print("Found %d group(s) of bursts or near-duplicates (%d items). "
+                        "Each group shown and categorized together.\n"
+                        % (len(set(tuple(group) for group
+                                                in related_paths_of.values())),
+                                                    len(related_paths_of)))
+
+        cursor = 0
+        while True:
+            if cursor >= len(buffered_imgs):
+                # Pick up anything added to buffer during session.
+                new_imgs = self.get_new_buffer_imgs(listed_imgs
+                                            | set(buffered_imgs) | handled_imgs)
+                if not new_imgs:
+                    break
+                listed_imgs.update(new_imgs)
+                self.buffer_units.update(media_unit.map_units(
+                        media_unit.build_units(new_imgs, self.buffer_root)))
+                print("\n%d item(s) added to buffer during session."
+                                                                % len(new_imgs))
+                buffered_imgs += new_imgs
+                new_paths = list(dict.fromkeys(self.get_display_path(
+                            os.path.join(self.buffer_root, img)) for img in new_imgs))
+                self.Previews.fill(new_paths)
+                self.Suggester.score_in_background(new_paths, self.MetaCache)
+            img = buffered_imgs[cursor]
             img_path = os.path.join(self.buffer_root, img)
+            self.Previews.prefetch([self.get_display_path(os.path.join(
+                                        self.buffer_root, next_img)) for next_img
+                in buffered_imgs[cursor+1:cursor+1+preview_cache.PREVIEW_PREFETCH_COUNT]])
 
-            if os.path.isdir(img_path):
+            if img in handled_imgs:
+                cursor += 1
+                continue
+            elif os.path.isdir(img_path):
                 # Ignore any manual sort folder left over from previous offload.
+                cursor += 1
                 continue
             elif not os.path.exists(img_path):
+                renamed_path = self.follow_rename(img_path)
+                if renamed_path != img_path:
+                    # Renamed outside program. Process under new name.
+                    print("%s renamed to %s outside program." % (img,
+                                            os.path.basename(renamed_path)))
+                    buffered_imgs[cursor] = os.path.basename(renamed_path)
+                    continue
                 # Handle case where user manually deletes img in buffer outside
                 # of program.
                 print("%s skipped - not found in Cat buffer." % img)
+                cursor += 1
                 continue
 
-            if os.path.splitext(img)[-1].upper() == ".HEIC":
-                # Can't display these, but they should have already been
+            # Paths that go wherever the displayed image goes: every file of
+            # img's media unit still in buffer, one that can be displayed
+            # first (e.g. JPG made from HEIC in ORG step).
+            img_group = self.get_unit_group(img, handled_imgs)
+            if (os.path.splitext(img_group[0])[-1].upper()
+                                            not in media_unit.DISPLAY_EXTS
+                    and any(os.path.splitext(group_path)[-1].upper() == ".HEIC"
+                                                for group_path in img_group)):
+                # Can't display HEIC, but it should have already been
                 # converted during org step.
-                # Look for JPG version.
-                jpg_path = os.path.splitext(img_path)[0] + ".jpg"
-                if os.path.exists(jpg_path):
-                    dup_heif_path = img_path
-                    img_path = jpg_path
-                    # Will sub in jpg file to use for determining where to
-                    # transfer. Then apply the transfer to both.
-
-                    mod_heif_path = dup_heif_path.replace("IMG_", "IMG_E")
-                    if not os.path.exists(mod_heif_path) or mod_heif_path==dup_heif_path:
-                        # IMG_ --> IMG_E sub may do nothing w/ nonstandard
-                        # naming (e.g. YYYY-MM-DD_VNUF5899.HEIC)
-                        mod_heif_path = None
-                else:
-                    dup_heif_path = None
-                    print("Cannot find associated JPG for %s. Storing in "
-                                                 "manual-sort buffer '%s'"
-                                       % (img, os.path.basename(CAT_DIRS['u'])))
-                    # Automatically move to manual-sort dir. May change this
-                    # to fall through to prompt (w/o img display) and allow user
-                    # to decide.
-                    copy_to_target(img_path, CAT_DIRS['u'])
-                    continue
-            else:
-                dup_heif_path = None
+                print("Cannot find associated JPG for %s. Storing in "
+                                             "manual-sort buffer '%s'"
+                                   % (img, os.path.basename(CAT_DIRS['u'])))
+                # Automatically move to manual-sort dir. May change this
+                # to fall through to prompt (w/o img display) and allow user
+                # to decide.
+                self.Session.submit(copy_jobs=[(group_path, CAT_DIRS['u'],
+                                        None, False) for group_path in img_group])
+                handled_imgs.update(os.path.basename(group_path)
+                                                    for group_path in img_group)
+                cursor += 1
+                continue
+
+            # Rest of burst/near-duplicate group (with any HEIC originals)
+            # goes wherever this item goes.
+            dup_paths = [dup_path for dup_path
+                            in related_paths_of.get(img_group[0], [])
+                            if dup_path not in img_group
+                            and os.path.basename(dup_path) not in handled_imgs
+                            and os.path.exists(dup_path)]
+            for dup_path in dup_paths:
+                img_group += self.get_source_paths(dup_path)
+            # Rest of event, sent along if '@' appended to dest.
+            event_rest = [event_path for event_path
+                            in event_paths_of.get(img_group[0], [])
+                            if event_path not in img_group
+                            and os.path.basename(event_path) not in handled_imgs
+                            and os.path.exists(event_path)]
+
+            self.Session.record_position(img)
+            suggestion = self.Suggester.get_suggestion(img_group[0])
+            if self.Suggester.can_auto_route(suggestion,
+                                                self.auto_route_confidence):
+                print("Auto-routed %s to %s (%d%% confident)." % (img,
+                                    suggestion[0], round(suggestion[1] * 100)))
+                self.record_decision(img_group[0], suggestion[0])
+                self.Session.submit(copy_jobs=[(group_path, suggestion[0], None,
+                                                True) for group_path in img_group])
+                handled_imgs.update(os.path.basename(group_path)
+                                                    for group_path in img_group)
+                cursor += 1
+                continue
+
+            if dup_paths:
+                print("\n%s shown with %d burst shot(s)/near-duplicate(s). "
+                            "Choice applies to all:" % (os.path.basename(
+                                            img_group[0]), len(dup_paths)))
+                for dup_path in dup_paths:
+                    print("\t%s" % os.path.basename(dup_path))
+                for dup_path in dup_paths[:NEAR_DUP_MAX_DISPLAY]:
+                    self.display_preview(dup_path)
+            if event_rest:
+                print("\nPart of event %s with %d more item(s) to categorize. "
+                        "Append '@' to send them all to same dest."
+                        % (event_group.describe_event(event_paths_of[
+                            img_group[0]], self.MetaCache), len(event_rest)))
 
             # Show image and prompt for location.
             try:
-                target_dir = self.get_target_dir(img_path)
+                target_dir = self.get_target_dir(img_group[0])
             except MediaCatPathError:
-                # Runs if file renamed by user during get_target_dir() prompt loop.
-                print("Restarting. Name of target img may have changed.\n")
-                self.photo_transfer()
-                return
+                # Runs if file renamed by user during get_target_dir() prompt
+                # loop and there's no buffer watch to follow the rename. Only
+                # case buffer gets re-read. Resume at same spot.
+                print("Re-reading buffer. Name of target img may have changed.\n")
+                # Everything not yet handled, since a renamed img may now sort
+                # before the one shown.
+                reread_imgs = sorted(copy_engine.clean_temp_files(
+                                                            self.buffer_root))
+                listed_imgs.update(reread_imgs)
+                self.buffer_units = media_unit.map_units(media_unit.build_units(
+                                                reread_imgs, self.buffer_root))
+                buffered_imgs = [buffered_img for buffered_img in reread_imgs
+                                        if buffered_img not in handled_imgs
+                                        and buffered_img not in skipped_imgs]
+                cursor = 0
+                continue
+
+            # Group items may have been renamed during prompt (followed by
+            # get_target_dir() through buffer watch).
+            img_group = [self.follow_rename(group_path)
+                                                for group_path in img_group]
 
             # Have to implement (sometimes redundant) check on directory
             # existence because stored directories might have gone stale (e.g.
@@ -211,65 +470,117 @@ class Categorizer(object):
             if target_dir == None:
                 # If user chooses to discard img, None is returned by
                 # get_target_dir. Delete image from buffer.
-                os.remove(img_path)
-                if dup_heif_path:
-                    os.remove(dup_heif_path)
-                    if mod_heif_path:
-                        os.remove(mod_heif_path)
-                continue
+                self.Session.submit(delete_paths=img_group)
+                handled_imgs.update(os.path.basename(group_path)
+                                                    for group_path in img_group)
+                cursor += 1
 
             elif target_dir[0] == '*' and os.path.isdir(target_dir[1:]):
                 # If get_target_dir detected the trailing special character '&',
                 # then after copying image into one place, the user should be
                 # prompted again w/ same photo to put somewhere else.
-                copy_to_target(img_path, target_dir[1:])
-                if dup_heif_path:
-                    copy_to_target(dup_heif_path, target_dir[1:])
-                    if mod_heif_path:
-                        copy_to_target(mod_heif_path, target_dir[1:])
-                self.photo_transfer(start_point=img)
-                return
+                self.record_decision(img_group[0], target_dir[1:])
+                self.Session.submit(copy_jobs=[(group_path, target_dir[1:],
+                                        None, False) for group_path in img_group])
+                # Cursor stays put.
 
             elif target_dir[0] == '!' and os.path.isdir(target_dir[3:]):
-                copy_to_target(img_path, target_dir[3:], move_op=True)
-                if dup_heif_path:
-                    copy_to_target(dup_heif_path, target_dir[3:], move_op=True)
-                    if mod_heif_path:
-                        copy_to_target(mod_heif_path, target_dir[3:], move_op=True)
+                copy_jobs = [(group_path, target_dir[3:], None, True)
+                                                    for group_path in img_group]
+                batch_names = [os.path.basename(group_path)
+                                                    for group_path in img_group]
 
                 # If get_target_dir detected the trailing special character '+' and
                 # a two-digit number, copy multiple successive images to same place.
+                # Taken from listing already in memory. Counted in media units.
                 additional_copies = int(target_dir[1:3])
-                re_buffered_imgs = os.listdir(self.buffer_root)
-                re_buffered_imgs.sort()
-                for extra_img in re_buffered_imgs[:additional_copies]:
+                extra_units = []
+                for extra_img in buffered_imgs[cursor+1:]:
+                    if len(extra_units) >= additional_copies:
+                        break
                     extra_img_path = os.path.join(self.buffer_root, extra_img)
-                    copy_to_target(extra_img_path, target_dir[3:], move_op=True)
-
-                self.photo_transfer()
-                return
+                    if (extra_img in handled_imgs or extra_img in batch_names
+                                            or not os.path.isfile(extra_img_path)):
+                        continue
+                    extra_group = self.get_unit_group(extra_img,
+                                                handled_imgs.union(batch_names))
+                    copy_jobs += [(extra_path, target_dir[3:], None, True)
+                                                for extra_path in extra_group]
+                    batch_names += [os.path.basename(extra_path)
+                                                for extra_path in extra_group]
+                    extra_units.append(extra_group[0])
+                # Items moved along count as decisions for that dest too.
+                self.record_decision(img_group[0], target_dir[3:])
+                for extra_path in extra_units:
+                    self.record_decision(extra_path, target_dir[3:])
+                self.Session.submit(copy_jobs=copy_jobs)
+                handled_imgs.update(batch_names)
+                cursor += 1
+
+            elif target_dir[0] == '@' and os.path.isdir(target_dir[1:]):
+                # If get_target_dir detected the trailing special character
+                # '@', rest of event goes to same place.
+                copy_jobs = [(group_path, target_dir[1:], None, True)
+                                                    for group_path in img_group]
+                self.record_decision(img_group[0], target_dir[1:])
+                for event_path in event_rest:
+                    if os.path.basename(event_path) in handled_imgs:
+                        # Already brought in with an earlier event item.
+                        continue
+                    self.record_decision(event_path, target_dir[1:])
+                    event_group_paths = self.get_source_paths(event_path)
+                    for related_path in related_paths_of.get(event_path, []):
+                        if related_path not in event_group_paths:
+                            event_group_paths += self.get_source_paths(related_path)
+                    for event_group_path in event_group_paths:
+                        if (event_group_path not in [copy_job[0] for copy_job
+                                                                in copy_jobs]
+                                        and os.path.exists(event_group_path)):
+                            copy_jobs.append((event_group_path, target_dir[1:],
+                                                                    None, True))
+                print("Sending %d item(s) from event to %s." % (len(copy_jobs),
+                                                                target_dir[1:]))
+                self.Session.submit(copy_jobs=copy_jobs)
+                handled_imgs.update(os.path.basename(copy_job[0])
+                                                    for copy_job in copy_jobs)
+                cursor += 1
 
             elif os.path.isdir(target_dir):
                 # Execute the move from buffer to appropriate dir.
-                copy_to_target(img_path, target_dir, move_op=True)
-                if dup_heif_path:
-                    copy_to_target(dup_heif_path, target_dir, move_op=True)
-                    if mod_heif_path:
-                        copy_to_target(mod_heif_path, target_dir, move_op=True)
+                self.record_decision(img_group[0], target_dir)
+                self.Session.submit(copy_jobs=[(group_path, target_dir, None,
+                                                True) for group_path in img_group])
+                handled_imgs.update(os.path.basename(group_path)
+                                                    for group_path in img_group)
+                cursor += 1
 
             else:
                 # Path returned by get_target_dir isn't a valid directory.
                 print("Invalid path specified. Path of stored dir may have "
                                                                 "changed.\n")
-                self.photo_transfer()
-                return
-
+                # Prompt again for same image.
+
+        print("\nFinishing transfers.")
+        self.Session.wait()
+        # Collisions found in background all reviewed now (journaled until
+        # then so they survive an interrupted session).
+        review_conflicts(self.Session.get_conflicts())
+        self.Session.record_conflicts_reviewed()
+        errors = self.Session.finish()
+        self.Session = None
+        if self.BufferWatch:
+            self.BufferWatch.close()
+            self.BufferWatch = None
+        for decision, error in errors:
+            print("Transfer failed (will be retried when session resumed): "
+                                                                "%s" % error)
 
         while os.listdir(CAT_DIRS['u']):
-            sort_folder_response = input("\nToday's manual-sort folder "
-                "populated.\nCheck folder(s) for any uncategorized pictures "
-                    "and categorize them manually.\nPress Enter to continue "
-                                                        "or 'q' to quit.\n> ")
+            sort_folder_response = policy.ask("manual_sort", "\nToday's "
+                "manual-sort folder populated.\nCheck folder(s) for any "
+                "uncategorized pictures and categorize them manually.\nPress "
+                        "Enter to continue or 'q' to quit.\n> ",
+                                                    subject=CAT_DIRS['u'])
             if sort_folder_response.lower() == 'q':
                 return
             else:
@@ -282,9 +593,10 @@ class Categorizer(object):
             if "manual_" in other_folder:
                 other_folder_path = os.path.join(self.buffer_root, other_folder)
                 while os.listdir(other_folder_path):
-                    other_folder_response = input("\nAt least one manual-sort "
-                        "folder in the buffer is populated.\nCategorize content "
-                        "then press Enter to continue or 'q' to quit.\n> ")
+                    other_folder_response = policy.ask("manual_sort", "\nAt "
+                        "least one manual-sort folder in the buffer is "
+                        "populated.\nCategorize content then press Enter to "
+                        "continue or 'q' to quit.\n> ", subject=other_folder_path)
                     if other_folder_response.lower() == 'q':
                         return
                     else:
@@ -304,13 +616,31 @@ class Categorizer(object):
         while True:
             if not os.path.exists(img_path):
                 # If item renamed after first prompt, this block runs.
-                # Issue will be handled automatically in caller method above.
-                raise MediaCatPathError()
+                # Follow rename if buffer watched, and prompt again for item
+                # under new name. Otherwise handled in caller method above.
+                renamed_path = self.follow_rename(img_path)
+                if renamed_path == img_path or not os.path.exists(renamed_path):
+                    raise MediaCatPathError()
+                print("%s renamed to %s outside program." % (image_name,
+                                            os.path.basename(renamed_path)))
+                img_path = renamed_path
+                image_name = os.path.basename(img_path)
+                target_input = ""
+                continue
             if not target_input:
                 # Runs first time and if user enters nothing at prompt
-                display_photo(img_path)
+                self.display_preview(img_path)
+                suggestion = self.Suggester.get_suggestion(img_path)
+                if suggestion:
+                    print("\nSuggested: %s (%d%% confident). Enter '.' to "
+                        "accept." % (suggestion[0], round(suggestion[1] * 100)))
                 target_input = input("\nEnter target location for %s (or 'n' "
                                             "for no transfer)\n> " % image_name)
+                if target_input == '.' and suggestion:
+                    target_input = suggestion[0]
+                elif target_input == '.':
+                    print("No suggestion for this item.")
+                    target_input = ""
                 continue
             elif target_input == 'n':
                 return None
@@ -326,6 +656,16 @@ class Categorizer(object):
                 # pre-pend '*' to returned path to indicate special case to
                 # caller.
                 return '*' + self.get_target_dir(img_path, target_input[:-1])
+            elif ( (target_input[-1] == '@')
+                   and target_input[:-1] != 'st'
+                   and (self.find_stored_dir(target_input[:-1], silent=True)
+                        or os.path.isdir(target_input[:-1])) ):
+                # If the '@' special character invoked, rest of image's event
+                # goes to same dest. ('st' needs a folder per date, so st
+                # items go through st_buffer instead.)
+                # pre-pend '@' to returned path to indicate special case to
+                # caller.
+                return '@' + self.get_target_dir(img_path, target_input[:-1])
             elif ( len(target_input) >= 3
                    and target_input[-3] == '+'
                    and (self.find_stored_dir(target_input[:-3], silent=True)
@@ -351,105 +691,342 @@ class Categorizer(object):
                 continue
 
 
+    def follow_rename(self, img_path):
+        # Where buffer item is now, if renamed during session. Unchanged if
+        # not renamed or buffer not watched.
+        if self.BufferWatch:
+            return self.BufferWatch.follow_rename(img_path)
+        return img_path
+
+    def get_new_buffer_imgs(self, listed_imgs):
+        """Returns sorted names of items in buffer not in listed_imgs (added
+        since buffer listed). Empty if buffer not watched."""
+        if not self.BufferWatch:
+            return []
+        return [img for img in self.BufferWatch.get_names() or []
+                        if img not in listed_imgs and os.path.isfile(
+                                            os.path.join(self.buffer_root, img))]
+
+    def record_decision(self, img_path, target_dir):
+        # Feeds destination index ranking and suggestion model. Called before
+        # decision submitted, while item still in buffer to read metadata from.
+        self.DestIndex.record_use(target_dir)
+        img_meta = self.MetaCache.get(img_path)
+        self.Suggester.record(img_path, target_dir,
+                                cat_suggest.get_features(img_path, img_meta))
+
+    def apply_decision(self, copy_jobs, delete_paths):
+        """Carries out a decision from photo_transfer (runs in CatSession
+        worker). Returns any collisions still needing review."""
+        for delete_path in delete_paths:
+            if os.path.exists(delete_path):
+                os.remove(delete_path)
+                copy_engine.track_rename(delete_path, None)
+                change_journal.record_deleted(delete_path)
+        return copy_batch_to_target(copy_jobs, defer_conflicts=True)
+
+    def get_near_dups(self):
+        """Returns NearDupIndex, or None if grouping turned off or NumPy
+        not available."""
+        if self.NearDups is None and self.find_near_dups:
+            try:
+                # Imported here so only runs that group near-duplicates
+                # need NumPy.
+                from idevice_media_offload import near_dup
+            except ImportError as import_error:
+                print("Near-duplicate grouping skipped: %s" % import_error)
+                self.find_near_dups = False
+                return None
+            self.NearDups = near_dup.NearDupIndex(self.state_dir)
+        return self.NearDups
+
+    def get_display_path(self, img_path):
+        # Media unit displayed through one file (HEICs using JPG version made
+        # in ORG step).
+        Unit = self.buffer_units.get(os.path.basename(img_path))
+        if Unit and Unit.get_display_path():
+            return Unit.get_display_path()
+        return img_path
+
+    def get_source_paths(self, display_path):
+        """Returns display path plus rest of its media unit still in buffer
+        (reverse of get_display_path())."""
+        Unit = self.buffer_units.get(os.path.basename(display_path))
+        if not Unit:
+            return [display_path]
+        return [display_path] + [unit_path for unit_path in Unit.get_paths()
+                        if unit_path != display_path and os.path.exists(unit_path)]
+
+    def get_unit_group(self, img_name, handled_imgs):
+        """Returns paths of img's media unit not yet handled and still in
+        buffer, displayable one (if any) first."""
+        img_path = os.path.join(self.buffer_root, img_name)
+        Unit = self.buffer_units.get(img_name)
+        if not Unit:
+            return [img_path]
+        unit_paths = [unit_path for unit_path in Unit.get_paths()
+                        if os.path.basename(unit_path) not in handled_imgs
+                        and os.path.exists(unit_path)] or [img_path]
+        display_paths = [unit_path for unit_path in unit_paths
+                            if os.path.splitext(unit_path)[-1].upper()
+                                                    in media_unit.DISPLAY_EXTS]
+        if display_paths:
+            unit_paths.remove(display_paths[0])
+            unit_paths.insert(0, display_paths[0])
+        return unit_paths
+
+    def display_preview(self, img_path):
+        """Displays cached preview of img if one can be made, otherwise the
+        original."""
+        preview_path = self.Previews.get_preview(img_path)
+        display_photo(preview_path or img_path)
+
     def get_st_target_dir(self, img_path):
         """Function to find correct directory (or make new) within dated
         heirarchy based on image mod date. Return resulting path."""
 
-        img_name = os.path.basename(img_path)
-        img_date = img_name.split('_')[0]
+        img_date = get_st_date(os.path.basename(img_path))
 
         st_root = CAT_DIRS['st']
         st_img_path = os.path.join(st_root, img_date)
 
         if not img_date in os.listdir(st_root):
             os.mkdir(st_img_path)
+            change_journal.record_created(st_img_path)
 
         return st_img_path
 
 
-def copy_to_target(img_path, target_dir, new_name=None, move_op=False):
-    """Function to copy img to target directory with collision detection.
-    If 'move_op' param specified, delete img from current dir."""
-
-    if os.path.isdir(img_path):
-        return
-    img = os.path.basename(img_path)
-
-    if not new_name:
-        new_name = img
+def merge_groups(groups):
+    """Merges groups (lists of paths) sharing any path. Returns dict mapping
+    each path to sorted list of all paths in its merged group."""
+    merged = {}
+    for group in groups:
+        members = set(group)
+        for path in group:
+            members.update(merged.get(path, []))
+        members = sorted(members)
+        for path in members:
+            merged[path] = members
+    return merged
 
-    # Need to assume trailing slash in target_dir later.
-    if target_dir[-1] != "/":
-        target_dir += "/"
 
-    # Prompt user for decision if collision detected.
-    target_dir_imgs = os.listdir(target_dir)
-    if new_name in target_dir_imgs:
-
-        if same_hash(img_path, os.path.join(target_dir, new_name)):
-            # First check if they are the same file. If so, don't replace.
-            print("%s/%s with same file hash exists already. "
-                                "Dest file not overwritten.\n"
-                            % (os.path.basename(target_dir[:-1]), new_name))
-            time.sleep(1) # Pause for one second so user sees above message.
+def copy_to_target(img_path, target_dir, new_name=None, move_op=False):
+    """Function to copy img to target directory with collision detection.
+    If 'move_op' param specified, delete img from current dir.
+    Returns path img ended up at (identical file already there counts), or
+    None if skipped."""
+    written_paths = {}
+    copy_batch_to_target([(img_path, target_dir, new_name, move_op)],
+                                                written_paths=written_paths)
+    return written_paths.get(img_path)
+
+
+def get_st_date(img_name):
+    # ORG prepends YYYY-MM-DD_ datestamp to names. st folders named by it.
+    return img_name.split('_')[0]
+
+
+def copy_batch_to_target(copy_jobs, defer_conflicts=False, workers=1,
+                                                        written_paths=None):
+    """Copies (or moves) a batch of images with collision detection done
+    up front for the whole batch.
+    copy_jobs is list of (img_path, target_dir, new_name, move_op) tuples.
+    new_name can be None to keep img's name.
+    Each target dir is listed once. Files without a collision are transferred
+    first. Then all collision pairs are hashed in parallel, identical files are
+    de-duplicated automatically, and remaining conflicts are reviewed in one
+    step.
+    If defer_conflicts, nothing is printed or prompted (e.g. when running in
+    background) and remaining conflicts are returned for review_conflicts()
+    instead.
+    If workers > 1, non-colliding transfers run in that many threads with a
+    progress bar in bytes and files (worth it for many small same-filesystem
+    moves, which are just renames).
+    If written_paths (dict) passed, it's filled in with img_path: path img
+    ended up at (including identical file already there) for every img
+    transferred. Skipped imgs and deferred conflicts left out."""
+    if written_paths is None:
+        written_paths = {}
+    dir_listings = {}  # target dir: set of names in it (incl. batch's own)
+    transfers = []
+    collisions = []
+    for img_path, target_dir, new_name, move_op in copy_jobs:
+        if os.path.isdir(img_path):
+            continue
+        elif not os.path.exists(img_path):
+            # Removed since batch queued (e.g. IMG_E original replaced).
+            continue
+        if not new_name:
+            new_name = os.path.basename(img_path)
+        # Need to assume trailing slash in target_dir later.
+        if target_dir[-1] != "/":
+            target_dir += "/"
+
+        if target_dir not in dir_listings:
+            # Partial copy left by a crash would look like a collision.
+            dir_listings[target_dir] = set(
+                                    copy_engine.clean_temp_files(target_dir))
+        if new_name in dir_listings[target_dir]:
+            # Checked once everything else is in place. Name may be taken
+            # by an earlier job in this batch.
+            collisions.append((img_path, target_dir, new_name, move_op))
+        else:
+            transfers.append((img_path, os.path.join(target_dir, new_name),
+                                                                    move_op))
+            dir_listings[target_dir].add(new_name)
+
+    if workers > 1 and len(transfers) > 1:
+        Progress = copy_engine.CopyProgress(copy_engine.scan_sizes(
+                        [transfer[0] for transfer in transfers]), len(transfers))
+        def run_transfer(transfer):
+            transfer_file(*transfer, progress_callback=Progress.add_bytes)
+            Progress.file_done()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # list() so any error in a worker is raised here.
+            list(executor.map(run_transfer, transfers))
+        Progress.close()
+    else:
+        for img_path, dest_path, move_op in transfers:
+            transfer_file(img_path, dest_path, move_op)
+    for img_path, dest_path, move_op in transfers:
+        written_paths[img_path] = dest_path
+
+    if not collisions:
+        return []
+
+    # Hash every file involved in a collision in parallel.
+    hash_paths = set()
+    for img_path, target_dir, new_name, move_op in collisions:
+        hash_paths.add(img_path)
+        hash_paths.add(os.path.join(target_dir, new_name))
+    hash_paths = sorted(hash_paths)
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+        file_hashes = dict(zip(hash_paths, executor.map(copy_engine.file_hash,
+                                                                hash_paths)))
+
+    conflicts = []
+    dup_names = []
+    for img_path, target_dir, new_name, move_op in collisions:
+        if (file_hashes[img_path]
+                        == file_hashes[os.path.join(target_dir, new_name)]):
+            # Same file already there. Don't replace.
+            dup_names.append("%s/%s" % (os.path.basename(target_dir[:-1]),
+                                                                    new_name))
+            written_paths[img_path] = os.path.join(target_dir, new_name)
             if move_op:
                 os.remove(img_path)
-            else:
-                return
-
+                change_journal.record_deleted(img_path)
         else:
-            # Otherwise, need user input to decide what to do about collision.
-            action = None
-            while action != "s" and action != "o" and action != "k":
-                action = input("Collision detected: %s in dir:\n\t%s\n"
-                    "\tSkip, overwrite, or keep both? [S/O/K]\n\t> "
-                                                % (new_name, target_dir))
-                if action.lower() == "s":
-                    return
-                elif action.lower() == "o":
-                    # Overwrite file in destination folder w/ same name.
-                    os.remove(os.path.join(target_dir, new_name))
-                    shutil.move(img_path, target_dir)
-                    return
-                elif action.lower() == "k":
-                    # Repeatedly check for existence of duplicates until a free
-                    # name appears. Assume there will never be more than 9.
-                    # Prefer shorter file name to spare leading zeros.
-                    img_noext = os.path.splitext(new_name)[0]
-                    img_ext = os.path.splitext(new_name)[-1]
-
-                    n = 1
-                    img_noext = img_noext + "_%d" % n
-
-                    while img_noext + img_ext in target_dir_imgs:
-                        n += 1
-                        if n > 9:
-                            raise Exception("Image incrementer exceeded 9.\n"
-                                        "Check dest folder %s" % target_dir)
-                        img_noext = img_noext[:-1] + "%d" % n
-                    if move_op:
-                        shutil.move(img_path,
-                                os.path.join(target_dir, img_noext + img_ext))
-                    else:
-                        shutil.copy2(img_path,
-                                os.path.join(target_dir, img_noext + img_ext))
-
-    elif move_op:
-        shutil.move(img_path, os.path.join(target_dir, new_name))
+            conflicts.append((img_path, target_dir, new_name, move_op))
+
+    if defer_conflicts:
+        return conflicts
+    elif len(dup_names) == 1:
+        print("%s with same file hash exists already. "
+                                "Dest file not overwritten.\n" % dup_names[0])
+    elif dup_names:
+        print("%d files with same file hash exist already in dest. Dest files "
+                                            "not overwritten:" % len(dup_names))
+        for dup_name in dup_names:
+            print("\t%s" % dup_name)
+        print("")
+    if dup_names and not policy.is_unattended():
+        time.sleep(1) # Pause for one second so user sees above message.
+
+    review_conflicts(conflicts, written_paths)
+    return []
+
+
+def review_conflicts(conflicts, written_paths=None):
+    """Has user decide all conflicts (list of (img_path, target_dir,
+    new_name, move_op) tuples) in one step, or one by one if they prefer.
+    If written_paths (dict) passed, path each img written to is added to it
+    as in copy_batch_to_target()."""
+    # Conflicts may have been found a while ago, so check they still apply.
+    conflicts = [conflict for conflict in conflicts if os.path.exists(conflict[0])
+                            and os.path.exists(os.path.join(conflict[1], conflict[2]))]
+    if not conflicts:
+        return
+    dir_listings = {}
+    for img_path, target_dir, new_name, move_op in conflicts:
+        if target_dir not in dir_listings:
+            dir_listings[target_dir] = set(os.listdir(target_dir))
+
+    Policy = policy.get_active_policy()
+    bulk_action = None
+    if len(conflicts) > 1 and not (Policy and Policy.has_answer("collision")):
+        # One decision for all of them unless user wants to go one by one.
+        print("Collisions detected (%d):" % len(conflicts))
+        for img_path, target_dir, new_name, move_op in conflicts:
+            print("\t%s in dir:\n\t\t%s\n\t\t(new %d B, existing %d B)"
+                        % (new_name, target_dir, os.path.getsize(img_path),
+                           os.path.getsize(os.path.join(target_dir, new_name))))
+        while bulk_action not in ["s", "o", "k", "r"]:
+            bulk_action = input("\tSkip, overwrite, or keep both for all? "
+                        "[S/O/K]\n\tOr 'r' to review each one.\n\t> ").lower()
+        if bulk_action == "r":
+            bulk_action = None
+
+    for img_path, target_dir, new_name, move_op in conflicts:
+        action = bulk_action
+        while action not in ["s", "o", "k"]:
+            action = policy.ask("collision", "Collision detected: %s in "
+                "dir:\n\t%s\n\tSkip, overwrite, or keep both? [S/O/K]\n\t> "
+                                                % (new_name, target_dir),
+                            subject=os.path.join(target_dir, new_name)).lower()
+        dest_path = resolve_collision(img_path, target_dir, new_name, move_op,
+                                            action, dir_listings[target_dir])
+        if dest_path and written_paths is not None:
+            written_paths[img_path] = dest_path
+
+
+def resolve_collision(img_path, target_dir, new_name, move_op, action,
+                                                            target_dir_imgs):
+    """Carries out user's decision for a name collision: 's' skips, 'o'
+    overwrites, 'k' keeps both (new file gets _N suffix). target_dir_imgs is
+    set of names in target_dir, updated with any name added. Returns path
+    written, or None if skipped."""
+    if action == "s":
+        return None
+    elif action == "o":
+        # Overwrite file in destination folder w/ same name.
+        os.remove(os.path.join(target_dir, new_name))
+        transfer_file(img_path, os.path.join(target_dir, new_name), move_op)
+        return os.path.join(target_dir, new_name)
+    elif action == "k":
+        # Repeatedly check for existence of duplicates until a free
+        # name appears. Assume there will never be more than 9.
+        # Prefer shorter file name to spare leading zeros.
+        img_noext = os.path.splitext(new_name)[0]
+        img_ext = os.path.splitext(new_name)[-1]
+
+        n = 1
+        img_noext = img_noext + "_%d" % n
+
+        while img_noext + img_ext in target_dir_imgs:
+            n += 1
+            if n > 9:
+                raise Exception("Image incrementer exceeded 9.\n"
+                            "Check dest folder %s" % target_dir)
+            img_noext = img_noext[:-1] + "%d" % n
+        transfer_file(img_path, os.path.join(target_dir, img_noext + img_ext),
+                                                                        move_op)
+        target_dir_imgs.add(img_noext + img_ext)
+        return os.path.join(target_dir, img_noext + img_ext)
+
+
+def transfer_file(img_path, dest_path, move_op, progress_callback=None):
+    if move_op:
+        copy_engine.move_file(img_path, dest_path, progress_callback)
+        change_journal.record_moved(img_path, dest_path)
     else:
-        shutil.copy2(img_path, os.path.join(target_dir, new_name))
+        copy_engine.copy_file(img_path, dest_path, progress_callback)
+        change_journal.record_created(dest_path)
 
 
 def same_hash(img1_path, img2_path):
-    with open(img1_path, 'rb') as file_obj:
-        img1_hash = hashlib.sha1(file_obj.read())
-        # print(img1_hash.hexdigest())
-
-    with open(img2_path, 'rb') as file_obj:
-        img2_hash = hashlib.sha1(file_obj.read())
-        # print(img2_hash.hexdigest())
-
-    if img1_hash.hexdigest() == img2_hash.hexdigest():
+    if copy_engine.file_hash(img1_path) == copy_engine.file_hash(img2_path):
         return True
     else:
         return False
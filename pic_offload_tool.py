@@ -1,11 +1,20 @@
 import os
-import shutil
 import time
 from tqdm import tqdm, trange
 import subprocess
+import json
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 from idevice_media_offload.dir_names import IDEVICE_MOUNT_POINT, NAS_TRANSFER
+from idevice_media_offload import dir_names
 from idevice_media_offload.pic_categorize_tool import os_open
+from idevice_media_offload import change_journal
+from idevice_media_offload import device_io
+from idevice_media_offload import policy
+from idevice_media_offload import copy_engine
+from idevice_media_offload import offload_verify
+from idevice_media_offload import media_unit
 
 class iDeviceLocError(Exception):
     pass
@@ -22,6 +31,13 @@ class RawOffloadError(Exception):
 
 DATETIME_FORMAT = "%Y-%m-%dT%H%M%S"  # Global format
 
+MERGE_JOURNAL_NAME = "merge_journal.json"
+FINGERPRINT_FILE_NAME = ".folder_fingerprints.json"  # Stored in mirror tree
+FINGERPRINT_MTIME_MARGIN = 60  # seconds
+MIRROR_STATS_FILE_NAME = ".mirror_stats.json"  # Stored in mirror tree
+MERGE_COPY_WORKERS = 4  # Only used when merge can't be done with renames.
+USB_SYSFS_PATH = "/sys/bus/usb/devices/"
+
 
 # Phase 1: Copy any new pics from device to raw_offload folder.
 # Find device in GVFS dir.
@@ -30,8 +46,13 @@ DATETIME_FORMAT = "%Y-%m-%dT%H%M%S"  # Global format
 # previous offload, not date).
 
 class iDeviceDCIM(object):
-    """Represents DCIM folder structure at iDevice's gvfs mount point"""
-    def __init__(self):
+    """Represents DCIM folder structure at iDevice's gvfs mount point.
+    Specify gvfs handle when more than one device is mounted (see
+    discover_iDevices()). io_limiter (threading semaphore) can be shared
+    between objects to cap device I/O across all of them."""
+    def __init__(self, handle=None, io_limiter=None):
+        self.handle = handle
+        self.io_limiter = io_limiter
         self.find_root()
 
     def find_root(self):
@@ -39,9 +60,19 @@ class iDeviceDCIM(object):
         # There should only be one.
         # If none found, an alternate method of mounting will be attempted.
         gvfs_handles = os.listdir(IDEVICE_MOUNT_POINT)
+        if self.handle:
+            # Caller picked a specific device. Ignore any others.
+            if self.handle not in gvfs_handles:
+                self.ask_retry("Error: Can't find iDevice %s in %s\nUnlock "
+                                    "device then press Enter to try again."
+                                        % (self.handle, IDEVICE_MOUNT_POINT))
+                print("\n")
+                self.find_root()
+                return
+            gvfs_handles = [self.handle]
         count = 0
         for i, handle in enumerate(gvfs_handles):
-            if handle[0:6] == 'gphoto':
+            if handle[0:6] == 'gphoto' or handle == self.handle:
                 iDevice_handle = handle
                 count += 1
 
@@ -89,8 +120,9 @@ class iDeviceDCIM(object):
             if count:
                 dir_type = "fallback (S/N-based)"
                 while True:
-                    fallback_ans = input("Use fallback DCIM (includes deleted "
-                                    "images) [Y] or retry DCIM search [N].\n> ")
+                    fallback_ans = policy.get_input("Use fallback DCIM "
+                                "(includes deleted images) [Y] or retry DCIM "
+                                                        "search [N].\n> ")
                     if fallback_ans in ["Y", "y"]:
                         try:
                             subprocess.run(["xdg-open", "%s" % iDevice_handle],
@@ -114,8 +146,10 @@ class iDeviceDCIM(object):
         except OSError:
             # OSError when trying to access device dir resolved by hitting Eject
             # in Nemo sidebar and re-selecting (mounting) device there.
-            os_open("/")
-            input("\nCan't access iDevice contents. Eject and re-mount in file manager.\n")
+            if not policy.is_unattended():
+                os_open("/")
+            self.ask_retry("\nCan't access iDevice contents. Eject and re-mount "
+                                                        "in file manager.\n")
             self.find_root()
             return
 
@@ -126,10 +160,11 @@ class iDeviceDCIM(object):
             self.APPLE_folders = os.listdir(self.DCIM_path)
             if not self.APPLE_folders:
                 # Empty DCIM folder indicates temporary issue like locked device.
-                os_error_response = input("\nCan't access iDevice pictures.\n"
+                os_error_response = policy.ask("device_retry",
+                "\nCan't access iDevice pictures.\n"
                 "Plugging device in again and unlocking will likely fix issue."
                 "\nPlug back in then press Enter to continue, or press 'q' "
-                                                                "to quit.\n> ")
+                                    "to quit.\n> ", subject=IDEVICE_MOUNT_POINT)
                 if os_error_response.lower() == 'q':
                     raise iDeviceIOError("Cannot access files on iDevice. "
                     "Plug device in again and unlock to fix. Then run program "
@@ -143,12 +178,18 @@ class iDeviceDCIM(object):
             else:
                 print("\nSuccessfully accessed %s DCIM mount point." % dir_type)
             self.APPLE_folders.sort()
+            # All further device access goes through async reader. Contents
+            # cache is reset since gvfs root may have changed.
+            self.Reader = device_io.AsyncDCIMReader(self.DCIM_path,
+                                                shared_limiter=self.io_limiter)
+            self.APPLE_contents = {}
 
         elif count == 1:
             # iDevice handle exists, but DCIM folder not present.
             # Unlocking doesn't always solve it.
-            input("Error: Found %s mount point, but DCIM folder not present.\n"
-                    "Re-mount iDevice and press Enter to try again." % dir_type)
+            self.ask_retry("Error: Found %s mount point, but DCIM folder not "
+                "present.\nRe-mount iDevice and press Enter to try again."
+                                                                    % dir_type)
             print("\n")
             self.find_root()
             return
@@ -158,12 +199,20 @@ class iDeviceDCIM(object):
             # Have not seen this happen. In fact, with two iDevices plugged
             # in, only the first one shows up as a gvfs directory.
         else:
-            input("Error: Can't find iDevice in %s\nUnlock device then press "
-                                    "Enter to try again." % IDEVICE_MOUNT_POINT)
+            self.ask_retry("Error: Can't find iDevice in %s\nUnlock device then "
+                            "press Enter to try again." % IDEVICE_MOUNT_POINT)
             print("\n")
             self.find_root()
             return
 
+    def ask_retry(self, prompt):
+        # Unattended runs can be told to give up ('q') rather than wait on
+        # a device that isn't coming back.
+        if policy.ask("device_retry", prompt,
+                                subject=IDEVICE_MOUNT_POINT).lower() == 'q':
+            raise iDeviceIOError("Gave up waiting for iDevice in %s."
+                                                        % IDEVICE_MOUNT_POINT)
+
     def get_root(self):
         return self.DCIM_path
 
@@ -180,18 +229,54 @@ class iDeviceDCIM(object):
 
     def get_APPLE_contents(self, APPLE_folder_name):
         # Exception handling done by get_APPLE_folder_path() method
-        APPLE_contents = os.listdir(self.get_APPLE_folder_path(APPLE_folder_name))
-        APPLE_contents.sort()
-        return APPLE_contents
+        self.get_APPLE_folder_path(APPLE_folder_name)
+        if APPLE_folder_name not in self.APPLE_contents:
+            self.APPLE_contents[APPLE_folder_name] = self.Reader.run_sync(
+                                    self.Reader.list_folder(APPLE_folder_name))
+        return self.APPLE_contents[APPLE_folder_name].copy()
+
+    def prefetch_APPLE_contents(self, APPLE_folder_names=None):
+        """Lists APPLE folders (all by default) concurrently and caches results
+        for get_APPLE_contents()."""
+        if APPLE_folder_names is None:
+            APPLE_folder_names = self.list_APPLE_folders()
+        uncached = [APPLE_folder for APPLE_folder in APPLE_folder_names
+                                    if APPLE_folder not in self.APPLE_contents]
+        if uncached:
+            self.APPLE_contents.update(self.Reader.run_sync(
+                                            self.Reader.list_folders(uncached)))
+
+    def stat_APPLE_folders(self, APPLE_folder_names):
+        """Returns dict mapping each APPLE folder name to its mtime.
+        Folders stat'd concurrently without listing them."""
+        return self.Reader.run_sync(self.Reader.stat_folders(
+                                                        APPLE_folder_names))
+
+    def stat_APPLE_contents(self, APPLE_folder_name, img_names):
+        """Returns dict mapping each image name to (size, mtime) tuple.
+        Files stat'd concurrently."""
+        self.get_APPLE_folder_path(APPLE_folder_name)
+        return self.Reader.run_sync(self.Reader.stat_files(APPLE_folder_name,
+                                                                    img_names))
+
+    def copy_APPLE_imgs(self, APPLE_folder_name, img_names, dest_dir,
+                    done_callback=None, progress_callback=None, digests=None):
+        """Copies images concurrently. Returns dict mapping each image name to
+        None if copied or the OSError raised if not. If digests dict given,
+        SHA-1 of each copied image is stored in it by name."""
+        self.get_APPLE_folder_path(APPLE_folder_name)
+        return self.Reader.run_sync(self.Reader.copy_files(APPLE_folder_name,
+                img_names, dest_dir, done_callback, progress_callback, digests))
 
     def reconnect(self):
         """Re-establish connection after an OSError. iOS has bug that can
         terminate PC connection. Requires iDevice restart to fix.
         """
-        os_error_response = input("\nEncountered device I/O error during "
-                            "offload. Device may need to be restarted to fix.\n"
+        os_error_response = policy.ask("device_retry", "\nEncountered device "
+                            "I/O error during offload. Device may need to be "
+                            "restarted to fix.\n"
                             "Press Enter to attempt to continue offload.\n"
-                            "Or press 'q' to quit.\n> ")
+                            "Or press 'q' to quit.\n> ", subject=self.DCIM_path)
         if os_error_response.lower() == 'q':
             return False
         else:
@@ -206,6 +291,50 @@ class iDeviceDCIM(object):
         return ("iDevice DCIM directory object with path:\n\t%s" % self.get_root())
 
 
+def discover_iDevices():
+    """Returns dict mapping USB serial number to gvfs handle for every iDevice
+    mounted under IDEVICE_MOUNT_POINT."""
+    devices = {}
+    for handle in os.listdir(IDEVICE_MOUNT_POINT):
+        if handle[0:6] == 'gphoto':
+            serial = get_gphoto_serial(handle)
+        elif handle[0:3] == 'afc':
+            # e.g. afc:host=00008030-001A2B3C4D5E6F7G
+            # UDID minus dash is the USB serial.
+            serial = handle.split("host=")[-1].split(",")[0].replace("-", "")
+        else:
+            continue
+        if serial:
+            devices[serial] = handle
+    return devices
+
+
+def get_gphoto_serial(gphoto_handle):
+    """gvfs names gphoto2 mounts by USB port rather than device, e.g.
+    gphoto2:host=%5Busb%3A002%2C005%5D (bus 2, device 5). Look up serial of
+    device at that port in sysfs. Returns None if not found."""
+    port = urllib.parse.unquote(gphoto_handle).split("usb:")[-1].strip("[]")
+    try:
+        (bus_num, dev_num) = [int(num) for num in port.split(",")]
+    except ValueError:
+        return None
+
+    for usb_dev in os.listdir(USB_SYSFS_PATH):
+        usb_dev_path = os.path.join(USB_SYSFS_PATH, usb_dev)
+        try:
+            with open(os.path.join(usb_dev_path, "busnum")) as busnum_file:
+                usb_bus_num = int(busnum_file.read())
+            with open(os.path.join(usb_dev_path, "devnum")) as devnum_file:
+                usb_dev_num = int(devnum_file.read())
+            if (usb_bus_num, usb_dev_num) == (bus_num, dev_num):
+                with open(os.path.join(usb_dev_path, "serial")) as serial_file:
+                    return serial_file.read().strip()
+        except (OSError, ValueError):
+            # Interfaces and hubs lack some of these attributes.
+            continue
+    return None
+
+
 ##########################################
 
 # Program creates new folder with today’s date in raw offload directory.
@@ -226,6 +355,8 @@ class RawOffloadGroup(object):
             raise RawOffloadError("Raw_Offload dir not found at %s! "
                         "Pics not offloaded. Terminating" % self.RO_root_path)
 
+        # Finish or undo any merge interrupted on a previous run first.
+        self.check_merge_journal()
         self.generate_offload_set()
 
     def get_BU_root(self):
@@ -288,21 +419,26 @@ class RawOffloadGroup(object):
                     pass # exclude
                 else:
                     if not os.listdir(item_path):
-                        delete_empty_ro = input("Folder %s in raw_offload "
+                        delete_empty_ro = policy.ask("empty_ro_folder",
+                                    "Folder %s in raw_offload "
                                     "directory is empty, possibly from previous "
                                     "aborted offload.\nPress 'd' to delete "
                                     "folder and continue or any other key to "
-                                    "skip.\n> " % offload_item)
+                                    "skip.\n> " % offload_item, subject=item_path)
                         if delete_empty_ro.lower() == 'd':
                             os.rmdir(item_path)
+                            change_journal.record_deleted(item_path)
                         # Need to ignore it either way.
                         pass # exclude
                     else:
                         self.offload_obj_set.add(OffloadObj)
 
-    def create_new_offload(self):
-        NewOffload = NewRawOffload(self)
-        self.merge_todays_offloads()
+    def create_new_offload(self, folder_queue=None):
+        NewOffload = NewRawOffload(self, folder_queue=folder_queue)
+        if not folder_queue:
+            # In pipelined mode, ORG is still reading the new offload, so
+            # caller has to run the merge once ORG finishes.
+            self.merge_todays_offloads()
         return NewOffload
 
     def merge_todays_offloads(self):
@@ -323,7 +459,8 @@ class RawOffloadGroup(object):
                 print("\t%s" % offload.get_dir_name())
 
             while True:
-                merge_response = input("Merge folders? (Y/N)\n> ")
+                merge_response = policy.ask("merge", "Merge folders? (Y/N)\n> ",
+                                subject=todays_offloads[-1].get_dir_name())
                 if merge_response.lower() == 'y':
                     self.raw_offload_merge(todays_offloads)
                     break
@@ -338,23 +475,176 @@ class RawOffloadGroup(object):
         DestFolder = offload_objects[-1]
         old_offloads = offload_objects[:-1]
 
+        # Plan every move before touching anything so a name collision aborts
+        # the merge cleanly, then journal the plan so an interrupted merge can
+        # be completed or rolled back next time the group is instantiated.
+        merge_plan = self.plan_merge(DestFolder, old_offloads)
+        self.write_merge_journal(merge_plan)
+        self.execute_merge(merge_plan)
+        self.merge_digests(merge_plan)
+        self.clear_merge_journal()
+
+    def merge_digests(self, merge_plan):
+        # Copy records (see offload_verify) follow files into merged folder.
+        # Safe to re-run after an interrupted merge.
+        digests = offload_verify.load_digests(self.get_RO_root(),
+                                                    merge_plan["dest_name"])
+        for src_name in merge_plan["src_names"]:
+            digests.update(offload_verify.load_digests(self.get_RO_root(),
+                                                                    src_name))
+        if digests:
+            offload_verify.save_digests(self.get_RO_root(),
+                                            merge_plan["dest_name"], digests)
+        for src_name in merge_plan["src_names"]:
+            digest_path = offload_verify.get_digest_path(self.get_RO_root(),
+                                                                    src_name)
+            if os.path.exists(digest_path):
+                os.remove(digest_path)
+
+    def plan_merge(self, DestFolder, old_offloads):
+        """Returns dict describing every dir creation, file move, and dir
+        removal needed to merge old_offloads into DestFolder. Each folder is
+        listed only once."""
+        dest_APPLE_folders = set(DestFolder.list_APPLE_folders())
+        merge_plan = {"dest": DestFolder.get_full_path(),
+                      "dest_name": DestFolder.get_dir_name(),
+                      "src_names": [SrcFolder.get_dir_name()
+                                                for SrcFolder in old_offloads],
+                      "mkdirs": [], "moves": [], "rmdirs": []}
+        planned_dests = set()
+
         for SrcFolder in old_offloads:
+            src_full_path = SrcFolder.get_full_path()
             for APPLE_folder in SrcFolder.list_APPLE_folders():
-                # If the dir doesn't exist in the destination dir yet, create it.
-                if not APPLE_folder in DestFolder.list_APPLE_folders():
-                    dest_APPLE_path = os.path.join(DestFolder.get_full_path(),
+                src_APPLE_path = os.path.join(src_full_path, APPLE_folder)
+                dest_APPLE_path = os.path.join(DestFolder.get_full_path(),
                                                                    APPLE_folder)
-                    os.mkdir(dest_APPLE_path)
-
-                for image in SrcFolder.get_APPLE_contents(APPLE_folder):
-                    src_img_path = os.path.join(
-                           SrcFolder.get_APPLE_folder_path(APPLE_folder), image)
-                    shutil.move(src_img_path,
-                                    DestFolder.get_APPLE_folder_path(APPLE_folder))
-                # Delete each APPLE directory after copying everything out of it
-                os.rmdir(SrcFolder.get_APPLE_folder_path(APPLE_folder))
-            # Delete each RO directory after copying everything out of it
-            os.rmdir(SrcFolder.get_full_path())
+                # If the dir doesn't exist in the destination dir yet, create it.
+                if APPLE_folder not in dest_APPLE_folders:
+                    merge_plan["mkdirs"].append(dest_APPLE_path)
+                    dest_APPLE_folders.add(APPLE_folder)
+                    dest_APPLE_contents = set()
+                else:
+                    dest_APPLE_contents = set(os.listdir(dest_APPLE_path))
+
+                for image in sorted(os.listdir(src_APPLE_path)):
+                    dest_img_path = os.path.join(dest_APPLE_path, image)
+                    if image in dest_APPLE_contents or dest_img_path in planned_dests:
+                        raise RawOffloadError("Can't merge %s into %s. %s/%s "
+                                    "already exists there. No changes made."
+                                    % (SrcFolder.get_dir_name(),
+                                       DestFolder.get_dir_name(), APPLE_folder,
+                                                                        image))
+                    planned_dests.add(dest_img_path)
+                    merge_plan["moves"].append(
+                        [os.path.join(src_APPLE_path, image), dest_img_path])
+                # Delete each APPLE directory after moving everything out of it
+                merge_plan["rmdirs"].append(src_APPLE_path)
+            # Delete each RO directory after moving everything out of it
+            merge_plan["rmdirs"].append(src_full_path)
+
+        return merge_plan
+
+    def get_merge_journal_path(self):
+        # Files in RO root are excluded from the offload set, so journal can
+        # live there.
+        return os.path.join(self.get_RO_root(), MERGE_JOURNAL_NAME)
+
+    def write_merge_journal(self, merge_plan):
+        journal_path = self.get_merge_journal_path()
+        # Write to temp name then rename so a crash never leaves a partial
+        # journal behind.
+        with open(journal_path + ".tmp", "w") as journal_file:
+            json.dump(merge_plan, journal_file)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(journal_path + ".tmp", journal_path)
+
+    def clear_merge_journal(self):
+        os.remove(self.get_merge_journal_path())
+
+    def check_merge_journal(self):
+        """Looks for journal left by an interrupted merge and lets user finish
+        or undo it before anything else reads the Raw_Offload tree."""
+        journal_path = self.get_merge_journal_path()
+        if not os.path.exists(journal_path):
+            return
+        with open(journal_path, "r") as journal_file:
+            merge_plan = json.load(journal_file)
+
+        while True:
+            journal_response = policy.ask("merge_journal", "Found journal from "
+                            "interrupted merge of "
+                            "today's Raw_Offload folders into\n\t%s\n"
+                            "Press 'c' to complete merge or 'r' to roll it "
+                                            "back.\n> " % merge_plan["dest"],
+                                                    subject=merge_plan["dest"])
+            if journal_response.lower() == 'c':
+                self.execute_merge(merge_plan)
+                if "dest_name" in merge_plan:
+                    # Journals written before digests were tracked lack names.
+                    self.merge_digests(merge_plan)
+                break
+            elif journal_response.lower() == 'r':
+                self.rollback_merge(merge_plan)
+                break
+        self.clear_merge_journal()
+
+    def execute_merge(self, merge_plan):
+        """Carries out (or finishes) a journaled merge. Safe to re-run since
+        moves already done are detected from the filesystem. Uses rename when
+        src and dest share a filesystem and falls back to parallel copies."""
+        for dir_path in merge_plan["mkdirs"]:
+            os.makedirs(dir_path, exist_ok=True)
+
+        copy_moves = []
+        for src_path, dest_path in merge_plan["moves"]:
+            if not os.path.exists(src_path):
+                # Already moved before interruption.
+                continue
+            if (os.stat(os.path.dirname(src_path)).st_dev
+                            == os.stat(os.path.dirname(dest_path)).st_dev):
+                os.rename(src_path, dest_path)
+                copy_engine.track_rename(src_path, dest_path)
+            else:
+                copy_moves.append((src_path, dest_path))
+            change_journal.record_moved(src_path, dest_path)
+
+        if copy_moves:
+            Progress = copy_engine.CopyProgress(copy_engine.scan_sizes(
+                                        [move[0] for move in copy_moves]),
+                                        len(copy_moves), desc=" Merge copies")
+            def run_merge_copy(move):
+                merge_copy(*move, progress_callback=Progress.add_bytes)
+                Progress.file_done()
+            with ThreadPoolExecutor(max_workers=MERGE_COPY_WORKERS) as executor:
+                # list() forces any worker exception to surface here.
+                list(executor.map(run_merge_copy, copy_moves))
+            Progress.close()
+
+        # Merged folder on disk before old ones removed and journal cleared.
+        copy_engine.commit()
+        for dir_path in merge_plan["rmdirs"]:
+            if os.path.exists(dir_path):
+                os.rmdir(dir_path)
+                change_journal.record_deleted(dir_path)
+
+    def rollback_merge(self, merge_plan):
+        """Undoes a partially-executed journaled merge, moving files back into
+        their original offload folders."""
+        for src_path, dest_path in merge_plan["moves"]:
+            if os.path.exists(dest_path) and not os.path.exists(src_path):
+                os.makedirs(os.path.dirname(src_path), exist_ok=True)
+                copy_engine.move_file(dest_path, src_path)
+                change_journal.record_moved(dest_path, src_path)
+            elif os.path.exists(dest_path):
+                # Copy finished but source never removed. Source is intact.
+                os.remove(dest_path)
+                change_journal.record_deleted(dest_path)
+
+        for dir_path in merge_plan["mkdirs"]:
+            if os.path.exists(dir_path) and not os.listdir(dir_path):
+                os.rmdir(dir_path)
 
     def __str__(self):
         return self.get_RO_root()
@@ -363,6 +653,13 @@ class RawOffloadGroup(object):
         return "RawOffloadGroup object with path:\n\t%s" % self.get_RO_root()
 
 
+def merge_copy(src_path, dest_path, progress_callback=None):
+    """Cross-filesystem fallback for a merge move. copy_engine copies to temp
+    name first so an interrupted copy never looks like a finished one, and
+    syncs copy before source removed."""
+    copy_engine.move_file(src_path, dest_path, progress_callback)
+
+
 class RawOffload(object):
     """Represents a datestamped folder under the Raw_Offload root containing
     APPLE folders."""
@@ -414,7 +711,9 @@ class RawOffload(object):
 
     def get_APPLE_contents(self, APPLE_folder_name):
         # Exception handling done by get_APPLE_folder_path() method
-        APPLE_contents = os.listdir(self.get_APPLE_folder_path(APPLE_folder_name))
+        APPLE_folder_path = self.get_APPLE_folder_path(APPLE_folder_name)
+        # Partial copies left by a crash aren't real contents.
+        APPLE_contents = copy_engine.clean_temp_files(APPLE_folder_path)
         APPLE_contents.sort()
         return APPLE_contents
 
@@ -446,27 +745,57 @@ class RawOffload(object):
 
 class NewRawOffload(RawOffload):
     """Represents new RawOffload instance (timestamped folder).
-    Includes functionality to perform the offload from an iDeviceDCIM obj."""
+    Includes functionality to perform the offload from an iDeviceDCIM obj.
+    If folder_queue (queue.Queue) passed, path of each month folder is put on
+    it as soon as that month is fully offloaded, followed by None at the end,
+    so ORG can consume folders while offload continues."""
 
-    def __init__(self, Group):
+    def __init__(self, Group, folder_queue=None, iDevice_DCIM=None,
+                                                        caption_prompt=True):
         self.ParentGroup = Group
         self.offload_dir_name = time.strftime(DATETIME_FORMAT)
         self.full_path = os.path.join(self.ParentGroup.get_RO_root(),
                                                     self.offload_dir_name + '/')
-
-        self.src_iDevice_DCIM = iDeviceDCIM()
+        self.folder_queue = folder_queue
+        self.pending_month = None
+        # Source, device stats, and SHA-1 of every image copied, for
+        # offload_verify.
+        self.digests = {}
+
+        if iDevice_DCIM:
+            # Device already chosen by caller (multi-device mode).
+            self.src_iDevice_DCIM = iDevice_DCIM
+        else:
+            self.src_iDevice_DCIM = iDeviceDCIM()
         self.MTree = MirrorTree(self.ParentGroup, self.src_iDevice_DCIM)
 
         self.create_target_folder()
         self.run_offload()
 
+        if self.folder_queue:
+            # ORG has already consumed the folders, so manually-transferred
+            # captioned versions would not get picked up.
+            print("\nPipelined mode: skipping manual caption transfer. Run "
+                        "OFFLOAD and ORG separately if captions are needed.")
+        elif caption_prompt:
+            # Caller can defer prompt (e.g. so concurrent offloads don't
+            # prompt over each other).
+            self.prompt_caption_transfer()
+
+    def prompt_caption_transfer(self):
+        Policy = policy.get_active_policy()
+        if Policy and Policy.has_answer("caption_transfer"):
+            # Nobody there to do the transfer.
+            Policy.get_answer("caption_transfer", subject=self.full_path)
+            return
         while not os.path.exists(NAS_TRANSFER):
-            input("\nCan't reach NAS share. Check network connection and ensure "
-                            "NAS share is mounted.\nPress Enter to try again.")
+            policy.ask("nas_retry", "\nCan't reach NAS share. Check network "
+                            "connection and ensure NAS share is mounted.\n"
+                            "Press Enter to try again.", subject=NAS_TRANSFER)
         os_open(self.full_path)
         os_open(NAS_TRANSFER)
-        input("\nManually transfer any images with captions into latest "
-            "Raw_Offload directory (using NAS transfer)\n\tsince captions "
+        policy.get_input("\nManually transfer any images with captions into "
+            "latest Raw_Offload directory (using NAS transfer)\n\tsince captions "
             "aren't included in EXIF data when offloaded over USB.\n"
             "Press Enter when finished.")
 
@@ -482,17 +811,74 @@ class NewRawOffload(RawOffload):
             os.mkdir(self.full_path)
 
     def run_offload(self):
+        try:
+            self.copy_new_imgs()
+        finally:
+            # Hand off last month folder and end-of-offload signal to ORG,
+            # even if offload quit early.
+            self.queue_finished_month(None)
+            # Keep fingerprints and mirror stats of images offloaded before
+            # any early quit.
+            self.MTree.save_fingerprints()
+            self.MTree.save_entry_stats()
+            if self.digests:
+                offload_verify.save_digests(self.ParentGroup.get_RO_root(),
+                                            self.offload_dir_name, self.digests)
+
+    def queue_finished_month(self, next_month):
+        """Called whenever the month being offloaded changes. APPLE folders
+        are processed in sorted order, so once the month changes, the
+        previous month's offload folder won't receive any more images."""
+        if not self.folder_queue:
+            return
+        if self.pending_month and self.pending_month != next_month:
+            self.folder_queue.put(os.path.join(self.full_path,
+                                                        self.pending_month))
+        if next_month is None:
+            self.folder_queue.put(None)
+        self.pending_month = next_month
+
+    def copy_new_imgs(self):
         APPLE_folders = self.src_iDevice_DCIM.list_APPLE_folders()
+        if getattr(dir_names, "TRUST_FOLDER_MTIME", False):
+            # Only set where adding a file was seen to change the folder mtime
+            # (not the case on every gvfs mount). Then a folder whose mtime
+            # matches the fingerprint stored at the end of the last offload
+            # hasn't changed since, so don't even list it.
+            folder_mtimes = self.src_iDevice_DCIM.stat_APPLE_folders(
+                                                                APPLE_folders)
+            APPLE_folders = [APPLE_folder for APPLE_folder in APPLE_folders
+                            if not self.MTree.fingerprint_matches(APPLE_folder,
+                                        dir_mtime=folder_mtimes[APPLE_folder])]
+        else:
+            # Every folder listed and checked against fingerprint below.
+            folder_mtimes = {}
+        # List remaining APPLE folders concurrently up front rather than one
+        # at a time inside loop.
+        self.src_iDevice_DCIM.prefetch_APPLE_contents(APPLE_folders)
         # Make set of items for each dir in iDevice DCIM.
         # Compare to set of items in corresponding mirror_tree YYYYMM dir.
         for APPLE_folder in tqdm(APPLE_folders, position=0, desc=" DCIM folders"):
-            src_APPLE_path = self.src_iDevice_DCIM.get_APPLE_folder_path(
-                                                                APPLE_folder)
             dir_month = APPLE_folder[:6] # ignore chars after YYYYMM
             offload_mon_path = os.path.join(self.full_path, dir_month) + "/"
 
 
-            imgs = set(self.src_iDevice_DCIM.get_APPLE_contents(APPLE_folder))
+            APPLE_contents = self.src_iDevice_DCIM.get_APPLE_contents(APPLE_folder)
+            # (size, mtime) of every image, stat'd concurrently.
+            img_stats = self.src_iDevice_DCIM.stat_APPLE_contents(APPLE_folder,
+                                                                APPLE_contents)
+            if self.MTree.fingerprint_matches(APPLE_folder,
+                                    contents=APPLE_contents,
+                                    total_size=sum(size for (size, mtime)
+                                                        in img_stats.values())):
+                # Same entry count, highest filename, and total size as last
+                # offload, so no new images. Skip set difference against mirror.
+                self.record_fingerprint(APPLE_folder, APPLE_contents,
+                                folder_mtimes.get(APPLE_folder, 0), img_stats)
+                continue
+
+            imgs = set(APPLE_contents)
+            replaced_imgs = set()
             if not os.path.exists(self.MTree.get_mon_path(dir_month)):
                 transfer_type = "New"
                 # No comparison needed. Copy all imgs from device for this month.
@@ -503,39 +889,121 @@ class NewRawOffload(RawOffload):
             else:
                 transfer_type = "Overlap"
                 mirror_imgs = set(self.MTree.get_month_contents(dir_month))
-                new_imgs = imgs - mirror_imgs
+                # Names already in mirror may still be different files. iOS
+                # reuses IMG_ numbers after a device reset.
+                replaced_imgs = set(img_name for img_name in imgs & mirror_imgs
+                            if self.MTree.entry_changed(dir_month, img_name,
+                                                        img_stats[img_name]))
+                new_imgs = (imgs - mirror_imgs) | replaced_imgs
 
             if new_imgs:
                 if not os.path.exists(offload_mon_path):
                     # May already exist since multiple YYYYMMxx folders often
                     # exist on iDevice
                     self.create_APPLE_folder(dir_month)
+                self.queue_finished_month(dir_month)
 
                 print("%s folder: %s" % (transfer_type, APPLE_folder))
                 print("%s-transfer progress:" % transfer_type)
             else:
+                self.record_fingerprint(APPLE_folder, APPLE_contents,
+                                folder_mtimes.get(APPLE_folder, 0), img_stats)
                 continue # To prevent loop below from printing empty tqdm bar
-            for img_name in tqdm(sorted(new_imgs), position=1, desc=" Images",
-                                                   leave=False, colour="green"):
-                src_img_path = os.path.join(src_APPLE_path, img_name)
-                while True:
-                    try:
-                        shutil.copy2(src_img_path, offload_mon_path)
-                    except OSError:
-                        # iOS has bug that can terminate PC connection.
-                        # Requires iDevice restart to fix.
-                        reconn_success = self.src_iDevice_DCIM.reconnect()
-                        if not reconn_success:
-                            return
-                        # Update local variable that has gvfs root path embedded
-                        src_APPLE_path = self.src_iDevice_DCIM.get_APPLE_folder_path(
-                                                                   APPLE_folder)
-                        continue # retry
-                    else:
-                        # Runs only if copy operation successful
-                        # Create empty file w/ same name in mirror tree
-                        self.MTree.create_mirror_file(dir_month, img_name)
-                        break
+            if replaced_imgs:
+                print("%d image(s) have same name as previously-offloaded "
+                      "image(s) but different size or mod time. Copying "
+                                    "those too." % len(replaced_imgs))
+
+            # Bytes (ETA from sizes already stat'd) plus file count.
+            copied_imgs = []
+            folder_digests = {}
+            img_progress = copy_engine.CopyProgress(sum(img_stats[img_name][0]
+                                for img_name in new_imgs), len(new_imgs),
+                                desc=" Images", position=1, leave=False,
+                                                                colour="green")
+            def img_done(img_name, error):
+                if error is None:
+                    # Runs only if copy operation successful. Mirror entry
+                    # made once copies are committed to disk (below).
+                    copied_imgs.append(img_name)
+                    img_progress.file_done()
+
+            # Copied unit by unit (see media_unit) so a Live Photo's video
+            # or an edit's sidecar follows its photo.
+            remaining_imgs = [img_name for Unit
+                                in media_unit.build_units(new_imgs)
+                                for img_name in Unit.get_names()]
+            while remaining_imgs:
+                copy_results = self.src_iDevice_DCIM.copy_APPLE_imgs(
+                        APPLE_folder, remaining_imgs, offload_mon_path, img_done,
+                                        img_progress.add_bytes, folder_digests)
+                remaining_imgs = [img_name for img_name in remaining_imgs
+                                                    if copy_results[img_name]]
+                if remaining_imgs:
+                    # iOS has bug that can terminate PC connection.
+                    # Requires iDevice restart to fix.
+                    reconn_success = self.src_iDevice_DCIM.reconnect()
+                    if not reconn_success:
+                        img_progress.close()
+                        copied_imgs = self.drop_partial_units(offload_mon_path,
+                                                        copied_imgs, new_imgs)
+                        self.commit_copies(APPLE_folder, offload_mon_path,
+                                    copied_imgs, replaced_imgs, img_stats,
+                                                                folder_digests)
+                        return
+                    # retry failed copies
+            img_progress.close()
+            self.commit_copies(APPLE_folder, offload_mon_path, copied_imgs,
+                                    replaced_imgs, img_stats, folder_digests)
+            self.record_fingerprint(APPLE_folder, APPLE_contents,
+                                folder_mtimes.get(APPLE_folder, 0), img_stats)
+
+    def drop_partial_units(self, offload_mon_path, copied_imgs, new_imgs):
+        """Removes copies of media units not copied in full (e.g. photo made
+        it but its Live Photo video didn't) so whole unit is copied together
+        next offload instead of ORG and CAT seeing it in pieces. Returns
+        copied images in complete units."""
+        complete_imgs = media_unit.complete_names(copied_imgs, new_imgs)
+        partial_imgs = sorted(set(copied_imgs) - set(complete_imgs))
+        for img_name in partial_imgs:
+            img_path = os.path.join(offload_mon_path, img_name)
+            if os.path.exists(img_path):
+                os.remove(img_path)
+                copy_engine.track_rename(img_path, None)
+        if partial_imgs:
+            print("Removed %d image(s) from incomplete media unit(s). They'll "
+                        "be copied with rest of unit next offload."
+                                                        % len(partial_imgs))
+        return complete_imgs
+
+    def commit_copies(self, APPLE_folder, offload_mon_path, copied_imgs,
+                                    replaced_imgs, img_stats, folder_digests):
+        """Syncs copied images to disk in one go, then records them in mirror
+        tree, change journal, and offload digests. A crash before this leaves
+        no mirror entries, so next offload copies them again rather than
+        trusting files that may not have made it to disk."""
+        dir_month = APPLE_folder[:6]
+        copy_engine.commit([offload_mon_path])
+        for img_name in copied_imgs:
+            self.digests["%s/%s" % (dir_month, img_name)] = {
+                                        "src": APPLE_folder,
+                                        "size": img_stats[img_name][0],
+                                        "mtime": img_stats[img_name][1],
+                                        "sha1": folder_digests.get(img_name)}
+            change_journal.record_created(os.path.join(offload_mon_path,
+                                                                    img_name))
+            # Create empty file w/ same name in mirror tree
+            self.MTree.create_mirror_file(dir_month, img_name,
+                                        allow_dup=img_name in replaced_imgs,
+                                        img_stat=img_stats[img_name])
+
+    def record_fingerprint(self, APPLE_folder, APPLE_contents, dir_mtime,
+                                                                    img_stats):
+        total_size = sum(size for (size, mtime) in img_stats.values())
+        newest_mtime = max([mtime for (size, mtime) in img_stats.values()],
+                                                                    default=0)
+        self.MTree.set_fingerprint(APPLE_folder, APPLE_contents, dir_mtime,
+                                                    total_size, newest_mtime)
 
     def __repr__(self):
         return "NewRawOffload object with path:\n\t%s" % self.full_path
@@ -560,6 +1028,19 @@ class MirrorTree(object):
         if not os.path.exists(self.get_path()):
             self.build_tree()
 
+        # Per-APPLE-folder fingerprints from previous offloads.
+        self.fingerprint_path = os.path.join(self.full_path,
+                                                        FINGERPRINT_FILE_NAME)
+        self.fingerprints = self.load_fingerprints()
+        # (size, mtime) recorded for each mirror entry, by month. Entries
+        # created before this was tracked have none.
+        self.entry_stats_path = os.path.join(self.full_path,
+                                                        MIRROR_STATS_FILE_NAME)
+        self.entry_stats = self.load_entry_stats()
+        # Raw_Offload dir name: (digests, APPLE folders), read as needed to
+        # seed stats of entries that have none.
+        self.seed_sources = {}
+
         # Save current state for debugging
         self.log_tree()
 
@@ -599,6 +1080,7 @@ class MirrorTree(object):
         # Build whole tree before most recent offload month
         APPLE_folders = self.iDevice_DCIM.list_APPLE_folders()
         old_APPLE_folders = [x for x in APPLE_folders if x[:6] < last_offload_mon]
+        self.iDevice_DCIM.prefetch_APPLE_contents(old_APPLE_folders)
         for APPLE_folder in old_APPLE_folders:
             dir_month = APPLE_folder[:6] # ignore chars after YYYYMM
             if not self.month_exists(dir_month):
@@ -613,6 +1095,126 @@ class MirrorTree(object):
             # Pre-structure change months sometimes have dups
             self.create_mirror_file(last_offload_mon, img, allow_dup=True)
 
+    def load_fingerprints(self):
+        if os.path.exists(self.fingerprint_path):
+            with open(self.fingerprint_path, "r") as fp_file:
+                return json.load(fp_file)
+        else:
+            return {}
+
+    def save_fingerprints(self):
+        with open(self.fingerprint_path + ".tmp", "w") as fp_file:
+            json.dump(self.fingerprints, fp_file, indent=1, sort_keys=True)
+        os.replace(self.fingerprint_path + ".tmp", self.fingerprint_path)
+
+    def get_fingerprint(self, APPLE_folder):
+        # Returns None if folder never fingerprinted.
+        return self.fingerprints.get(APPLE_folder)
+
+    def set_fingerprint(self, APPLE_folder, APPLE_contents, dir_mtime,
+                                                    total_size, newest_mtime):
+        """Records state of device APPLE folder once it's fully offloaded:
+        entry count, highest filename, total size, folder mtime, and mtime of
+        newest file in it."""
+        if dir_mtime > time.time() - FINGERPRINT_MTIME_MARGIN:
+            # Folder changed too recently to trust its mtime (coarse mtime
+            # resolution, device clock offset). Force listing next time.
+            dir_mtime = 0
+        self.fingerprints[APPLE_folder] = {
+                    "count": len(APPLE_contents),
+                    "last": max(APPLE_contents) if APPLE_contents else "",
+                    "size": total_size,
+                    "dir_mtime": dir_mtime,
+                    "newest": newest_mtime}
+
+    def fingerprint_matches(self, APPLE_folder, dir_mtime=None, contents=None,
+                                                            total_size=None):
+        """Compares stored fingerprint to whatever is known about the folder
+        now. Only the given criteria are checked."""
+        fingerprint = self.get_fingerprint(APPLE_folder)
+        if not fingerprint:
+            return False
+        if dir_mtime is not None and (not dir_mtime
+                                    or dir_mtime != fingerprint["dir_mtime"]):
+            # Some mounts report no folder mtime. Can't rely on it then.
+            return False
+        if dir_mtime and (fingerprint.get("newest") is None
+                                or dir_mtime + device_io.DEVICE_MTIME_TOLERANCE
+                                                    < fingerprint["newest"]):
+            # Folder mtime older than a file in it, so it doesn't track
+            # additions. Re-list.
+            return False
+        if contents is not None:
+            if (len(contents) != fingerprint["count"]
+                or (max(contents) if contents else "") != fingerprint["last"]):
+                return False
+        if total_size is not None and total_size != fingerprint["size"]:
+            return False
+        return True
+
+    def load_entry_stats(self):
+        if os.path.exists(self.entry_stats_path):
+            with open(self.entry_stats_path, "r") as stats_file:
+                return json.load(stats_file)
+        else:
+            return {}
+
+    def save_entry_stats(self):
+        with open(self.entry_stats_path + ".tmp", "w") as stats_file:
+            json.dump(self.entry_stats, stats_file, sort_keys=True)
+        os.replace(self.entry_stats_path + ".tmp", self.entry_stats_path)
+
+    def get_entry_stat(self, YYYYMM, filename):
+        # Returns [size, mtime] or None if not recorded.
+        return self.entry_stats.get(YYYYMM, {}).get(filename)
+
+    def get_seed_stat(self, YYYYMM, filename):
+        """Returns [size, mtime] for entry created before stats were tracked,
+        from newest Raw_Offload copy of it: device stats recorded in that
+        offload's digests, or just the copy's size (mtime None) if offload
+        predates digests. None if no copy found."""
+        for Offload in reversed(self.ParentGroup.get_offload_obj_set()):
+            dir_name = Offload.get_dir_name()
+            if dir_name not in self.seed_sources:
+                self.seed_sources[dir_name] = (offload_verify.load_digests(
+                                    self.ParentGroup.get_RO_root(), dir_name),
+                                    Offload.list_APPLE_folders())
+            (digests, APPLE_folders) = self.seed_sources[dir_name]
+            record = digests.get("%s/%s" % (YYYYMM, filename))
+            if record and record.get("size") is not None:
+                return [record["size"], record.get("mtime")]
+            for APPLE_folder in APPLE_folders:
+                img_path = os.path.join(Offload.get_full_path(), APPLE_folder,
+                                                                    filename)
+                if APPLE_folder.startswith(YYYYMM) and os.path.isfile(img_path):
+                    return [os.path.getsize(img_path), None]
+        return None
+
+    def entry_changed(self, YYYYMM, filename, img_stat):
+        """Returns True if device file's (size, mtime) differs from what was
+        recorded when mirror entry was created. Entries without recorded stats
+        are checked against their Raw_Offload copy instead (then seeded with
+        device stats if unchanged), and assumed unchanged if there is none."""
+        entry_stat = self.get_entry_stat(YYYYMM, filename)
+        seeded = False
+        if not entry_stat:
+            entry_stat = self.get_seed_stat(YYYYMM, filename)
+            if not entry_stat:
+                return False
+            seeded = True
+        if entry_stat[0] != img_stat[0]:
+            return True
+        if entry_stat[1] is not None:
+            mtime_diff = abs(entry_stat[1] - img_stat[1])
+            # Shift by a whole number of hours is a DST or time zone change on
+            # device, not a new file.
+            if (abs(mtime_diff - round(mtime_diff / 3600) * 3600)
+                                                    > device_io.DEVICE_MTIME_TOLERANCE):
+                return True
+        if seeded:
+            self.entry_stats.setdefault(YYYYMM, {})[filename] = list(img_stat)
+        return False
+
     def get_month_contents(self, YYYYMM):
         return os.listdir(self.get_mon_path(YYYYMM))
 
@@ -623,13 +1225,18 @@ class MirrorTree(object):
         if not self.month_exists(YYYYMM):
             os.mkdir(self.get_mon_path(YYYYMM))
 
-    def create_mirror_file(self, YYYYMM, filename, allow_dup=False):
+    def create_mirror_file(self, YYYYMM, filename, allow_dup=False,
+                                                                img_stat=None):
         file_path = os.path.join(self.get_mon_path(YYYYMM), filename)
 
         if os.path.exists(file_path) and not allow_dup:
             raise RawOffloadError("Tried creating mirror file %s, but it "
                                     "already exists in %s" % (filename, YYYYMM))
-        elif os.path.exists(file_path):
+        if img_stat:
+            # Recorded even for dups so a replaced file's new stats are kept.
+            self.entry_stats.setdefault(YYYYMM, {})[filename] = list(img_stat)
+
+        if os.path.exists(file_path):
             return
         else:
             fd = open(file_path, "x")
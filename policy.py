@@ -0,0 +1,183 @@
+import os
+import time
+import json
+import threading
+
+
+class PolicyFileError(Exception):
+    pass
+
+
+# Pre-answered decisions for unattended runs (full_bu.py --policy).
+# Policy file is a JSON object mapping decision class to the answer that
+# class's prompt would otherwise get typed in, e.g.
+#   {"collision": "k", "date_fallback": "defer", "merge": "y",
+#    "empty_ro_folder": "d", "caption_append": "n"}
+# "defer" takes the conservative option (usually skipping the item) and lists
+# the item in the end-of-run summary so it can be handled by hand later.
+# Classes left out of the policy file are still prompted for.
+# Asking is plain input() unless a policy has been loaded, so the tools
+# behave as before when run interactively.
+# Prompts go through get_input() so threads running at the same time
+# (pipelined OFFLOAD and ORG) ask one at a time and each answer goes to the
+# thread that asked.
+
+PROMPT_LOCK = threading.Lock()
+
+# decision class: (allowed answers, answer substituted for "defer", description)
+DECISION_CLASSES = {
+    "collision": (["s", "o", "k", "defer"], "s",
+        "Different file with same name in destination. Skip, overwrite, or "
+                                                                "keep both."),
+    "date_fallback": (["", "s", "defer"], "s",
+        "No valid EXIF timestamp. '' falls back on fs mod time, 's' skips."),
+    "age_warning": (["", "s", "defer"], "s",
+        "Date older than newest Organized dir. '' copies into older dir "
+                                                        "anyway, 's' skips."),
+    "ignore_month_warnings": (["y", "n"], None,
+        "After an age warning is bypassed, stop warning for that month."),
+    "merge": (["y", "n"], None,
+        "Merge multiple Raw_Offload folders created today."),
+    "merge_journal": (["c", "r"], None,
+        "Complete or roll back a merge interrupted in an earlier run."),
+    "empty_ro_folder": (["d", "k", "defer"], "k",
+        "Delete or keep empty Raw_Offload folder left by aborted offload."),
+    "caption_append": (["y", "n", "defer"], "n",
+        "Append caption found in EXIF data to file name."),
+    "caption_transfer": (["skip", "defer"], "skip",
+        "Manual transfer of captioned images through NAS share."),
+    "buffer_prep": (["skip", "defer"], "skip",
+        "Manual bulk moves into st_buffer before CAT."),
+    "manual_sort": (["q", "defer"], "q",
+        "Manual-sort folder in CAT buffer still populated."),
+    "unmapped_device": (["defer"], "skip",
+        "Connected device with serial not listed in DEVICE_BU_ROOTS."),
+    "device_retry": (["retry", "q"], None,
+        "Device unreachable or I/O error. Wait and retry, or give up."),
+    "nas_retry": (["retry"], None,
+        "NAS share unreachable. Wait and retry."),
+    "verify_recopy": (["y", "n", "defer"], "n",
+        "Re-copy offloaded files that failed verification from device."),
+}
+
+# Classes that loop back to the same prompt until something outside the
+# program changes. Answering from policy pauses first so they poll.
+RETRY_CLASSES = ["device_retry", "nas_retry"]
+DEFAULT_RETRY_DELAY = 30  # seconds
+
+_ActivePolicy = None
+
+
+class Policy(object):
+    """Represents policy file loaded for an unattended run. Keeps a record of
+    every decision it answers and every item it deferred."""
+    def __init__(self, policy_path):
+        self.policy_path = policy_path
+        if not os.path.isfile(self.policy_path):
+            raise PolicyFileError("Policy file %s not found." % self.policy_path)
+        with open(self.policy_path, "r") as policy_file:
+            try:
+                policy_data = json.load(policy_file)
+            except ValueError as error:
+                raise PolicyFileError("Policy file %s not valid JSON: %s"
+                                                    % (self.policy_path, error))
+
+        # Optional setting stored alongside answers.
+        self.retry_delay = policy_data.pop("retry_delay", DEFAULT_RETRY_DELAY)
+
+        self.answers = {}
+        for decision_class, answer in policy_data.items():
+            if decision_class not in DECISION_CLASSES:
+                raise PolicyFileError("Unknown decision class '%s' in %s. "
+                        "Expected one of %s" % (decision_class, self.policy_path,
+                                                sorted(DECISION_CLASSES.keys())))
+            allowed_answers = DECISION_CLASSES[decision_class][0]
+            if str(answer).lower() not in allowed_answers:
+                raise PolicyFileError("Invalid answer '%s' for '%s'. Expected "
+                        "one of %s" % (answer, decision_class, allowed_answers))
+            self.answers[decision_class] = str(answer).lower()
+
+        self.decision_counts = {}
+        self.deferred = []  # (decision class, subject) tuples
+        self.lock = threading.Lock()
+
+    def get_policy_path(self):
+        return self.policy_path
+
+    def has_answer(self, decision_class):
+        return decision_class in self.answers
+
+    def get_answer(self, decision_class, subject=None):
+        """Returns answer for decision class (with "defer" translated into
+        the class's defer answer) and records it. Returns None if policy
+        doesn't cover the class."""
+        answer = self.answers.get(decision_class)
+        if answer is None:
+            return None
+        with self.lock:
+            self.decision_counts[decision_class] = (
+                                self.decision_counts.get(decision_class, 0) + 1)
+            if answer == "defer":
+                self.deferred.append((decision_class, subject))
+        if answer == "defer":
+            return DECISION_CLASSES[decision_class][1]
+        return answer
+
+    def defer(self, decision_class, subject):
+        # For callers that skip something outright in unattended runs.
+        with self.lock:
+            self.deferred.append((decision_class, subject))
+
+    def get_deferred(self):
+        return self.deferred
+
+    def print_summary(self):
+        print("\nPolicy decisions made (%s):" % self.policy_path)
+        if not self.decision_counts:
+            print("\tNone")
+        for decision_class, count in sorted(self.decision_counts.items()):
+            print("\t%s: '%s' x%d" % (decision_class,
+                                        self.answers[decision_class], count))
+
+        print("\nDeferred decisions (%d):" % len(self.deferred))
+        if not self.deferred:
+            print("\tNone")
+        for decision_class, subject in self.deferred:
+            print("\t%s: %s" % (decision_class, subject))
+
+    def __repr__(self):
+        return "Policy object with path:\n\t%s" % self.policy_path
+
+
+def load_policy(policy_path):
+    global _ActivePolicy
+    _ActivePolicy = Policy(policy_path)
+    return _ActivePolicy
+
+
+def get_active_policy():
+    return _ActivePolicy
+
+
+def is_unattended():
+    return _ActivePolicy is not None
+
+
+def ask(decision_class, prompt, subject=None):
+    """Drop-in for input() at a decision point. Returns policy's answer if
+    loaded policy covers decision class, otherwise prompts as usual."""
+    if _ActivePolicy and _ActivePolicy.has_answer(decision_class):
+        answer = _ActivePolicy.get_answer(decision_class, subject)
+        if decision_class in RETRY_CLASSES and answer == "retry":
+            print("\n%s\n(Policy: retrying in %d s.)"
+                            % (prompt.strip(), _ActivePolicy.retry_delay))
+            time.sleep(_ActivePolicy.retry_delay)
+            return ""
+        return answer
+    return get_input(prompt)
+
+
+def get_input(prompt=""):
+    """input() that holds PROMPT_LOCK while waiting for answer."""
+    with PROMPT_LOCK:
+        return input(prompt)
@@ -0,0 +1,223 @@
+import os
+import io
+import shutil
+import subprocess
+import threading
+import queue
+import itertools
+
+import PIL.Image
+import PIL.ImageOps
+
+
+PREVIEW_DIR_NAME = ".cat_previews"  # Stored next to Cat_Buffer in BU root
+PREVIEW_WORKERS = 3
+PREVIEW_MAX_SIZE = (1280, 1280)  # Bounding box for generated previews
+PREVIEW_MIN_EXIF_THUMB = 320  # px width. Smaller EXIF thumbnails not used.
+PREVIEW_PREFETCH_COUNT = 5  # Items ahead of current one to bump in queue
+PREVIEW_WAIT_TIMEOUT = 10  # seconds to wait for preview before using original
+POSTER_FRAME_TIME = "0.5"  # seconds into video
+FFMPEG_TIMEOUT = 30  # seconds
+
+IMAGE_EXTS = [".JPG", ".JPEG", ".PNG", ".GIF", ".WEBP"]
+VIDEO_EXTS = [".MOV", ".MP4", ".M4V"]
+
+# Priorities for generation queue. Lower runs first.
+PREFETCH_PRIORITY = 0
+FILL_PRIORITY = 1
+
+
+# Downscaled previews of Cat_Buffer media for Categorizer to display instead
+# of full-size originals (slow to open) or HEIC/video files (can't be shown or
+# take long to load).
+# A worker pool fills the cache for the whole buffer in the background, in
+# order. Categorizer bumps the next few items to the front of the queue as it
+# goes, so the preview is normally ready by the time an item comes up.
+
+class PreviewCache(object):
+    """Represents preview cache dir for a cat buffer. Previews are keyed by
+    source name, size, and mtime, so a changed file gets a new preview."""
+    def __init__(self, buffer_root, workers=PREVIEW_WORKERS):
+        self.buffer_root = buffer_root
+        self.cache_dir = os.path.join(os.path.dirname(
+                            os.path.normpath(buffer_root)), PREVIEW_DIR_NAME)
+        if not os.path.exists(self.cache_dir):
+            os.mkdir(self.cache_dir)
+        self.workers = workers
+        self.ffmpeg_path = shutil.which("ffmpeg")
+
+        self.job_queue = queue.PriorityQueue()
+        self.counter = itertools.count()  # keeps FIFO order within a priority
+        self.events = {}  # img path: threading.Event set once attempted
+        self.started = set()  # img paths a worker has picked up
+        self.results = {}  # img path: preview path or None
+        self.lock = threading.Lock()
+        self.worker_threads = []
+
+    def get_cache_dir(self):
+        return self.cache_dir
+
+    def get_preview_path(self, img_path):
+        img_stat = os.stat(img_path)
+        preview_name = "%s_%d_%d.jpg" % (os.path.basename(img_path),
+                                    img_stat.st_size, int(img_stat.st_mtime))
+        return os.path.join(self.cache_dir, preview_name)
+
+    def start_workers(self):
+        # Started on first use so nothing runs if previews never needed.
+        if self.worker_threads:
+            return
+        for n in range(self.workers):
+            worker_thread = threading.Thread(target=self.worker,
+                                    name="PreviewCache-%d" % n, daemon=True)
+            worker_thread.start()
+            self.worker_threads.append(worker_thread)
+
+    def worker(self):
+        while True:
+            (priority, count, img_path) = self.job_queue.get()
+            with self.lock:
+                event = self.events[img_path]
+                if img_path in self.started:
+                    # Already picked up (queued at both priorities).
+                    continue
+                self.started.add(img_path)
+            try:
+                preview_path = self.generate(img_path)
+            except Exception:
+                # Any failure just means original gets displayed.
+                preview_path = None
+            with self.lock:
+                self.results[img_path] = preview_path
+                event.set()
+
+    def enqueue(self, img_path, priority):
+        with self.lock:
+            if img_path in self.events and (priority == FILL_PRIORITY
+                                            or img_path in self.started):
+                return
+            self.events.setdefault(img_path, threading.Event())
+        self.job_queue.put((priority, next(self.counter), img_path))
+
+    def fill(self, img_paths):
+        """Queues previews for all given paths in background, in order."""
+        self.start_workers()
+        for img_path in img_paths:
+            self.enqueue(img_path, FILL_PRIORITY)
+
+    def prefetch(self, img_paths):
+        """Moves given paths (e.g. next few in buffer) to front of queue."""
+        self.start_workers()
+        for img_path in img_paths:
+            self.enqueue(img_path, PREFETCH_PRIORITY)
+
+    def get_preview(self, img_path, timeout=PREVIEW_WAIT_TIMEOUT):
+        """Returns path to preview for img, generating it now if needed.
+        Returns None if no preview could be made in time."""
+        self.prefetch([img_path])
+        if self.events[img_path].wait(timeout):
+            return self.results.get(img_path)
+        return None
+
+    def generate(self, img_path):
+        """Writes preview for img_path unless already cached. Returns preview
+        path or None if file type not supported."""
+        if not os.path.isfile(img_path):
+            return None
+        preview_path = self.get_preview_path(img_path)
+        if os.path.exists(preview_path):
+            return preview_path
+
+        img_ext = os.path.splitext(img_path)[-1].upper()
+        tmp_path = preview_path + ".tmp"
+        if img_ext in VIDEO_EXTS:
+            made_preview = self.write_poster_frame(img_path, tmp_path)
+        elif img_ext in IMAGE_EXTS:
+            made_preview = (self.write_exif_thumbnail(img_path, tmp_path)
+                            or self.write_downscaled(img_path, tmp_path))
+        else:
+            made_preview = False
+
+        if not made_preview:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, preview_path)
+        return preview_path
+
+    def write_exif_thumbnail(self, img_path, dest_path):
+        """Saves JPEG thumbnail embedded in EXIF data if there is one big
+        enough. Only the EXIF header is read."""
+        with PIL.Image.open(img_path) as img_obj:
+            if img_obj.format != "JPEG":
+                return False
+            exif_data = img_obj.info.get("exif")
+        if not exif_data:
+            return False
+        # Embedded thumbnail is a complete JPEG stream inside EXIF block.
+        thumb_start = exif_data.find(b"\xff\xd8\xff")
+        thumb_end = exif_data.rfind(b"\xff\xd9")
+        if thumb_start < 0 or thumb_end < thumb_start:
+            return False
+        thumb_data = exif_data[thumb_start:thumb_end + 2]
+        try:
+            with PIL.Image.open(io.BytesIO(thumb_data)) as thumb_obj:
+                if thumb_obj.size[0] < PREVIEW_MIN_EXIF_THUMB:
+                    return False
+                # Thumbnail carries no orientation tag of its own.
+                with PIL.Image.open(img_path) as img_obj:
+                    orientation = img_obj.getexif().get(0x0112, 1)
+                thumb_obj = rotate_for_orientation(thumb_obj, orientation)
+                thumb_obj.convert("RGB").save(dest_path, "JPEG")
+        except OSError:
+            return False
+        return True
+
+    def write_downscaled(self, img_path, dest_path):
+        with PIL.Image.open(img_path) as img_obj:
+            # For JPEGs, draft() decodes at reduced scale directly (much
+            # faster than decoding full size then shrinking).
+            img_obj.draft("RGB", PREVIEW_MAX_SIZE)
+            preview_obj = PIL.ImageOps.exif_transpose(img_obj)
+            preview_obj.thumbnail(PREVIEW_MAX_SIZE)
+            preview_obj.convert("RGB").save(dest_path, "JPEG", quality=85)
+        return True
+
+    def write_poster_frame(self, vid_path, dest_path):
+        if not self.ffmpeg_path:
+            return False
+        try:
+            CompProc = subprocess.run([self.ffmpeg_path, "-y", "-loglevel",
+                    "error", "-ss", POSTER_FRAME_TIME, "-i", vid_path,
+                    "-frames:v", "1", "-vf", "scale='min(%d,iw)':-2"
+                    % PREVIEW_MAX_SIZE[0], "-f", "image2", dest_path],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                                        timeout=FFMPEG_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            return False
+        return CompProc.returncode == 0 and os.path.exists(dest_path)
+
+    def prune(self):
+        """Removes previews whose source is no longer in buffer (moved out
+        or deleted)."""
+        buffer_names = set(os.listdir(self.buffer_root))
+        for preview_name in os.listdir(self.cache_dir):
+            # Strip "_<size>_<mtime>.jpg" to recover source name.
+            src_name = preview_name.rsplit("_", 2)[0]
+            if src_name not in buffer_names:
+                os.remove(os.path.join(self.cache_dir, preview_name))
+
+    def __repr__(self):
+        return "PreviewCache object with path:\n\t%s" % self.cache_dir
+
+
+def rotate_for_orientation(img_obj, orientation):
+    # EXIF orientation values: 3 = 180, 6 = 90 CW, 8 = 90 CCW
+    if orientation == 3:
+        return img_obj.rotate(180, expand=True)
+    elif orientation == 6:
+        return img_obj.rotate(270, expand=True)
+    elif orientation == 8:
+        return img_obj.rotate(90, expand=True)
+    else:
+        return img_obj
@@ -10,7 +10,7 @@ config = {
     'download_url': 'github.com/jbowen102/idevice_media_offload.git',
     'author_email': 'ew15dro6k216@opayq.net',
     'version': '0.1',
-    'install_requires': ['exiftool', 'PIL', 'mediadapt'],
+    'install_requires': ['exiftool', 'Pillow', 'mediadapt', 'numpy'],
     'packages': [''],
     'scripts': [''],
     'name': 'idevice_media_offload'